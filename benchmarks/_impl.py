@@ -0,0 +1,45 @@
+"""
+ベンチマーク共通ヘルパー
+
+各実装ディレクトリはモジュール名（storage, server など）が重複するため、
+1プロセスで1つの実装だけを読み込む
+"""
+
+import os
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPLEMENTATIONS = ["flask-custom", "flask-authlib", "fastapi-custom"]
+
+
+def use_impl(impl):
+    """実装ディレクトリを import パスに追加"""
+    if impl not in IMPLEMENTATIONS:
+        raise SystemExit(f"Unknown implementation: {impl} (choose from {', '.join(IMPLEMENTATIONS)})")
+    sys.path.insert(0, os.path.join(ROOT, impl))
+
+
+def make_access_token(impl, token, username, client_id, scope, expires_at: datetime):
+    """実装ごとの形式でアクセストークンのレコードを作成"""
+    if impl == "flask-authlib":
+        from models import Token
+        return Token(
+            access_token=token,
+            token_type="Bearer",
+            scope=scope,
+            expires_at=expires_at,
+            client_id=client_id,
+            username=username,
+        )
+    data = {
+        "username": username,
+        "client_id": client_id,
+        "scope": scope,
+        "expires_at": expires_at,
+    }
+    if impl == "flask-custom":
+        data["access_token"] = token
+        data["token_type"] = "Bearer"
+    return data
@@ -0,0 +1,143 @@
+"""
+fastapi-custom のクライアントの API レスポンスキャッシュ（api_cache.py）のベンチマーク
+
+認可サーバーを uvicorn でローカルのポートに起動し、-c 人のユーザー（セッション）がそれぞれ
+/api/call/me・profile・posts を順に呼び続ける。1回あたりの時間（ミリ秒の平均・p50・p95）と
+リソースサーバーへのリクエスト数を JSON で出力する
+
+- off: キャッシュなし（変更前と同じく毎回問い合わせて本文を受け取る）
+- revalidate: サーバーの Cache-Control を private, no-cache に置き換える（毎回 If-None-Match で問い合わせ、変更がなければ 304）
+- ttl: API_CACHE_TTL=--ttl で、サーバーの Cache-Control を private, max-age=--ttl に置き換える（期限内は問い合わせない）
+
+    python benchmarks/api_cache.py -n 3000 -c 8 --ttl 1
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+ENDPOINTS = ("me", "profile", "posts")
+
+
+def start_server(app, port):
+    """認可サーバーを別スレッドの uvicorn で起動"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def override_cache_control(app, cache_control):
+    """/api/* のレスポンスの Cache-Control を cache_control["value"] に置き換える（None なら変えない）"""
+
+    @app.middleware("http")
+    async def replace(request, call_next):
+        response = await call_next(request)
+        if cache_control["value"] and request.url.path.startswith("/api/"):
+            response.headers["Cache-Control"] = cache_control["value"]
+        return response
+
+
+async def bench(client, cookies, n):
+    import httpx
+
+    latencies = []
+
+    async def worker(count, http):
+        for i in range(count):
+            path = f"/api/call/{ENDPOINTS[i % len(ENDPOINTS)]}"
+            start = time.perf_counter()
+            response = await http.get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or "error" in response.json():
+                raise RuntimeError(f"{path}: {response.status_code} {response.text}")
+
+    # ASGITransport は lifespan を呼ばないので、共有クライアントの作成・終了はここで行う
+    async with client.lifespan(client.app):
+        transport = httpx.ASGITransport(app=client.app)
+        users = [
+            httpx.AsyncClient(transport=transport, base_url="http://localhost:5001", cookies={"session": cookie})
+            for cookie in cookies
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(n // len(users), http) for http in users))
+        elapsed = time.perf_counter() - start
+        for http in users:
+            await http.aclose()
+
+    latencies.sort()
+    stats = client.api_cache.stats()
+    return {
+        "requests_per_sec": round(len(latencies) / elapsed),
+        "mean_ms": round(statistics.fmean(latencies) * 1e3, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1e3, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1e3, 3),
+        "upstream_requests": stats["upstream_requests"],
+        "not_modified": stats["not_modified"],
+        "upstream_reduction": round(stats["upstream_reduction"], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=3000, help="リクエスト数（全ユーザーの合計）")
+    parser.add_argument("-c", type=int, default=8, help="同時に呼ぶユーザー数")
+    parser.add_argument("--ttl", type=float, default=1.0, help="ttl モードの API_CACHE_TTL（秒）")
+    parser.add_argument("--port", type=int, default=5900, help="認可サーバーのポート")
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    import client
+    import server
+    from api_cache import ApiResponseCache
+
+    cache_control = {"value": None}
+    override_cache_control(server.app, cache_control)
+    http_server, thread = start_server(server.app, args.port)
+    client.OAUTH_CONFIG["api_base"] = f"http://127.0.0.1:{args.port}/api"
+
+    # 認可フローを省略し、ユーザーごとのトークンとセッションを直接作る
+    cookies = []
+    for _ in range(args.c):
+        token = secrets.token_urlsafe(32)
+        server.storage.backend.save_access_token(token, make_access_token(
+            "fastapi-custom", token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+        ))
+        session_id = secrets.token_urlsafe(16)
+        client.sessions.set(session_id, {"status": "authorized", "access_token": token, "token_data": {}}, ttl=3600)
+        cookies.append(client.serializer.dumps(session_id))
+
+    results = {}
+    # off は maxsize=0（保存した直後に捨てる）でキャッシュを無効にする
+    for name, cache, server_cache_control in (
+        ("off", ApiResponseCache(ttl=0, maxsize=0), None),
+        ("revalidate", ApiResponseCache(ttl=args.ttl), "private, no-cache"),
+        ("ttl", ApiResponseCache(ttl=args.ttl), f"private, max-age={args.ttl:g}"),
+    ):
+        client.api_cache = cache
+        cache_control["value"] = server_cache_control
+        results[name] = asyncio.run(bench(client, cookies, args.n))
+
+    http_server.should_exit = True
+    thread.join()
+    print(json.dumps({
+        "requests": args.n,
+        "users": args.c,
+        "cache_ttl": args.ttl,
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
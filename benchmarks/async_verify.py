@@ -0,0 +1,112 @@
+"""
+fastapi-custom のトークン検証（verify_token）のベンチマーク
+
+/api/me を並行に呼び出したスループットを比較し、JSON で出力する
+
+- threadpool: 変更前と同じ同期の依存関数（FastAPI がスレッドプールで実行する）
+- async: async の verify_token と AsyncStorage（async_storage.py）
+
+サーバーは httpx の ASGITransport で同じプロセス内から呼び出す（ネットワークを含まない）
+
+    python benchmarks/async_verify.py -n 20000 --concurrency 64 --backend memory
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+
+def add_threadpool_route(server):
+    """変更前の /api/me（同期の verify_token）を /bench/me-threadpool として追加"""
+    from fastapi import Depends, HTTPException
+    from fastapi.security import HTTPAuthorizationCredentials
+
+    backend = server.storage.backend
+
+    def verify_token_threadpool(credentials: HTTPAuthorizationCredentials = Depends(server.security)):
+        token_data = backend.get_access_token(credentials.credentials)
+        if not token_data:
+            raise HTTPException(status_code=401, detail="Invalid access token")
+        if datetime.now() > token_data["expires_at"]:
+            raise HTTPException(status_code=401, detail="Access token expired")
+        return token_data
+
+    @server.app.get("/bench/me-threadpool")
+    async def get_user_info_threadpool(token_data: dict = Depends(verify_token_threadpool)):
+        user = backend.get_user(token_data["username"])
+        return {"username": token_data["username"], "name": user["name"], "email": user["email"]}
+
+
+async def bench_path(app, path, token, n, concurrency):
+    import httpx
+
+    headers = {"Authorization": f"Bearer {token}"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost:5000") as client:
+        # ウォームアップ
+        response = await client.get(path, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: {response.status_code} {response.text}")
+
+        async def worker(count):
+            for _ in range(count):
+                await client.get(path, headers=headers)
+
+        per_worker = n // concurrency
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(per_worker) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    total = per_worker * concurrency
+    return {
+        "requests": total,
+        "requests_per_sec": round(total / elapsed),
+        "us_per_request": round(elapsed / total * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=20000, help="リクエスト数")
+    parser.add_argument("--concurrency", type=int, default=64, help="並行リクエスト数")
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["STORAGE_BACKEND"] = args.backend
+        os.environ["STORAGE_SQLITE_PATH"] = os.path.join(tmp, "bench.db")
+        os.environ["TOKEN_FORMAT"] = "opaque"
+        import server
+
+        add_threadpool_route(server)
+        token = secrets.token_urlsafe(32)
+        backend = server.storage.backend
+        backend.save_access_token(token, make_access_token(
+            "fastapi-custom", token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+        ))
+
+        results = {
+            "threadpool": asyncio.run(bench_path(server.app, "/bench/me-threadpool", token, args.n, args.concurrency)),
+            "async": asyncio.run(bench_path(server.app, "/api/me", token, args.n, args.concurrency)),
+        }
+        if hasattr(backend, "close"):
+            backend.close()
+
+    print(json.dumps({
+        "impl": "fastapi-custom",
+        "backend": args.backend,
+        "concurrency": args.concurrency,
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+fastapi-custom のクライアントの /api/call/batch（複数の API を同時に呼ぶ）のベンチマーク
+
+認可サーバーを uvicorn でローカルのポートに起動し、ダッシュボードが me・profile・posts を取得する時間
+（ミリ秒の平均・p50・p95）を JSON で出力する
+
+- sequential: /api/call/{endpoint} を1つずつ順に呼ぶ（変更前のダッシュボード）
+- batch: /api/call/batch?endpoints=me,profile,posts を1回呼ぶ
+
+ネットワークの往復時間の代わりに、リソースサーバーの /api/* が応答する前に --latency 秒待つ
+API レスポンスキャッシュは無効にする（毎回リソースサーバーに問い合わせる）
+
+    python benchmarks/batch_fanout.py -n 200 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+ENDPOINTS = ("me", "profile", "posts")
+
+
+def start_server(app, port):
+    """認可サーバーを別スレッドの uvicorn で起動"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def add_latency(app, latency):
+    """/api/* の応答を latency 秒遅らせる"""
+
+    @app.middleware("http")
+    async def delay(request, call_next):
+        if request.url.path.startswith("/api/"):
+            await asyncio.sleep(latency)
+        return await call_next(request)
+
+
+async def bench(client, cookie, n, batch):
+    import httpx
+
+    latencies = []
+
+    # ASGITransport は lifespan を呼ばないので、共有クライアントの作成・終了はここで行う
+    async with client.lifespan(client.app):
+        transport = httpx.ASGITransport(app=client.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost:5001",
+                                     cookies={"session": cookie}) as http:
+            for _ in range(n):
+                start = time.perf_counter()
+                if batch:
+                    response = await http.get(f"/api/call/batch?endpoints={','.join(ENDPOINTS)}")
+                    failed = response.status_code != 200 or response.json()["errors"]
+                else:
+                    failed = False
+                    for endpoint in ENDPOINTS:
+                        response = await http.get(f"/api/call/{endpoint}")
+                        failed = failed or response.status_code != 200 or "error" in response.json()
+                latencies.append(time.perf_counter() - start)
+                if failed:
+                    raise RuntimeError(f"{response.status_code} {response.text}")
+
+    latencies.sort()
+    return {
+        "mean_ms": round(statistics.fmean(latencies) * 1e3, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1e3, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1e3, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=200, help="ダッシュボードの読み込み回数")
+    parser.add_argument("--latency", type=float, default=0.02, help="リソースサーバーの応答の遅延（秒）")
+    parser.add_argument("--port", type=int, default=5900, help="認可サーバーのポート")
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    import client
+    import server
+    from api_cache import ApiResponseCache
+
+    add_latency(server.app, args.latency)
+    http_server, thread = start_server(server.app, args.port)
+    client.OAUTH_CONFIG["api_base"] = f"http://127.0.0.1:{args.port}/api"
+    client.api_cache = ApiResponseCache(ttl=0, maxsize=0)
+
+    # 認可フローを省略し、トークンとセッションを直接作る
+    token = secrets.token_urlsafe(32)
+    server.storage.backend.save_access_token(token, make_access_token(
+        "fastapi-custom", token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+    ))
+    session_id = secrets.token_urlsafe(16)
+    client.sessions.set(session_id, {"status": "authorized", "access_token": token, "token_data": {}}, ttl=3600)
+    cookie = client.serializer.dumps(session_id)
+
+    results = {}
+    for name, batch in (("sequential", False), ("batch", True)):
+        results[name] = asyncio.run(bench(client, cookie, args.n, batch))
+
+    http_server.should_exit = True
+    thread.join()
+    print(json.dumps({
+        "endpoints": list(ENDPOINTS),
+        "loads": args.n,
+        "latency": args.latency,
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
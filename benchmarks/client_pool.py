@@ -0,0 +1,131 @@
+"""
+fastapi-custom のクライアント（client.py）の /api/call/{endpoint} のレイテンシ
+
+認可サーバーを uvicorn でローカルのポートに起動し、クライアントから実際の TCP 接続で API を呼ぶ
+1回あたりの時間（ミリ秒の平均・p50・p95）を JSON で出力する
+
+- before: 変更前のハンドラ（リクエストごとに httpx.AsyncClient を作る）。/bench/call-before/{endpoint} として追加する
+- pooled: 起動時に作った共有クライアント（接続プール・keep-alive）
+
+クライアントは httpx の ASGITransport で同じプロセス内から呼び出す（-c で同時に呼ぶ数を指定）
+
+    python benchmarks/client_pool.py -n 2000 -c 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+
+def start_server(app, port):
+    """認可サーバーを別スレッドの uvicorn で起動"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def add_before_route(client):
+    """変更前の /api/call/{endpoint} を /bench/call-before/{endpoint} として追加"""
+    import httpx
+    from fastapi import Cookie
+    from typing import Optional
+
+    @client.app.get("/bench/call-before/{endpoint}")
+    async def call_before(endpoint: str, session: Optional[str] = Cookie(None)):
+        access_token = client.get_access_token(client.get_session_id(session))
+        async with httpx.AsyncClient() as http:
+            response = await http.get(
+                f"{client.OAUTH_CONFIG['api_base']}/{endpoint}",
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+        return response.json()
+
+
+async def bench(client, path, cookie, n, concurrency):
+    import httpx
+
+    latencies = []
+
+    async def worker(count, http):
+        for _ in range(count):
+            start = time.perf_counter()
+            response = await http.get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or "error" in response.json():
+                raise RuntimeError(f"{path}: {response.status_code} {response.text}")
+
+    # ASGITransport は lifespan を呼ばないので、共有クライアントの作成・終了はここで行う
+    async with client.lifespan(client.app):
+        transport = httpx.ASGITransport(app=client.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost:5001",
+                                     cookies={"session": cookie}) as http:
+            await worker(10, http)
+            latencies.clear()
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(n // concurrency, http) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_sec": round(len(latencies) / elapsed),
+        "mean_ms": round(statistics.fmean(latencies) * 1e3, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1e3, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1e3, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=2000, help="リクエスト数")
+    parser.add_argument("-c", type=int, default=1, help="同時に呼ぶ数")
+    parser.add_argument("--port", type=int, default=5900, help="認可サーバーのポート")
+    parser.add_argument("--endpoint", default="me")
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    import client
+    import server
+
+    http_server, thread = start_server(server.app, args.port)
+    client.OAUTH_CONFIG["api_base"] = f"http://127.0.0.1:{args.port}/api"
+    add_before_route(client)
+
+    # 認可フローを省略し、トークンとセッションを直接作る
+    token = secrets.token_urlsafe(32)
+    server.storage.backend.save_access_token(token, make_access_token(
+        "fastapi-custom", token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+    ))
+    session_id = secrets.token_urlsafe(16)
+    client.sessions.set(session_id, {"status": "authorized", "access_token": token, "token_data": {}}, ttl=3600)
+    cookie = client.serializer.dumps(session_id)
+
+    results = {}
+    for name, path in (("before", f"/bench/call-before/{args.endpoint}"), ("pooled", f"/api/call/{args.endpoint}")):
+        results[name] = asyncio.run(bench(client, path, cookie, args.n, args.c))
+
+    http_server.should_exit = True
+    thread.join()
+    print(json.dumps({
+        "endpoint": f"/api/call/{args.endpoint}",
+        "requests": args.n,
+        "concurrency": args.c,
+        "http2": os.environ.get("HTTP2") == "1" and client.h2 is not None,
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Flask 版クライアント（flask-custom / flask-authlib の client.py）の /api/call/<endpoint> のレイテンシ
+
+認可サーバーを別プロセスの werkzeug のスレッドサーバー（python server.py と同じく keep-alive あり）で
+ローカルのポートに起動し、クライアントから実際の TCP 接続で API を呼ぶ。1回あたりの時間（ミリ秒の平均・p50・p95）を JSON で出力する
+
+- before: 変更前のハンドラ（flask-custom は requests.get、flask-authlib はリクエストごとの OAuth2Session）
+  /bench/call-before/<endpoint> として追加する
+- pooled: プロセスで共有する接続プール
+
+connections は新しく開いた TCP 接続の数（urllib3 のログから数える）
+
+クライアントはテストクライアントで同じプロセス内から呼び出す（-c で同時に呼ぶスレッド数を指定）
+
+    python benchmarks/client_session.py --impl flask-authlib -n 2000 -c 8
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+# Authlib のクライアントは http の API 呼び出しを拒否する
+os.environ.setdefault("AUTHLIB_INSECURE_TRANSPORT", "1")
+
+
+def serve(app, port):
+    from werkzeug.serving import make_server
+
+    # アクセスログの出力を計測に含めない
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def start_server(app, port):
+    """認可サーバーを別プロセスの werkzeug サーバーで起動（fork するので、起動前に保存したトークンが引き継がれる）"""
+    import socket
+
+    process = multiprocessing.get_context("fork").Process(
+        target=serve, args=(app, port), daemon=True,
+    )
+    process.start()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+
+def add_before_route(impl, client):
+    """変更前の /api/call/<endpoint> を /bench/call-before/<endpoint> として追加"""
+    from flask import jsonify, session
+
+    if impl == "flask-authlib":
+        from authlib.integrations.requests_client import OAuth2Session
+
+        def call_before(endpoint):
+            oauth = OAuth2Session(
+                client_id=client.OAUTH_CONFIG["client_id"],
+                client_secret=client.OAUTH_CONFIG["client_secret"],
+                redirect_uri=client.OAUTH_CONFIG["redirect_uri"],
+                token=session["token"],
+            )
+            return jsonify(oauth.get(f"{client.OAUTH_CONFIG['api_base']}/{endpoint}").json())
+    else:
+        import requests
+
+        def call_before(endpoint):
+            response = requests.get(
+                f"{client.OAUTH_CONFIG['api_base']}/{endpoint}",
+                headers={"Authorization": f"Bearer {session['access_token']}"},
+            )
+            return jsonify(response.json())
+
+    client.app.add_url_rule("/bench/call-before/<endpoint>", "call_before", call_before)
+
+
+class ConnectionCounter(logging.Handler):
+    """urllib3 が新しい接続を開いた回数を数える"""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        if record.getMessage().startswith("Starting new"):
+            self.count += 1
+
+
+def bench(impl, client, path, token, n, concurrency):
+    latencies = []
+    errors = []
+    counter = ConnectionCounter()
+    pool_logger = logging.getLogger("urllib3.connectionpool")
+
+    def worker(count):
+        test_client = client.app.test_client()
+        with test_client.session_transaction() as sess:
+            if impl == "flask-authlib":
+                sess["token"] = {"access_token": token, "token_type": "Bearer"}
+            else:
+                sess["access_token"] = token
+                sess["token_data"] = {}
+        for _ in range(count):
+            start = time.perf_counter()
+            response = test_client.get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or "error" in response.get_json():
+                errors.append(f"{path}: {response.status_code} {response.data!r}")
+                return
+
+    worker(10)
+    latencies.clear()
+    threads = [threading.Thread(target=worker, args=(n // concurrency,)) for _ in range(concurrency)]
+    pool_logger.setLevel(logging.DEBUG)
+    pool_logger.addHandler(counter)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool_logger.removeHandler(counter)
+    if errors:
+        raise RuntimeError(errors[0])
+
+    latencies.sort()
+    return {
+        "requests_per_sec": round(len(latencies) / elapsed),
+        "mean_ms": round(statistics.fmean(latencies) * 1e3, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1e3, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1e3, 3),
+        "connections": counter.count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom", choices=["flask-custom", "flask-authlib"])
+    parser.add_argument("-n", type=int, default=2000, help="リクエスト数")
+    parser.add_argument("-c", type=int, default=1, help="同時に呼ぶスレッド数")
+    parser.add_argument("--port", type=int, default=5900, help="認可サーバーのポート")
+    parser.add_argument("--endpoint", default="me")
+    args = parser.parse_args()
+
+    use_impl(args.impl)
+    import client
+    import server
+
+    # 認可フローを省略し、トークンを直接作る
+    token = secrets.token_urlsafe(32)
+    server.storage.save_access_token(token, make_access_token(
+        args.impl, token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+    ))
+    process = start_server(server.app, args.port)
+    client.OAUTH_CONFIG["api_base"] = f"http://127.0.0.1:{args.port}/api"
+    add_before_route(args.impl, client)
+
+    results = {}
+    for name, path in (("before", f"/bench/call-before/{args.endpoint}"), ("pooled", f"/api/call/{args.endpoint}")):
+        results[name] = bench(args.impl, client, path, token, args.n, args.c)
+
+    process.terminate()
+    process.join()
+    print(json.dumps({
+        "impl": args.impl,
+        "endpoint": f"/api/call/{args.endpoint}",
+        "requests": args.n,
+        "concurrency": args.c,
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+認可フロー全体の負荷テスト
+
+仮想ユーザーごとに 認可リクエスト → 同意（ログイン）→ トークン取得 → API 呼び出し を繰り返し、
+エンドポイントごとのスループットとレイテンシ（p50/p95/p99）を JSON で出力する
+出力をコミット間で diff して性能の変化を確認する
+
+- inprocess: テストクライアント経由でサーバーを同じプロセス内で呼び出す（デフォルト）
+- http: 起動済みのサーバー（--url）に HTTP で接続する（仮想ユーザーごとに keep-alive の接続を使う）
+
+    python benchmarks/load_flow.py --impl flask-custom --users 8 --flows 20 --api-rounds 10
+    python benchmarks/load_flow.py --impl fastapi-custom --mode http --url http://localhost:5000 -o report.json
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import math
+import os
+import re
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from _impl import use_impl
+
+CLIENT_ID = "demo-client-id"
+CLIENT_SECRET = "demo-client-secret"
+REDIRECT_URI = "http://localhost:5001/callback"
+USERNAME = "demo-user"
+PASSWORD = "demo-password"
+API_ENDPOINTS = ["/api/me", "/api/profile", "/api/posts"]
+
+# テストクライアントのホスト（Authlib は http の場合 localhost:<port> 以外を拒否する）
+BASE_URL = "http://localhost:5000"
+
+
+# ===== 接続 =====
+
+class FlaskTransport:
+    """Flask のテストクライアント（仮想ユーザーごとに作成）"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None):
+        response = self.client.open(path, method=method, data=data, headers=headers, base_url=BASE_URL)
+        return response.status_code, response.headers, response.data
+
+
+class FastAPITransport:
+    """FastAPI の TestClient（全仮想ユーザーで共有）"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, path, data=None, headers=None):
+        response = self.client.request(method, path, data=data, headers=headers, follow_redirects=False)
+        return response.status_code, response.headers, response.content
+
+
+class HTTPTransport:
+    """起動済みサーバーへの HTTP 接続（リダイレクトは追わない）"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        return response.status, response.headers, response.read()
+
+
+# ===== 計測 =====
+
+class Recorder:
+    """エンドポイントごとのレイテンシとエラー数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(values, p):
+    """ソート済みの values の p パーセンタイル（nearest-rank）"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def timed(recorder, transport, name, expected, method, path, data=None, headers=None):
+    start = time.perf_counter()
+    status, response_headers, body = transport.request(method, path, data, headers)
+    ok = status == expected
+    recorder.record(name, time.perf_counter() - start, ok)
+    return (response_headers, body) if ok else None
+
+
+# ===== 仮想ユーザー =====
+
+def run_flow(impl, transport, recorder, api_rounds):
+    """認可コードフローを1回実行し、取得したトークンで API を api_rounds 回ずつ呼ぶ"""
+    query = urlencode({
+        "response_type": "code",
+        "client_id": CLIENT_ID,
+        "redirect_uri": REDIRECT_URI,
+        "scope": "read",
+        "state": "load",
+    })
+    if timed(recorder, transport, "GET /authorize", 200, "GET", f"/authorize?{query}") is None:
+        return
+
+    # Authlib は同意も /authorize で受ける
+    consent_path = "/authorize" if impl == "flask-authlib" else "/authorize/consent"
+    form = {
+        "response_type": "code",
+        "client_id": CLIENT_ID,
+        "redirect_uri": REDIRECT_URI,
+        "scope": "read",
+        "state": "load",
+        "username": USERNAME,
+        "password": PASSWORD,
+    }
+    result = timed(recorder, transport, f"POST {consent_path}", 302, "POST", consent_path, form)
+    if result is None:
+        return
+    match = re.search(r"[?&]code=([^&]+)", result[0]["location"])
+    if match is None:
+        return
+
+    # 各実装のクライアントと同じクライアント認証方式を使う
+    form = {"grant_type": "authorization_code", "code": match.group(1), "redirect_uri": REDIRECT_URI}
+    headers = {}
+    if impl == "flask-authlib":
+        credentials = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+        headers["Authorization"] = f"Basic {credentials}"
+    else:
+        form.update(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
+    result = timed(recorder, transport, "POST /token", 200, "POST", "/token", form, headers)
+    if result is None:
+        return
+    access_token = json.loads(result[1])["access_token"]
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    for _ in range(api_rounds):
+        for path in API_ENDPOINTS:
+            timed(recorder, transport, f"GET {path}", 200, "GET", path, headers=headers)
+
+
+def run_users(impl, make_transport, users, flows, api_rounds):
+    recorder = Recorder()
+    barrier = threading.Barrier(users + 1)
+
+    def user():
+        transport = make_transport()
+        barrier.wait()
+        for _ in range(flows):
+            run_flow(impl, transport, recorder, api_rounds)
+
+    threads = [threading.Thread(target=user) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def report(recorder, duration):
+    endpoints = {}
+    total = 0
+    for name, latencies in recorder.latencies.items():
+        latencies.sort()
+        total += len(latencies)
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(name, 0),
+            "throughput_rps": round(len(latencies) / duration, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+    return {
+        "duration_sec": round(duration, 3),
+        "requests": total,
+        "errors": sum(recorder.errors.values()),
+        "throughput_rps": round(total / duration, 1),
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", default=BASE_URL, help="http モードの接続先")
+    parser.add_argument("--users", type=int, default=4, help="仮想ユーザー数（スレッド数）")
+    parser.add_argument("--flows", type=int, default=20, help="仮想ユーザーごとの認可フロー実行回数")
+    parser.add_argument("--api-rounds", type=int, default=10, help="1フローあたりの API 呼び出し回数（エンドポイントごと）")
+    parser.add_argument("-o", "--output", help="JSON レポートの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    def run(make_transport):
+        return run_users(args.impl, make_transport, args.users, args.flows, args.api_rounds)
+
+    if args.mode == "http":
+        recorder, duration = run(lambda: HTTPTransport(args.url))
+    else:
+        # 全リクエストが同じ IP・client_id から来るため、レート制限を外して測る
+        os.environ.setdefault("RATE_LIMIT_TOKEN", "0")
+        os.environ.setdefault("RATE_LIMIT_CONSENT", "0")
+        os.environ.setdefault("RATE_LIMIT_CONSENT_IP", "0")
+        use_impl(args.impl)
+        from server import app
+
+        if args.impl == "fastapi-custom":
+            from fastapi.testclient import TestClient
+
+            with TestClient(app) as client:
+                recorder, duration = run(lambda: FastAPITransport(client))
+        else:
+            recorder, duration = run(lambda: FlaskTransport(app))
+
+    result = {
+        "impl": args.impl,
+        "mode": args.mode,
+        "users": args.users,
+        "flows_per_user": args.flows,
+        "api_rounds": args.api_rounds,
+        **report(recorder, duration),
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+ログイン（同意フォームの送信）のスループットのベンチマーク
+
+同意フォームを並行に送信し、パスワード検証（scrypt）を行うログインのスループットと
+同時に実行した軽いリクエスト（GET /）のレイテンシを JSON で出力する
+
+検証プロセス数（PASSWORD_HASH_WORKERS）を変えて比較する
+0 はリクエストを処理するスレッド（FastAPI ではイベントループ）で検証する
+
+    python benchmarks/login_throughput.py --impl fastapi-custom -n 200 --concurrency 16 --workers 0 4
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+
+from _impl import use_impl
+
+CONSENT_FORM = {
+    "response_type": "code",
+    "client_id": "demo-client-id",
+    "redirect_uri": "http://localhost:5001/callback",
+    "scope": "read",
+    "state": "bench",
+    "username": "demo-user",
+    "password": "demo-password",
+}
+
+
+def percentile(values, p):
+    """ソート済みの values の p パーセンタイル（nearest-rank）"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def bench_flask(app, consent_path, n, concurrency):
+    logins, probes = [], []
+    done = threading.Event()
+
+    def login_worker(count):
+        client = app.test_client()
+        for _ in range(count):
+            start = time.perf_counter()
+            response = client.post(consent_path, data=CONSENT_FORM, base_url="http://localhost:5000")
+            logins.append(time.perf_counter() - start)
+            if response.status_code != 302:
+                raise RuntimeError(f"login failed: {response.status_code}")
+
+    def probe_worker():
+        client = app.test_client()
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get("/")
+            probes.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=login_worker, args=(n // concurrency,)) for _ in range(concurrency)]
+    probe = threading.Thread(target=probe_worker)
+    probe.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    probe.join()
+    return logins, probes, elapsed
+
+
+async def bench_fastapi(app, consent_path, n, concurrency):
+    import httpx
+
+    logins, probes = [], []
+    done = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost:5000") as client:
+        async def login_worker(count):
+            for _ in range(count):
+                start = time.perf_counter()
+                response = await client.post(consent_path, data=CONSENT_FORM)
+                logins.append(time.perf_counter() - start)
+                if response.status_code != 302:
+                    raise RuntimeError(f"login failed: {response.status_code}")
+
+        async def probe_worker():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/")
+                probes.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        probe = asyncio.create_task(probe_worker())
+        start = time.perf_counter()
+        await asyncio.gather(*(login_worker(n // concurrency) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe
+    return logins, probes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("-n", type=int, default=200, help="ログイン回数")
+    parser.add_argument("--concurrency", type=int, default=16, help="並行に送信する数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 4], help="比較する検証プロセス数")
+    args = parser.parse_args()
+
+    # 全リクエストが同じ IP・client_id から来るため、レート制限を外して測る
+    os.environ.setdefault("RATE_LIMIT_TOKEN", "0")
+    os.environ.setdefault("RATE_LIMIT_CONSENT", "0")
+    os.environ.setdefault("RATE_LIMIT_CONSENT_IP", "0")
+    use_impl(args.impl)
+    import passwords
+    import server
+
+    consent_path = "/authorize" if args.impl == "flask-authlib" else "/authorize/consent"
+    results = []
+    for workers in args.workers:
+        # server.py は passwords.verifier を参照するので、差し替えるだけで切り替わる
+        passwords.verifier.shutdown()
+        passwords.verifier = passwords.PasswordVerifier(workers)
+        # プロセスの起動をウォームアップで済ませておく
+        passwords.verifier.check("warmup", passwords.hash_password("warmup"))
+
+        if args.impl == "fastapi-custom":
+            logins, probes, elapsed = asyncio.run(bench_fastapi(server.app, consent_path, args.n, args.concurrency))
+        else:
+            logins, probes, elapsed = bench_flask(server.app, consent_path, args.n, args.concurrency)
+        results.append({
+            "hash_workers": workers,
+            "logins": summarize(logins, elapsed),
+            "concurrent_get_root": summarize(probes, elapsed),
+        })
+    passwords.verifier.shutdown()
+
+    print(json.dumps({
+        "impl": args.impl,
+        "concurrency": args.concurrency,
+        "scrypt": {"n": passwords.SCRYPT_N, "r": passwords.SCRYPT_R, "p": passwords.SCRYPT_P},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+複数プロセスで共有するストレージバックエンドのベンチマーク
+
+ワーカー数を変えながら、各プロセスがトークンを発行（save_access_token）し、
+別のプロセスが発行したトークンを検証（get_access_token）するスループットを計測する
+shm（共有メモリ）と sqlite（WAL）を比較し、JSON で出力する
+
+    python benchmarks/multiprocess_storage.py --impl fastapi-custom -n 5000 --workers 1 2 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+
+def token_for(worker, i):
+    return f"bench-{worker:03d}-{i:08d}"
+
+
+def worker_main(impl, backend, worker, workers, n, barrier, results):
+    use_impl(impl)
+    from storage import create_storage
+
+    storage = create_storage(backend)
+    expires_at = datetime.now() + timedelta(hours=1)
+    barrier.wait()
+
+    start = time.perf_counter()
+    for i in range(n):
+        token = token_for(worker, i)
+        storage.save_access_token(
+            token,
+            make_access_token(impl, token, "demo-user", "demo-client-id", "read", expires_at),
+        )
+    issue_sec = time.perf_counter() - start
+
+    # 全プロセスの発行が終わってから、隣のプロセスが発行したトークンを検証
+    barrier.wait()
+    other = (worker + 1) % workers
+    start = time.perf_counter()
+    for i in range(n):
+        if storage.get_access_token(token_for(other, i)) is None:
+            raise RuntimeError(f"token from worker {other} not visible in worker {worker}")
+    verify_sec = time.perf_counter() - start
+
+    results.put((issue_sec, verify_sec))
+
+
+def run(impl, backend, workers, n):
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=worker_main, args=(impl, backend, w, workers, n, barrier, results))
+        for w in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    timings = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError(f"worker failed with exit code {p.exitcode}")
+
+    # 最も遅いワーカーの所要時間で全体スループットを出す
+    total = workers * n
+    return {
+        "backend": backend,
+        "workers": workers,
+        "tokens_per_worker": n,
+        "issue_ops_per_sec": round(total / max(t[0] for t in timings)),
+        "verify_ops_per_sec": round(total / max(t[1] for t in timings)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="fastapi-custom")
+    parser.add_argument("-n", type=int, default=5000, help="1プロセスあたりのトークン数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--backends", nargs="+", default=["shm", "sqlite"])
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        for workers in args.workers:
+            # 計測ごとに空のテーブル・DBを使う
+            with tempfile.TemporaryDirectory(dir="/dev/shm" if os.path.isdir("/dev/shm") else None) as tmp:
+                os.environ["STORAGE_SHM_DIR"] = tmp
+                os.environ["STORAGE_SQLITE_PATH"] = os.path.join(tmp, "bench.db")
+                results.append(run(args.impl, backend, workers, args.n))
+
+    print(json.dumps({"impl": args.impl, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
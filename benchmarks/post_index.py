@@ -0,0 +1,150 @@
+"""
+投稿の索引（post_index.py）と created_at の範囲検索のベンチマーク
+
+1ユーザーに --posts 件（デフォルト10万件）の投稿を入れ、1回あたりの時間（マイクロ秒）を JSON で出力する
+
+- get: id を指定して1件取り出す（/api/posts/{id}）
+- range: ランダムな1日の範囲（since 以上 until 未満）を created_at 順に最大 --limit 件（/api/posts?since=&until=）
+- scan: 索引なし（id 順のリストを走査し、created_at を毎回パースして絞り込み・並べ替え）
+- index: PostIndex（id のハッシュと created_at のソート済みリストの二分探索）
+- sqlite: SQLiteStorage（(username, created_epoch, id) のインデックス）
+
+    python benchmarks/post_index.py --impl flask-custom --posts 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from _impl import use_impl
+
+START = 1767225600  # 2026-01-01T00:00:00Z
+DAY = 86400
+
+
+def make_posts(n):
+    """id 順で created_at がばらばらな投稿（平均して1日に100件）"""
+    from datetime import datetime, timezone
+
+    span = max(n // 100, 1) * DAY
+    posts = []
+    for post_id in range(1, n + 1):
+        created = START + random.randrange(span)
+        posts.append({
+            "id": post_id,
+            "title": f"post {post_id}",
+            "content": "benchmark",
+            "created_at": datetime.fromtimestamp(created, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+    return posts, span
+
+
+def scan_get(posts, post_id):
+    for post in posts:
+        if post["id"] == post_id:
+            return post
+    return None
+
+
+def scan_range(posts, since, until, limit, parse_timestamp):
+    matched = [
+        (created, post["id"], post) for post in posts
+        for created in (parse_timestamp(post["created_at"]),)
+        if since <= created < until
+    ]
+    matched.sort(key=lambda item: item[:2])
+    return [post for _, _, post in matched[:limit]]
+
+
+def timed(queries, func):
+    start = time.perf_counter()
+    for query in queries:
+        func(*query)
+    return round((time.perf_counter() - start) / len(queries) * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("--posts", type=int, default=100000, help="1ユーザーの投稿数")
+    parser.add_argument("--limit", type=int, default=100, help="範囲検索で返す最大件数")
+    parser.add_argument("-n", type=int, default=1000, help="索引・sqlite の検索回数")
+    parser.add_argument("--scan-n", type=int, default=20, help="索引なしの検索回数（1回が遅いので少なめ）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    use_impl(args.impl)
+    from post_index import PostIndex, parse_timestamp
+    import sqlite_storage
+
+    random.seed(args.seed)
+    posts, span = make_posts(args.posts)
+
+    start = time.perf_counter()
+    index = PostIndex(posts)
+    index_build = time.perf_counter() - start
+
+    path = os.path.join(tempfile.mkdtemp(), "posts.db")
+    storage = sqlite_storage.SQLiteStorage(path)
+    start = time.perf_counter()
+    with storage._lock, storage._conn:
+        storage._conn.executemany(sqlite_storage.INSERT_POST, [
+            ("bench-user", post["id"], post["title"], post["content"], post["created_at"],
+             parse_timestamp(post["created_at"]))
+            for post in posts
+        ])
+    sqlite_load = time.perf_counter() - start
+
+    def gets(n):
+        return [(random.randint(1, args.posts),) for _ in range(n)]
+
+    def ranges(n):
+        windows = []
+        for _ in range(n):
+            since = START + random.randrange(span)
+            windows.append((since, since + DAY))
+        return windows
+
+    results = {"get_us": {}, "range_us": {}}
+    queries = gets(args.scan_n)
+    results["get_us"]["scan"] = timed(queries, lambda post_id: scan_get(posts, post_id))
+    queries = gets(args.n)
+    results["get_us"]["index"] = timed(queries, index.get)
+    results["get_us"]["sqlite"] = timed(queries, lambda post_id: storage.get_post("bench-user", post_id))
+
+    queries = ranges(args.scan_n)
+    results["range_us"]["scan"] = timed(
+        queries, lambda since, until: scan_range(posts, since, until, args.limit, parse_timestamp),
+    )
+    queries = ranges(args.n)
+    results["range_us"]["index"] = timed(queries, lambda since, until: index.range(since, until, None, args.limit))
+    results["range_us"]["sqlite"] = timed(
+        queries, lambda since, until: storage.get_posts_range("bench-user", since, until, None, args.limit),
+    )
+
+    # 索引と sqlite が同じ結果を返すことを確認
+    since, until = queries[0]
+    expected = [post["id"] for post in scan_range(posts, since, until, args.limit, parse_timestamp)]
+    for name, found in (
+        ("index", index.range(since, until, None, args.limit)),
+        ("sqlite", storage.get_posts_range("bench-user", since, until, None, args.limit)),
+    ):
+        if [post["id"] for post in found] != expected:
+            raise RuntimeError(f"{name}: range result differs from scan")
+
+    storage.close()
+    print(json.dumps({
+        "impl": args.impl,
+        "posts": args.posts,
+        "limit": args.limit,
+        "index_build_sec": round(index_build, 3),
+        "sqlite_load_sec": round(sqlite_load, 3),
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+fastapi-custom のクライアントのトークン事前リフレッシュ（refresh.py）のベンチマーク
+
+同じ瞬間にログインした --sessions 件のセッションの更新を、時間を縮めて（有効期間 --expires-in 秒）実行する
+/token の代わりに --latency 秒待つだけの関数を呼び、/token への集中の度合いを JSON で出力する
+
+- stampede: jitter なし・同時実行数と毎秒の回数の制限なし（全セッションが同じ時刻に /token を呼ぶ）
+- scheduled: jitter・同時実行数・毎秒の回数の制限あり
+
+出力:
+- peak_in_flight: 同時に実行中だった更新の最大数
+- peak_per_100ms: 100ミリ秒の間に始まった更新の最大数
+- late: 期限切れまでに終わらなかった更新の数
+- spread_sec: 最初と最後の更新の開始時刻の差
+
+    python benchmarks/refresh_scheduler.py --sessions 5000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+from _impl import use_impl
+
+
+async def run(args, **options):
+    from refresh import RefreshScheduler
+
+    in_flight = 0
+    peak = 0
+    started = []
+    late = 0
+
+    async def refresh(session_id):
+        nonlocal in_flight, peak, late
+        in_flight += 1
+        peak = max(peak, in_flight)
+        started.append(time.time())
+        await asyncio.sleep(args.latency)
+        in_flight -= 1
+        if time.time() > login + args.expires_in:
+            late += 1
+        # 1回の更新で終わらせる（次の予定は作らない）
+        return None
+
+    scheduler = RefreshScheduler(refresh, margin=args.margin, **options)
+    login = time.time()
+    for i in range(args.sessions):
+        scheduler.schedule(f"session-{i}", args.expires_in, now=login)
+
+    runner = asyncio.create_task(scheduler.run())
+    while scheduler.dropped < args.sessions:
+        await asyncio.sleep(0.05)
+    runner.cancel()
+
+    windows = Counter(int((t - login) * 10) for t in started)
+    return {
+        "peak_in_flight": peak,
+        "peak_per_100ms": max(windows.values()),
+        "late": late,
+        "spread_sec": round(max(started) - min(started), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--expires-in", type=float, default=20.0, help="トークンの有効期間（秒）")
+    parser.add_argument("--margin", type=float, default=2.0, help="期限の何秒前に更新するか")
+    parser.add_argument("--jitter", type=float, default=0.25, help="更新時刻をばらつかせる幅（有効期間に対する割合）")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=2000.0, help="毎秒の更新回数")
+    parser.add_argument("--latency", type=float, default=0.005, help="1回の更新にかかる秒数")
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    results = {
+        "stampede": asyncio.run(run(args, jitter=0.0, concurrency=args.sessions, rate=False)),
+        "scheduled": asyncio.run(run(
+            args, jitter=args.jitter, concurrency=args.concurrency, rate=(args.rate, args.concurrency),
+        )),
+    }
+    print(json.dumps({
+        "sessions": args.sessions,
+        "expires_in": args.expires_in,
+        "latency": args.latency,
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
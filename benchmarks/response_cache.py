@@ -0,0 +1,167 @@
+"""
+/api/profile のシリアライズ済みレスポンスキャッシュ（response_cache.py）のベンチマーク
+
+1回あたりの時間（マイクロ秒、--repeat 回のうち最も速いもの）を JSON で出力する
+
+- encode: プロフィールの dict のエンコード（標準の json / orjson）とキャッシュのヒット
+- endpoint: 同じトークンで /api/profile を繰り返し呼び出す
+  - before: 変更前のハンドラ（dict を jsonify・FastAPI のエンコーダに渡す）。/bench/profile-before として追加する
+  - no-cache-json / no-cache-orjson: キャッシュなし（毎回エンコードしてバイト列を返す）
+  - cache: キャッシュあり（同じバージョンならエンコードしない）
+
+サーバーはテストクライアント（fastapi-custom は httpx の ASGITransport）で同じプロセス内から呼び出す
+
+    python benchmarks/response_cache.py --impl fastapi-custom -n 5000
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import time
+import timeit
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+PROFILE = {
+    "username": "demo-user",
+    "name": "Demo User",
+    "email": "demo@example.com",
+    "bio": "OAuth 2.0 デモユーザーです",
+    "location": "Tokyo, Japan",
+}
+
+
+def add_before_route(impl, server):
+    """変更前の /api/profile を /bench/profile-before として追加"""
+    if impl == "fastapi-custom":
+        from fastapi import Depends
+
+        @server.app.get("/bench/profile-before")
+        async def profile_before(token_data: dict = Depends(server.token_dependency)):
+            username = token_data["username"]
+            user = await server.storage.get_user(username)
+            return {
+                "username": username,
+                "name": user["name"],
+                "email": user["email"],
+                "bio": user.get("bio", ""),
+                "location": user.get("location", ""),
+            }
+        return
+
+    if impl == "flask-authlib":
+        def profile_before():
+            username = server.current_token.username
+            return profile_before_body(username)
+        protect = server.require_oauth()
+    else:
+        def profile_before(token_data):
+            return profile_before_body(token_data["username"])
+        protect = server.require_oauth
+
+    def profile_before_body(username):
+        user = server.storage.get_user(username)
+        return server.jsonify({
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+            "bio": user["bio"],
+            "location": user["location"],
+        })
+
+    server.app.add_url_rule("/bench/profile-before", "profile_before", protect(profile_before))
+
+
+def bench_encode(n):
+    import response_cache
+
+    encoders = {"json": response_cache.json_dumps}
+    if response_cache.orjson is not None:
+        encoders["orjson"] = response_cache.orjson.dumps
+    results = {
+        name: round(timeit.timeit(lambda: dumps(PROFILE), number=n) / n * 1e6, 3)
+        for name, dumps in encoders.items()
+    }
+    cache = response_cache.ResponseCache()
+    cache.put("profile", "demo-user", 1, PROFILE)
+    results["cache_hit"] = round(timeit.timeit(lambda: cache.get("profile", "demo-user", 1), number=n) / n * 1e6, 3)
+    return results
+
+
+def bench_flask(app, path, headers, n):
+    client = app.test_client()
+    response = client.get(path, headers=headers, base_url="http://localhost:5000")
+    if response.status_code != 200:
+        raise RuntimeError(f"{path}: {response.status_code} {response.data!r}")
+    start = time.perf_counter()
+    for _ in range(n):
+        client.get(path, headers=headers, base_url="http://localhost:5000")
+    return round((time.perf_counter() - start) / n * 1e6, 1)
+
+
+async def bench_fastapi(app, path, headers, n):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost:5000") as client:
+        response = await client.get(path, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: {response.status_code} {response.text}")
+        start = time.perf_counter()
+        for _ in range(n):
+            await client.get(path, headers=headers)
+        return round((time.perf_counter() - start) / n * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("-n", type=int, default=5000, help="リクエスト数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返して最も速い結果を使う")
+    args = parser.parse_args()
+
+    use_impl(args.impl)
+    import response_cache
+    import server
+
+    add_before_route(args.impl, server)
+    backend = server.storage.backend if args.impl == "fastapi-custom" else server.storage
+    token = secrets.token_urlsafe(32)
+    backend.save_access_token(token, make_access_token(
+        args.impl, token, "demo-user", "demo-client-id", "read", datetime.now() + timedelta(hours=1),
+    ))
+    headers = {"Authorization": f"Bearer {token}"}
+
+    variants = {
+        "before": ("/bench/profile-before", None),
+        "no-cache-json": ("/api/profile", response_cache.ResponseCache(maxsize=0, dumps=response_cache.json_dumps)),
+    }
+    if response_cache.orjson is not None:
+        variants["no-cache-orjson"] = (
+            "/api/profile", response_cache.ResponseCache(maxsize=0, dumps=response_cache.orjson.dumps),
+        )
+    variants["cache"] = ("/api/profile", response_cache.ResponseCache())
+
+    endpoint = {}
+    for name, (path, cache) in variants.items():
+        if cache is not None:
+            # server.py はリクエストごとに response_cache を参照するので、差し替えるだけで切り替わる
+            server.response_cache = cache
+        if args.impl == "fastapi-custom":
+            runs = [asyncio.run(bench_fastapi(server.app, path, headers, args.n)) for _ in range(args.repeat)]
+        else:
+            runs = [bench_flask(server.app, path, headers, args.n) for _ in range(args.repeat)]
+        endpoint[name] = min(runs)
+
+    print(json.dumps({
+        "impl": args.impl,
+        "requests": args.n,
+        "encode_us": bench_encode(args.n * 20),
+        "endpoint_us_per_request": endpoint,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+fastapi-custom のクライアントのセッションストア（session_store.py）のベンチマーク
+
+--sessions 件のセッションを作成 → 参照 → 削除する1件あたりの時間（マイクロ秒）と、
+期限切れのセッションの削除（sweep）にかかる時間を JSON で出力する
+
+- dict: 変更前の dict（期限切れ・上限なし）
+- store: SessionStore（TTL 付き LRU）
+- capped: 上限を --sessions の半分にした SessionStore（LRU の追い出しを含む）
+
+sweep は --sessions 件を期限切れにしてから run_sweeper と同じ batch_size ずつ削除し、
+1回あたりの最大時間（イベントループを止める時間）と合計を出力する
+
+    python benchmarks/session_store.py --sessions 100000
+"""
+
+import argparse
+import json
+import secrets
+import time
+
+from _impl import use_impl
+
+
+def per_op_us(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return round((time.perf_counter() - start) / len(keys) * 1e6, 3)
+
+
+def bench_dict(keys):
+    sessions = {}
+    return {
+        "set_us": per_op_us(lambda k: sessions.__setitem__(k, {"status": "authorized"}), keys),
+        "get_us": per_op_us(sessions.get, keys),
+        "pop_us": per_op_us(lambda k: sessions.pop(k, None), keys),
+    }
+
+
+def bench_store(keys, maxsize):
+    from session_store import SessionStore
+
+    store = SessionStore(maxsize=maxsize)
+    result = {
+        "set_us": per_op_us(lambda k: store.set(k, {"status": "authorized"}, ttl=3600), keys),
+        "get_us": per_op_us(store.get, keys),
+    }
+    result["size"] = len(store)
+    result["evictions"] = store.evictions
+    result["pop_us"] = per_op_us(store.pop, keys)
+    return result
+
+
+def bench_sweep(keys, batch_size):
+    from session_store import SessionStore
+
+    store = SessionStore(maxsize=len(keys))
+    now = time.time()
+    # ログイン途中（TTL 600秒）とログイン済み（TTL 3600秒）を混ぜる
+    for i, key in enumerate(keys):
+        store.set(key, {}, ttl=600 if i % 4 else 3600, now=now)
+
+    batches = []
+    removed = 0
+    while True:
+        start = time.perf_counter()
+        count = store.sweep(batch_size, now=now + 3600)
+        batches.append(time.perf_counter() - start)
+        removed += count
+        if count < batch_size:
+            break
+    return {
+        "removed": removed,
+        "batch_size": batch_size,
+        "total_ms": round(sum(batches) * 1e3, 2),
+        "max_batch_ms": round(max(batches) * 1e3, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    use_impl("fastapi-custom")
+    keys = [secrets.token_urlsafe(16) for _ in range(args.sessions)]
+    print(json.dumps({
+        "sessions": args.sessions,
+        "dict": bench_dict(keys),
+        "store": bench_store(keys, args.sessions),
+        "capped": bench_store(keys, args.sessions // 2),
+        "sweep": bench_sweep(keys, args.batch_size),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
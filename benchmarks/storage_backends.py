@@ -0,0 +1,74 @@
+"""
+ストレージバックエンドのベンチマーク
+
+トークン発行（save_access_token）と検証（get_access_token）のスループットを
+memory / sqlite バックエンドで比較し、JSON で出力する
+
+    python benchmarks/storage_backends.py --impl flask-custom -n 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import secrets
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+
+def bench_backend(impl, backend, n):
+    from storage import create_storage
+
+    storage = create_storage(backend)
+    tokens = [secrets.token_urlsafe(32) for _ in range(n)]
+    expires_at = datetime.now() + timedelta(hours=1)
+
+    # 発行
+    start = time.perf_counter()
+    for token in tokens:
+        storage.save_access_token(
+            token,
+            make_access_token(impl, token, "demo-user", "demo-client-id", "read", expires_at),
+        )
+    issue_sec = time.perf_counter() - start
+
+    # 検証（発行順とは無関係な順で引く）
+    random.shuffle(tokens)
+    start = time.perf_counter()
+    for token in tokens:
+        if storage.get_access_token(token) is None:
+            raise RuntimeError(f"token not found: {token}")
+    verify_sec = time.perf_counter() - start
+
+    if hasattr(storage, "close"):
+        storage.close()
+
+    return {
+        "backend": backend,
+        "tokens": n,
+        "issue_ops_per_sec": round(n / issue_sec),
+        "verify_ops_per_sec": round(n / verify_sec),
+        "issue_us_per_op": round(issue_sec / n * 1e6, 2),
+        "verify_us_per_op": round(verify_sec / n * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("-n", type=int, default=20000, help="発行・検証するトークン数")
+    args = parser.parse_args()
+
+    use_impl(args.impl)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["STORAGE_SQLITE_PATH"] = os.path.join(tmp, "bench.db")
+        results = [bench_backend(args.impl, backend, args.n) for backend in ("memory", "sqlite")]
+
+    print(json.dumps({"impl": args.impl, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+トークン保持のメモリ使用量ベンチマーク
+
+ライブなアクセストークンを n 件保持したときの1件あたりのバイト数を tracemalloc で計測し、
+JSON で出力する
+
+- before: 変更前の形式（dict / __dict__ を持つオブジェクト、有効期限は datetime、文字列は intern しない）
+- after: __slots__ のレコード（整数のエポック秒、client_id / username を intern）
+- after_storage: MemoryStorage.save_access_token で保存（インデックス・有効期限インデックスを含む）
+
+トークン文字列自体（dict のキー）は計測前に作成するため、どの結果にも含まない
+
+    python benchmarks/token_memory.py --impl flask-custom -n 1000000
+"""
+
+import argparse
+import gc
+import json
+import secrets
+import tracemalloc
+from datetime import datetime, timedelta
+
+from _impl import use_impl, make_access_token
+
+
+class LegacyToken:
+    """変更前の flask-authlib の Token と同じ属性を __dict__ で持つオブジェクト"""
+
+    def __init__(self, access_token, token_type, scope, expires_at, client_id, username, family_id=None):
+        self.access_token = access_token
+        self.token_type = token_type
+        self.scope = scope
+        self.expires_at = expires_at
+        self.client_id = client_id
+        self.username = username
+        self.family_id = family_id
+        self.revoked = False
+
+
+def fresh(s):
+    """リクエストから取り出した文字列と同じく、毎回別のオブジェクトを作る"""
+    return s.encode().decode()
+
+
+def legacy_record(impl, token, family_id, expires_at):
+    """変更前の形式のアクセストークン（文字列は毎回別のオブジェクト）"""
+    if impl == "flask-authlib":
+        return LegacyToken(
+            token, fresh("Bearer"), fresh("read"), expires_at,
+            fresh("demo-client-id"), fresh("demo-user"), family_id,
+        )
+    data = make_access_token(impl, token, fresh("demo-user"), fresh("demo-client-id"), fresh("read"), expires_at)
+    data["family_id"] = family_id
+    return data
+
+
+def to_record(impl, data):
+    """保存時と同じ変換（flask-authlib は Token 自体が __slots__ のレコード）"""
+    if impl == "flask-authlib":
+        return data
+    from records import AccessTokenRecord
+    return AccessTokenRecord.from_dict(data)
+
+
+def measure(build):
+    """build() が確保した分のメモリ（バイト）"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    gc.collect()
+    return after - before
+
+
+def bench(impl, n):
+    from storage import MemoryStorage
+
+    tokens = [secrets.token_urlsafe(32) for _ in range(n)]
+    families = [secrets.token_urlsafe(16) for _ in range(n)]
+    base = datetime.now() + timedelta(hours=1)
+
+    def build_before():
+        # 1件ごとに datetime を作る（発行時刻がずれる実際の発行と同じ）
+        return {
+            token: legacy_record(impl, token, family_id, base + timedelta(microseconds=i))
+            for i, (token, family_id) in enumerate(zip(tokens, families))
+        }
+
+    def build_after(with_storage):
+        storage = MemoryStorage()
+        for i, (token, family_id) in enumerate(zip(tokens, families)):
+            expires_at = base + timedelta(microseconds=i)
+            data = make_access_token(impl, token, fresh("demo-user"), fresh("demo-client-id"), fresh("read"), expires_at)
+            if impl == "flask-authlib":
+                data.family_id = family_id
+            else:
+                data["family_id"] = family_id
+            if with_storage:
+                storage.save_access_token(token, data)
+            else:
+                storage.access_tokens[token] = to_record(impl, data)
+        return storage
+
+    results = {
+        "before": measure(build_before),
+        "after": measure(lambda: build_after(with_storage=False)),
+        "after_storage": measure(lambda: build_after(with_storage=True)),
+    }
+    return {
+        name: {"total_mb": round(size / 1024 / 1024, 1), "bytes_per_token": round(size / n, 1)}
+        for name, size in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="flask-custom")
+    parser.add_argument("-n", type=int, default=1000000, help="保持するトークン数")
+    args = parser.parse_args()
+
+    use_impl(args.impl)
+    print(json.dumps({"impl": args.impl, "tokens": args.n, "results": bench(args.impl, args.n)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
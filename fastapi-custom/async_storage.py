@@ -0,0 +1,134 @@
+"""
+OAuth 2.0 ストレージ（async インターフェース）
+
+server.py は StorageBackend（storage.py）をこのラッパー経由で await して使う
+
+- memory / shm はメモリ上の操作だけなので、イベントループ上でそのまま実行する（スレッドを経由しない）
+- sqlite などブロックする I/O を持つバックエンド（blocking_io = True）は
+  asyncio.to_thread で実行し、イベントループを止めない
+- 認可コードの交換・リフレッシュトークンのローテーションは、バックエンドの1回の操作
+  （pop_auth_code_if_valid・mark_refresh_token_used）で検証と書き換えを行う
+  （--workers で複数プロセスが同じストレージを使っても、成功するのは1つのリクエストだけ）
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Callable, Optional
+
+from storage import StorageBackend, storage as default_backend
+
+
+class AsyncStorage:
+    """StorageBackend の各メソッドを await できるようにするラッパー"""
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.blocking_io = getattr(backend, "blocking_io", False)
+
+    async def _call(self, method, *args):
+        func = getattr(self.backend, method)
+        if self.blocking_io:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    # クライアント・ユーザー・投稿
+    async def get_client(self, client_id: str) -> Optional[dict]:
+        return await self._call("get_client", client_id)
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        return await self._call("get_user", username)
+
+    async def get_posts(self, username: str) -> list:
+        return await self._call("get_posts", username)
+
+    async def get_posts_page(self, username: str, after: Optional[int], limit: Optional[int]) -> list:
+        return await self._call("get_posts_page", username, after, limit)
+
+    async def get_posts_range(
+        self, username: str, since: Optional[int], until: Optional[int], after: Optional[int], limit: Optional[int],
+    ) -> list:
+        return await self._call("get_posts_range", username, since, until, after, limit)
+
+    async def get_post(self, username: str, post_id: int) -> Optional[dict]:
+        return await self._call("get_post", username, post_id)
+
+    async def count_posts(self, username: str) -> int:
+        return await self._call("count_posts", username)
+
+    async def get_user_version(self, username: str) -> int:
+        return await self._call("get_user_version", username)
+
+    async def get_posts_version(self, username: str) -> int:
+        return await self._call("get_posts_version", username)
+
+    async def update_user(self, username: str, fields: dict) -> None:
+        await self._call("update_user", username, fields)
+
+    async def add_post(self, username: str, post: dict) -> None:
+        await self._call("add_post", username, post)
+
+    # 認可コード
+    async def save_auth_code(self, code: str, data: dict) -> None:
+        await self._call("save_auth_code", code, data)
+
+    async def get_auth_code(self, code: str) -> Optional[dict]:
+        return await self._call("get_auth_code", code)
+
+    async def delete_auth_code(self, code: str) -> None:
+        await self._call("delete_auth_code", code)
+
+    async def pop_auth_code_if_valid(self, code: str, is_valid: Callable[[dict], bool]) -> Optional[dict]:
+        return await self._call("pop_auth_code_if_valid", code, is_valid)
+
+    # アクセストークン
+    async def save_access_token(self, token: str, data: dict) -> None:
+        await self._call("save_access_token", token, data)
+
+    async def get_access_token(self, token: str) -> Optional[dict]:
+        return await self._call("get_access_token", token)
+
+    async def delete_access_token(self, token: str) -> None:
+        await self._call("delete_access_token", token)
+
+    # リフレッシュトークン
+    async def save_refresh_token(self, token: str, data: dict) -> None:
+        await self._call("save_refresh_token", token, data)
+
+    async def get_refresh_token(self, token: str) -> Optional[dict]:
+        return await self._call("get_refresh_token", token)
+
+    async def mark_refresh_token_used(self, token: str) -> bool:
+        return await self._call("mark_refresh_token_used", token)
+
+    async def delete_refresh_token(self, token: str) -> None:
+        await self._call("delete_refresh_token", token)
+
+    # トークンファミリー・一括失効
+    async def revoke_family(self, family_id: str, expires_at: datetime) -> None:
+        await self._call("revoke_family", family_id, expires_at)
+
+    async def is_family_revoked(self, family_id: str) -> bool:
+        return await self._call("is_family_revoked", family_id)
+
+    async def is_bulk_revoked(self, username: str, client_id: str, issued_at: float) -> bool:
+        return await self._call("is_bulk_revoked", username, client_id, issued_at)
+
+    async def revoke_user_tokens(self, username: str) -> int:
+        return await self._call("revoke_user_tokens", username)
+
+    async def revoke_client_tokens(self, client_id: str) -> int:
+        return await self._call("revoke_client_tokens", client_id)
+
+    # 期限切れエントリの削除と運用メトリクス
+    async def has_expired(self, now: float) -> bool:
+        return await self._call("has_expired", now)
+
+    async def sweep_expired(self, max_batch: int = 1000) -> int:
+        return await self._call("sweep_expired", max_batch)
+
+    async def stats(self) -> dict:
+        return await self._call("stats")
+
+
+# グローバルストレージインスタンス（storage.storage を包む）
+storage = AsyncStorage(default_backend)
@@ -3,17 +3,78 @@ OAuth 2.0 クライアントアプリケーション
 
 認可コードフローを使用してアクセストークンを取得し、
 保護されたAPIに継続的にアクセスする
+
+認可サーバー・APIへのリクエストは、起動時に作る1つの httpx.AsyncClient（接続プール）で送る
+（リクエストごとに作ると、毎回 TCP 接続からやり直すことになる）
+
+環境変数:
+- HTTP_MAX_CONNECTIONS: 同時接続数の上限（デフォルト 100）
+- HTTP_MAX_KEEPALIVE: 使い回すために開いたままにする接続数（デフォルト 20）
+- HTTP_KEEPALIVE_EXPIRY: 使われていない接続を閉じるまでの秒数（デフォルト 30）
+- HTTP_TIMEOUT: タイムアウト秒数（デフォルト 10）
+- HTTP2: "1" なら HTTP/2 を使う（h2 パッケージが必要。`pip install httpx[http2]`）
+- BATCH_CALL_TIMEOUT: /api/call/batch でまとめて呼ぶ API 1つあたりのタイムアウト秒数（デフォルト 5）
+
+アクセストークンは期限切れ前にバックグラウンドでリフレッシュする（refresh.py、REFRESH_* の環境変数）
+API のレスポンスはセッションごとにキャッシュし、ETag で再検証する（api_cache.py、API_CACHE_* の環境変数）
 """
 
 from fastapi import FastAPI, Request, Cookie, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+import asyncio
 import httpx
+import json
+import os
 import secrets
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
-from itsdangerous import URLSafeTimedSerializer
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from datetime import datetime
 
-app = FastAPI(title="OAuth 2.0 Client")
+from api_cache import ApiResponseCache
+from refresh import RefreshScheduler
+from session_store import SessionStore, run_sweeper
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """環境変数の設定で接続プール付きの httpx.AsyncClient を作成"""
+    return httpx.AsyncClient(
+        timeout=float(os.environ.get("HTTP_TIMEOUT", "10")),
+        limits=httpx.Limits(
+            max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30")),
+        ),
+        # h2 がなければ HTTP/1.1（keep-alive で接続を使い回す）
+        http2=os.environ.get("HTTP2") == "1" and h2 is not None,
+    )
+
+
+# 認可サーバー・APIへの共有クライアント（lifespan で作成・終了）
+http_client: Optional[httpx.AsyncClient] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時に共有クライアントを作成し、終了時に接続を閉じる"""
+    global http_client
+    http_client = create_http_client()
+    refresher = asyncio.create_task(refresh_scheduler.run())
+    sweeper = asyncio.create_task(run_sweeper(sessions))
+    yield
+    sweeper.cancel()
+    refresher.cancel()
+    await http_client.aclose()
+    http_client = None
+
+
+app = FastAPI(title="OAuth 2.0 Client", lifespan=lifespan)
 
 # セッション署名用の秘密鍵（本番環境では環境変数から読み込む）
 SECRET_KEY = "fastapi-custom-client-secret-key-change-in-production"
@@ -25,12 +86,23 @@ OAUTH_CONFIG = {
     "client_secret": "demo-client-secret",
     "authorization_endpoint": "http://localhost:5000/authorize",
     "token_endpoint": "http://localhost:5000/token",
+    "revocation_endpoint": "http://localhost:5000/revoke",
     "redirect_uri": "http://localhost:5001/callback",
     "api_base": "http://localhost:5000/api",
 }
 
-# セッションストレージ（本番環境ではRedisなどを使用）
-sessions = {}
+# セッションの有効期間（Cookie の max_age と同じ）と、ログイン開始から認可サーバーから戻るまでの猶予
+# 最後のアクセスから SESSION_MAX_AGE 秒で切れる（使っている間は延長する。アクセストークンは事前リフレッシュで更新し続ける）
+SESSION_MAX_AGE = int(os.environ.get("SESSION_MAX_AGE", "3600"))
+LOGIN_STATE_TTL = 600
+# Cookie の発行からこの秒数を過ぎたリクエストで、Cookie とセッションの有効期限を延ばす（毎回は署名し直さない）
+SESSION_RENEW_AFTER = SESSION_MAX_AGE / 2
+
+# セッションストレージ（TTL 付き LRU。本番環境ではRedisなどを使用）
+sessions = SessionStore()
+
+# /api/call/{endpoint} のレスポンスキャッシュ（キーはセッションID）
+api_cache = ApiResponseCache()
 
 
 def get_session_id(session_cookie: Optional[str]) -> Optional[str]:
@@ -38,16 +110,89 @@ def get_session_id(session_cookie: Optional[str]) -> Optional[str]:
     if not session_cookie:
         return None
     try:
-        return serializer.loads(session_cookie, max_age=3600)
+        return serializer.loads(session_cookie, max_age=SESSION_MAX_AGE)
     except:
         return None
 
 
 def get_access_token(session_id: Optional[str]) -> Optional[str]:
     """セッションIDからアクセストークンを取得"""
-    if not session_id or session_id not in sessions:
+    session_data = session_id and sessions.get(session_id)
+    if not session_data:
         return None
-    return sessions[session_id].get("access_token")
+    return session_data.get("access_token")
+
+
+async def refresh_session(session_id: str) -> Optional[int]:
+    """セッションのアクセストークンをリフレッシュトークンで更新し、新しい expires_in を返す
+
+    refresh_scheduler から呼ばれる。セッションがない・リフレッシュトークンが無効なら None
+    （次の API 呼び出しでログインし直す）。認可サーバーの 5xx・429 は例外にして再試行させる
+    """
+    session_data = sessions.get(session_id, touch=False)
+    refresh_token = session_data and session_data.get("token_data", {}).get("refresh_token")
+    if not refresh_token:
+        return None
+
+    response = await http_client.post(
+        OAUTH_CONFIG["token_endpoint"],
+        data={
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": OAUTH_CONFIG["client_id"],
+            "client_secret": OAUTH_CONFIG["client_secret"],
+        },
+    )
+    if response.status_code >= 500 or response.status_code == 429:
+        response.raise_for_status()
+    # 更新中にログアウトされたセッションは復活させない
+    session_data = sessions.get(session_id, touch=False)
+    if response.status_code != 200 or session_data is None:
+        return None
+
+    token_data = response.json()
+    token_data.setdefault("refresh_token", refresh_token)
+    session_data["access_token"] = token_data["access_token"]
+    session_data["token_data"] = token_data
+    return token_data.get("expires_in", 3600)
+
+
+# 期限切れ前のトークン更新（lifespan で起動）
+refresh_scheduler = RefreshScheduler(refresh_session)
+
+
+def set_session_cookie(response: Response, session_id: str):
+    """署名したセッションIDを Cookie に設定（max_age は SESSION_MAX_AGE）"""
+    response.set_cookie(
+        key="session",
+        value=serializer.dumps(session_id),
+        httponly=True,
+        max_age=SESSION_MAX_AGE,
+    )
+
+
+@app.middleware("http")
+async def renew_session(request: Request, call_next):
+    """ログイン中のセッションを使っている間は有効期限を延ばす（スライディング有効期限）
+
+    Cookie の発行から SESSION_RENEW_AFTER 秒を過ぎていたら、セッションストアの期限と Cookie を
+    SESSION_MAX_AGE 秒後まで延ばす（トークンの有効期間を過ぎてもログインし直さずに使い続けられる）
+    """
+    response = await call_next(request)
+    session_cookie = request.cookies.get("session")
+    # Cookie を設定・削除したレスポンス（コールバック・ログアウト）はそのまま返す
+    if not session_cookie or "set-cookie" in response.headers:
+        return response
+    try:
+        session_id, issued_at = serializer.loads(session_cookie, max_age=SESSION_MAX_AGE, return_timestamp=True)
+    except BadSignature:
+        return response
+    if time.time() - issued_at.timestamp() < SESSION_RENEW_AFTER:
+        return response
+    session_data = sessions.get(session_id, touch=False)
+    if session_data and session_data.get("status") == "authorized" and sessions.extend(session_id, SESSION_MAX_AGE):
+        set_session_cookie(response, session_id)
+    return response
 
 
 @app.get("/")
@@ -97,12 +242,9 @@ async def login():
     認可フローの開始
     ユーザーを認可サーバーにリダイレクト
     """
-    # 古いセッションデータをクリア
-    sessions.clear()
-
-    # CSRF対策用のstateパラメータを生成
+    # CSRF対策用のstateパラメータを生成（他のユーザーのセッションには触れない）
     state = secrets.token_urlsafe(16)
-    sessions[state] = {"status": "pending"}
+    sessions.set(state, {"status": "pending"}, ttl=LOGIN_STATE_TTL)
 
     # 認可リクエストのURLを構築
     auth_url = (
@@ -131,17 +273,16 @@ async def callback(code: str, state: Optional[str] = None):
         )
 
     # トークンエンドポイントにリクエスト
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            OAUTH_CONFIG["token_endpoint"],
-            data={
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": OAUTH_CONFIG["redirect_uri"],
-                "client_id": OAUTH_CONFIG["client_id"],
-                "client_secret": OAUTH_CONFIG["client_secret"],
-            },
-        )
+    response = await http_client.post(
+        OAUTH_CONFIG["token_endpoint"],
+        data={
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": OAUTH_CONFIG["redirect_uri"],
+            "client_id": OAUTH_CONFIG["client_id"],
+            "client_secret": OAUTH_CONFIG["client_secret"],
+        },
+    )
 
     if response.status_code != 200:
         return HTMLResponse(
@@ -152,20 +293,18 @@ async def callback(code: str, state: Optional[str] = None):
     token_data = response.json()
     access_token = token_data["access_token"]
 
-    # セッションにアクセストークンを保存
-    sessions[state]["access_token"] = access_token
-    sessions[state]["status"] = "authorized"
-    sessions[state]["token_data"] = token_data
+    # セッションにアクセストークンを保存（有効期限は Cookie と同じ）
+    sessions.set(state, {
+        "status": "authorized",
+        "access_token": access_token,
+        "token_data": token_data,
+    }, ttl=SESSION_MAX_AGE)
+    if token_data.get("refresh_token"):
+        refresh_scheduler.schedule(state, token_data.get("expires_in", 3600))
 
     # セッションCookieを設定してダッシュボードにリダイレクト
     response = RedirectResponse(url="/dashboard", status_code=302)
-    session_cookie = serializer.dumps(state)
-    response.set_cookie(
-        key="session",
-        value=session_cookie,
-        httponly=True,
-        max_age=3600,
-    )
+    set_session_cookie(response, state)
     return response
 
 
@@ -183,7 +322,7 @@ async def dashboard(session: Optional[str] = Cookie(None)):
         return RedirectResponse(url="/", status_code=302)
 
     # セッション情報を取得
-    session_data = sessions.get(session_id, {})
+    session_data = sessions.get(session_id) or {}
     token_data = session_data.get("token_data", {})
 
     html_content = f"""
@@ -249,6 +388,7 @@ async def dashboard(session: Optional[str] = Cookie(None)):
                     <button class="button" onclick="callAPI('me')">GET /api/me (ユーザー情報)</button>
                     <button class="button" onclick="callAPI('posts')">GET /api/posts (投稿一覧)</button>
                     <button class="button" onclick="callAPI('profile')">GET /api/profile (プロフィール)</button>
+                    <button class="button" onclick="callAPI('batch?endpoints=me,profile,posts')">まとめて取得 (me・profile・posts を同時に)</button>
                 </div>
 
                 <div class="section">
@@ -264,6 +404,86 @@ async def dashboard(session: Optional[str] = Cookie(None)):
     return HTMLResponse(content=html_content)
 
 
+async def fetch_api(session_id: str, access_token: str, endpoint: str):
+    """API を呼び出して (ステータスコード, 本文のバイト列) を返す
+
+    保存済みのレスポンスが TTL 内ならそれを返し、TTL を過ぎていれば変更されていないか ETag で確認する
+    """
+    cached = api_cache.get(session_id, endpoint)
+    if cached and cached[2]:
+        return 200, cached[0]
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if cached and cached[1]:
+        headers["If-None-Match"] = cached[1]
+    response = await http_client.get(f"{OAUTH_CONFIG['api_base']}/{endpoint}", headers=headers)
+
+    if response.status_code == 304 and cached:
+        api_cache.revalidated(session_id, endpoint, response.headers.get("Cache-Control", ""))
+        return 200, cached[0]
+
+    if response.status_code == 200:
+        api_cache.set(
+            session_id, endpoint, response.content,
+            response.headers.get("ETag"), response.headers.get("Cache-Control", ""),
+        )
+    return response.status_code, response.content
+
+
+# /api/call/batch で呼べるエンドポイント（これ以外は 400。"../admin/revoke" などで他のパスを呼ばせない）と、
+# 1回にまとめて呼べるエンドポイントの数、1つあたりのタイムアウト秒数
+BATCH_ENDPOINTS = frozenset(("me", "profile", "posts"))
+BATCH_MAX_ENDPOINTS = 10
+BATCH_CALL_TIMEOUT = float(os.environ.get("BATCH_CALL_TIMEOUT", "5"))
+
+
+@app.get("/api/call/batch")
+async def call_api_batch(endpoints: str = "", session: Optional[str] = Cookie(None)):
+    """
+    複数のAPIを同時に呼び出し、1つの JSON にまとめて返す（?endpoints=me,profile,posts）
+
+    全体の時間は最も遅い1つとほぼ同じになる。失敗・タイムアウトしたものは errors に入れ、成功したものは返す
+    """
+    session_id = get_session_id(session)
+    access_token = get_access_token(session_id)
+
+    if not access_token:
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+
+    # 重複を除き、指定された順に呼ぶ
+    names = list(dict.fromkeys(name.strip() for name in endpoints.split(",") if name.strip()))
+    if not names or len(names) > BATCH_MAX_ENDPOINTS:
+        return JSONResponse(
+            {"error": f"endpoints must list 1 to {BATCH_MAX_ENDPOINTS} endpoints"}, status_code=400,
+        )
+    unknown = [name for name in names if name not in BATCH_ENDPOINTS]
+    if unknown:
+        return JSONResponse(
+            {"error": f"Unknown endpoints: {', '.join(unknown)}", "allowed": sorted(BATCH_ENDPOINTS)}, status_code=400,
+        )
+
+    async def fetch(endpoint):
+        try:
+            return await asyncio.wait_for(fetch_api(session_id, access_token, endpoint), BATCH_CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            return 504, f"Timed out after {BATCH_CALL_TIMEOUT} seconds".encode()
+        except httpx.HTTPError as e:
+            return 502, str(e).encode()
+
+    responses = await asyncio.gather(*(fetch(name) for name in names))
+
+    # 成功した本文はリソースサーバーが返したバイト列のまま埋め込む（パース・エンコードし直さない）
+    results = []
+    errors = {}
+    for name, (status_code, body) in zip(names, responses):
+        if status_code == 200:
+            results.append(json.dumps(name).encode() + b":" + body)
+        else:
+            errors[name] = {"error": body.decode(errors="replace"), "status_code": status_code}
+    content = b'{"results":{' + b",".join(results) + b'},"errors":' + json.dumps(errors).encode() + b"}"
+    return Response(content=content, media_type="application/json")
+
+
 @app.get("/api/call/{endpoint}")
 async def call_api(endpoint: str, session: Optional[str] = Cookie(None)):
     """
@@ -275,33 +495,59 @@ async def call_api(endpoint: str, session: Optional[str] = Cookie(None)):
     if not access_token:
         return {"error": "Not authenticated"}, 401
 
-    # APIを呼び出し
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{OAUTH_CONFIG['api_base']}/{endpoint}",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
+    # APIを呼び出し（保存済みのレスポンスがあれば、変更されていないか ETag で確認する）
+    status_code, body = await fetch_api(session_id, access_token, endpoint)
 
-    if response.status_code != 200:
-        return {"error": response.text, "status_code": response.status_code}
+    if status_code != 200:
+        return {"error": body.decode(errors="replace"), "status_code": status_code}
 
-    return response.json()
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/logout")
 async def logout(session: Optional[str] = Cookie(None)):
     """
     ログアウト
+    認可サーバー側のトークンも失効させる
     """
     session_id = get_session_id(session)
-    if session_id and session_id in sessions:
-        del sessions[session_id]
+    session_data = session_id and sessions.pop(session_id)
+    if session_data:
+        refresh_scheduler.cancel(session_id)
+        api_cache.invalidate(session_id)
+        token_data = session_data.get("token_data") or {}
+        # リフレッシュトークンを失効させると、同じ認可のアクセストークンも無効になる
+        token = token_data.get("refresh_token") or token_data.get("access_token")
+        if token:
+            try:
+                await http_client.post(
+                    OAUTH_CONFIG["revocation_endpoint"],
+                    data={
+                        "token": token,
+                        "client_id": OAUTH_CONFIG["client_id"],
+                        "client_secret": OAUTH_CONFIG["client_secret"],
+                    },
+                    timeout=5.0,
+                )
+            except httpx.HTTPError:
+                # 認可サーバーに届かなくてもローカルのログアウトは行う
+                pass
 
     response = RedirectResponse(url="/", status_code=302)
     response.delete_cookie("session")
     return response
 
 
+@app.get("/metrics")
+async def metrics():
+    """セッションストア・トークン更新・API レスポンスキャッシュの統計"""
+    return {
+        "sessions": sessions.stats(),
+        "refresh": refresh_scheduler.stats(),
+        "api_cache": api_cache.stats(),
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5001)
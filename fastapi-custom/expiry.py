@@ -0,0 +1,86 @@
+"""
+有効期限インデックスとスイーパー
+
+expires_at をキーにした最小ヒープで、期限切れのエントリを古い順に取り出す
+スイーパーは asyncio タスクとして一定件数ずつ削除する
+"""
+
+import asyncio
+import heapq
+import threading
+import time
+
+
+class ExpiryIndex:
+    """expires_at（epoch秒）順の最小ヒープ
+
+    交換済み・削除済みのエントリはヒープに残る（遅延削除）
+    取り出し時にストレージ側で存在と期限を再確認する
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def push(self, expires_at, table, key):
+        """エントリを登録"""
+        with self._lock:
+            heapq.heappush(self._heap, (expires_at, table, key))
+
+    def pop_expired(self, now, limit):
+        """期限切れのエントリを最大 limit 件取り出す"""
+        expired = []
+        with self._lock:
+            while self._heap and len(expired) < limit and self._heap[0][0] <= now:
+                expired.append(heapq.heappop(self._heap))
+        return expired
+
+    def has_expired(self, now):
+        """期限切れのエントリが残っているか"""
+        with self._lock:
+            return bool(self._heap) and self._heap[0][0] <= now
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class SweepStats:
+    """スイープのコスト集計"""
+
+    def __init__(self):
+        self.runs = 0
+        self.removed_total = 0
+        self.last_removed = 0
+        self.last_duration_ms = 0.0
+        self.total_duration_ms = 0.0
+
+    def record(self, removed, duration_ms):
+        self.runs += 1
+        self.removed_total += removed
+        self.last_removed = removed
+        self.last_duration_ms = duration_ms
+        self.total_duration_ms += duration_ms
+
+    def as_dict(self):
+        return {
+            "runs": self.runs,
+            "removed_total": self.removed_total,
+            "last_removed": self.last_removed,
+            "last_duration_ms": self.last_duration_ms,
+            "total_duration_ms": self.total_duration_ms,
+        }
+
+
+async def run_sweeper(storage, interval=1.0, batch_size=1000):
+    """期限切れエントリを定期的に削除する asyncio タスク
+
+    1回の削除件数を batch_size に抑え、イベントループを長時間占有しない
+    storage は AsyncStorage（async_storage.py）
+    """
+    while True:
+        await storage.sweep_expired(batch_size)
+        # 1バッチで削除しきれなかった場合は他のタスクに譲ってから続行
+        if await storage.has_expired(time.time()):
+            await asyncio.sleep(0)
+            continue
+        await asyncio.sleep(interval)
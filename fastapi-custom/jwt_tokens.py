@@ -0,0 +1,181 @@
+"""
+自己完結型アクセストークン（HS256 署名付き JWT）
+
+トークン自体に username / client_id / scope / exp を含めて署名するため、
+リソースサーバーはストレージを引かずにローカルで検証できる
+
+- KeyRing: kid ごとの署名鍵を管理し、ローテーション後も旧鍵で検証できる
+- DenyList: 失効させたトークン（jti）・トークンファミリーの一覧。唯一のステートフルなチェック
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from typing import Optional
+
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class KeyRing:
+    """kid ごとの HMAC 鍵と、検証用に初期化済みの HMAC オブジェクトのキャッシュ"""
+
+    def __init__(self):
+        self._keys = {}
+        # kid -> 鍵をセット済みの HMAC（検証時は copy() して使う）
+        self._macs = {}
+        # ヘッダーセグメント -> kid（同じ kid のヘッダーは毎回同じ文字列になる）
+        self._header_kids = {}
+        # kid -> エンコード済みヘッダーセグメント
+        self._headers = {}
+        self.active_kid = None
+
+    def add_key(self, kid: str, secret: bytes, activate: bool = False):
+        """鍵を追加（activate=True で以後の署名に使う）"""
+        self._keys[kid] = secret
+        self._macs[kid] = hmac.new(secret, digestmod=hashlib.sha256)
+        header = b64url_encode(json.dumps(
+            {"alg": "HS256", "typ": "JWT", "kid": kid}, separators=(",", ":")
+        ).encode())
+        self._headers[kid] = header
+        self._header_kids[header] = kid
+        if activate or self.active_kid is None:
+            self.active_kid = kid
+
+    def rotate(self, kid: str, secret: bytes):
+        """新しい鍵で署名を始める（旧鍵は検証用に残る）"""
+        self.add_key(kid, secret, activate=True)
+
+    def remove_key(self, kid: str):
+        """旧鍵を破棄（その鍵で署名されたトークンは検証できなくなる）"""
+        if kid == self.active_kid:
+            raise ValueError("Cannot remove the active key")
+        self._keys.pop(kid, None)
+        self._macs.pop(kid, None)
+        header = self._headers.pop(kid, None)
+        self._header_kids.pop(header, None)
+
+    def _sign(self, kid: str, signing_input: bytes) -> bytes:
+        mac = self._macs[kid].copy()
+        mac.update(signing_input)
+        return mac.digest()
+
+    def encode(self, claims: dict) -> str:
+        """claims に署名して JWT を作成"""
+        header = self._headers[self.active_kid]
+        payload = b64url_encode(json.dumps(claims, separators=(",", ":")).encode())
+        signing_input = f"{header}.{payload}"
+        signature = self._sign(self.active_kid, signing_input.encode("ascii"))
+        return f"{signing_input}.{b64url_encode(signature)}"
+
+    def decode(self, token: str) -> Optional[dict]:
+        """署名と有効期限を検証して claims を返す（不正なら None）"""
+        parts = token.split(".")
+        if len(parts) != 3:
+            return None
+        header, payload, signature = parts
+
+        kid = self._header_kids.get(header)
+        if kid is None:
+            return None
+
+        try:
+            # ASCII 以外を含むトークンは UnicodeEncodeError（ValueError）で不正扱いにする
+            expected = self._sign(kid, f"{header}.{payload}".encode("ascii"))
+            if not hmac.compare_digest(expected, b64url_decode(signature)):
+                return None
+            claims = json.loads(b64url_decode(payload))
+        except ValueError:
+            return None
+
+        if claims.get("exp", 0) <= time.time():
+            return None
+        return claims
+
+
+class DenyList:
+    """失効させた JWT の jti・ファミリーの一覧（exp を過ぎたものは破棄）
+
+    ファミリーの失効はストレージが正で、このプロセスで失効させたものはすぐに登録する。
+    別のワーカーや一括失効で失効したものは、ファミリーごとに family_recheck 秒に1回だけ
+    ストレージに問い合わせて反映する（JWT の検証ごとにストレージを引かない）
+    """
+
+    def __init__(self, family_recheck: Optional[float] = None):
+        self._revoked = {}
+        self._families = {}
+        if family_recheck is None:
+            family_recheck = float(os.environ.get("JWT_FAMILY_RECHECK", "1"))
+        self.family_recheck = family_recheck
+        # 現在の区間（family_recheck 秒ごと）にストレージで失効していないと確認したファミリー
+        self._checked = set()
+        self._checked_window = None
+
+    def revoke(self, jti: str, exp: float):
+        self._revoked[jti] = exp
+        self.purge(time.time())
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def revoke_family(self, family_id: str, exp: float):
+        """ファミリーの JWT をすべて拒否する（exp はファミリーの最後の JWT の期限）"""
+        self._families[family_id] = max(exp, self._families.get(family_id, 0))
+        self._checked.discard(family_id)
+        self.purge(time.time())
+
+    def is_family_revoked(self, family_id: str) -> bool:
+        return family_id in self._families
+
+    def needs_family_check(self, family_id: str, now: float) -> bool:
+        """ストレージに問い合わせるべきなら True（区間ごとにファミリーあたり1回）"""
+        if self.family_recheck <= 0:
+            return True
+        window = int(now // self.family_recheck)
+        if window != self._checked_window:
+            self._checked.clear()
+            self._checked_window = window
+        if family_id in self._checked:
+            return False
+        self._checked.add(family_id)
+        return True
+
+    def purge(self, now: float):
+        for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[jti]
+        for family_id in [family_id for family_id, exp in self._families.items() if exp <= now]:
+            del self._families[family_id]
+
+    def __len__(self):
+        return len(self._revoked) + len(self._families)
+
+
+def load_key_ring() -> KeyRing:
+    """環境変数 JWT_KEYS（"kid:base64url鍵,..."、先頭が署名用）から鍵を読み込む
+
+    未設定の場合は起動ごとにランダムな鍵を生成する（単一プロセス向け）
+    """
+    key_ring = KeyRing()
+    spec = os.environ.get("JWT_KEYS", "")
+    for i, entry in enumerate(filter(None, spec.split(","))):
+        kid, secret = entry.split(":", 1)
+        key_ring.add_key(kid, b64url_decode(secret), activate=(i == 0))
+    if key_ring.active_kid is None:
+        key_ring.add_key(f"k{int(time.time())}", secrets.token_bytes(32))
+    return key_ring
+
+
+# アクセストークンの形式（opaque: ランダム文字列 / jwt: 署名付き JWT）
+TOKEN_FORMAT = os.environ.get("TOKEN_FORMAT", "opaque")
+
+key_ring = load_key_ring()
+deny_list = DenyList()
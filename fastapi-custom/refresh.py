@@ -0,0 +1,133 @@
+"""
+アクセストークンの事前リフレッシュ（クライアント側）
+
+セッションのアクセストークンを期限切れ前にリフレッシュトークンで更新する asyncio のスケジューラ
+
+- 更新予定時刻（期限 - margin - 有効期間 × jitter 以内のランダムな秒数）をキーにした最小ヒープで、近いものから取り出す
+  同じ時刻にログインしたセッションも、有効期間に比例した幅で更新時刻がばらける
+- 予定の変更・取り消しはヒープから消さず、session_id -> 予定時刻 の表と一致しないエントリを読み飛ばす（遅延削除）
+- 同時に実行する更新の数（concurrency）と毎秒の更新回数（rate、トークンバケット）を制限し、
+  多数のセッションの更新が /token に集中しないようにする
+
+環境変数:
+- REFRESH_MARGIN: 期限の何秒前に更新するか（デフォルト 60）
+- REFRESH_JITTER: 更新時刻をばらつかせる幅（有効期間に対する割合、デフォルト 0.1 → 1時間のトークンなら最大6分早める）
+- REFRESH_CONCURRENCY: 同時に実行する更新の数（デフォルト 4）
+- REFRESH_RATE: 毎秒の更新回数（"毎秒の回数:バースト"、デフォルト 5:10、"0" で制限しない）
+  認可サーバーの /token の client_id ごとの制限（RATE_LIMIT_TOKEN、デフォルト 10:20）より低くし、ログインの分を残す
+"""
+
+import asyncio
+import heapq
+import os
+import random
+import time
+
+from ratelimit import TokenBuckets, limit_from_env
+
+
+class RefreshScheduler:
+    """セッションごとのトークン更新の予定を管理し、予定時刻に refresh を呼ぶ
+
+    refresh(session_id) は新しいトークンの expires_in（秒）を返す。None なら以後の更新をやめる
+    （セッションがない・リフレッシュトークンが無効）。例外なら retry_delay 秒後に再試行する
+    引数を省略したものは環境変数から読む（rate は (毎秒の回数, バースト)、False なら制限しない）
+    """
+
+    def __init__(self, refresh, margin=None, jitter=None, concurrency=None, rate=None, retry_delay=10.0):
+        self.refresh = refresh
+        self.margin = float(os.environ.get("REFRESH_MARGIN", "60")) if margin is None else margin
+        self.jitter = float(os.environ.get("REFRESH_JITTER", "0.1")) if jitter is None else jitter
+        if concurrency is None:
+            concurrency = int(os.environ.get("REFRESH_CONCURRENCY", "4"))
+        if rate is None:
+            rate = limit_from_env("REFRESH_RATE", "5:10")
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBuckets(*rate) if rate else None
+        # (予定時刻, session_id) の最小ヒープと、session_id -> 有効な予定時刻
+        self._heap = []
+        self._due = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def schedule(self, session_id, expires_in, now=None):
+        """expires_in 秒後に期限切れになるトークンの更新を予約（同じセッションの予定は置き換える）"""
+        now = time.time() if now is None else now
+        # 有効期間が短いトークンでも、期限の前半より早くは更新しない
+        lead = min(self.margin + random.uniform(0, expires_in * self.jitter), expires_in / 2)
+        self._push(session_id, now + expires_in - lead)
+
+    def cancel(self, session_id):
+        """更新の予定を取り消す（ログアウト時）"""
+        self._due.pop(session_id, None)
+
+    def _push(self, session_id, due):
+        self._due[session_id] = due
+        heapq.heappush(self._heap, (due, session_id))
+        if self._heap[0][1] == session_id:
+            # 待っている時刻より早い予定が入ったら起こす
+            self._wakeup.set()
+
+    async def run(self):
+        """予定時刻になったセッションを更新し続ける（lifespan で asyncio タスクとして起動する）"""
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, session_id = heapq.heappop(self._heap)
+                if self._due.get(session_id) != due:
+                    continue
+                del self._due[session_id]
+                # 同時実行数の上限に達していれば、空くまで次の予定を取り出さない
+                await self._semaphore.acquire()
+                await self._throttle()
+                task = asyncio.create_task(self._refresh(session_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                now = time.time()
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _throttle(self):
+        if self._bucket is None:
+            return
+        while True:
+            wait = self._bucket.take("refresh", time.monotonic())
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _refresh(self, session_id):
+        try:
+            expires_in = await self.refresh(session_id)
+        except Exception:
+            self.failed += 1
+            # 更新中に再予約されていなければ、少し待って再試行する（ログアウト済みなら次の refresh が None を返す）
+            if session_id not in self._due:
+                self._push(session_id, time.time() + self.retry_delay)
+            return
+        finally:
+            self._semaphore.release()
+        if expires_in is None:
+            self.dropped += 1
+            return
+        self.refreshed += 1
+        if session_id not in self._due:
+            self.schedule(session_id, expires_in)
+
+    def stats(self):
+        return {
+            "scheduled": len(self._due),
+            "in_flight": len(self._tasks),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,91 @@
+"""
+シリアライズ済みレスポンスのキャッシュ
+
+/api/me・/api/profile は同じユーザーに対して毎回同じ dict を作り、JSON にエンコードしている
+ユーザーごとに JSON のバイト列をキャッシュし、ストレージのバージョンカウンタ（ETag と同じもの）が変わったら作り直す
+
+- キーは (種類, username)、値は (バージョン, バイト列)。バージョンが違えばミス（ユーザー情報を更新すると自動的に無効になる）
+- maxsize 件を超えたら古く作ったものから捨てる（ヒット時に順序を更新しないため、読み出しはロックを取らない）
+- orjson がインストールされていればエンコードに使う（なければ標準の json）
+
+環境変数:
+- RESPONSE_CACHE_SIZE: キャッシュするレスポンス数（デフォルト 10000、0 でキャッシュしない）
+- JSON_ENCODER: "json" なら orjson があっても標準の json を使う
+"""
+
+import json
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 10000))
+
+
+def json_dumps(obj) -> bytes:
+    """標準の json でエンコード（orjson と同じく空白なしの UTF-8）"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+if orjson is not None and os.environ.get("JSON_ENCODER") != "json":
+    dumps = orjson.dumps
+else:
+    dumps = json_dumps
+
+
+class ResponseCache:
+    """ユーザーごとのシリアライズ済みレスポンスのキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, dumps=dumps):
+        self.maxsize = maxsize
+        self.dumps = dumps
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind, username, version):
+        """キャッシュ済みで、バージョンが一致すればバイト列（なければ None）"""
+        # 読み出しはロックを取らない（dict の get はアトミック。エンコードより速くなければ意味がない）
+        entry = self._entries.get((kind, username))
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, kind, username, version, payload):
+        """payload をエンコードしてキャッシュし、バイト列を返す
+
+        version はデータより先に読んだものを渡す（古い本文が新しいバージョンでキャッシュされないようにする）
+        """
+        body = self.dumps(payload)
+        if self.maxsize <= 0:
+            return body
+        key = (kind, username)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, body)
+            while len(self._entries) > self.maxsize:
+                del self._entries[next(iter(self._entries))]
+                self.evictions += 1
+        return body
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "encoder": "orjson" if orjson is not None and self.dumps is orjson.dumps else "json",
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# グローバルインスタンス
+response_cache = ResponseCache()
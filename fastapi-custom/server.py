@@ -4,21 +4,100 @@ OAuth 2.0 認可サーバー + リソースサーバー
 MCP の OAuth 実装を見据えたシンプルな実装例
 """
 
-from fastapi import FastAPI, Request, Form, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import FastAPI, Request, Form, Header, HTTPException, Depends, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, HTTPBasic, HTTPBasicCredentials
+import asyncio
+import json
+import os
 import secrets
-from typing import Optional
+import time
+import zlib
+from contextlib import asynccontextmanager
+from html import escape
+from string import Template
+from typing import List, Optional
 from datetime import datetime, timedelta
 
-from storage import storage
-
-app = FastAPI(title="OAuth 2.0 Server")
+from async_storage import storage
+from expiry import run_sweeper
+import jwt_tokens
+import passwords
+from post_index import INT64_MAX, INT64_MIN, in_int64_range, parse_timestamp
+from response_cache import response_cache
+from introspection import IntrospectionError, create_validator
+from ratelimit import RateLimiter, RateLimitMiddleware, limit_from_env
+
+# INTROSPECTION_URL 設定時は認可サーバーに問い合わせてトークンを検証（リソースサーバー単独運用）
+introspection_validator = create_validator()
+# 認可サーバーに問い合わせられないときの 503 のヘッダー
+INTROSPECTION_UNAVAILABLE_HEADERS = {
+    "WWW-Authenticate": 'Bearer error="temporarily_unavailable", error_description="Token introspection failed"',
+    "Retry-After": "1",
+}
+
+# 管理API（一括失効）の認証トークン（X-Admin-Token ヘッダーで渡す）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "demo-admin-token")
+
+# 同意処理で受け付けるスコープの最大長（認可コードと一緒に保存するため）
+MAX_SCOPE_LENGTH = 512
+
+# /token は IP ごと・client_id ごと、同意処理は IP ごと・IP + username ごとのレート制限
+rate_limiter = RateLimiter({
+    "/token": limit_from_env("RATE_LIMIT_TOKEN", "10:20"),
+    "/authorize/consent": limit_from_env("RATE_LIMIT_CONSENT", "1:5"),
+}, ip_limits={
+    "/authorize/consent": limit_from_env("RATE_LIMIT_CONSENT_IP", "10:50"),
+}, user_paths=["/authorize/consent"])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にスイーパーを開始し、終了時に停止する"""
+    sweeper = asyncio.create_task(run_sweeper(storage, interval=1.0, batch_size=1000))
+    yield
+    sweeper.cancel()
+    if introspection_validator:
+        await introspection_validator.aclose()
+    passwords.verifier.shutdown()
+
+
+app = FastAPI(title="OAuth 2.0 Server", lifespan=lifespan)
 security = HTTPBearer()
+client_basic = HTTPBasic(auto_error=False)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
 
 
 # ===== 認可サーバーのエンドポイント =====
 
+# ログイン・同意画面（起動時に1回だけ作成する。パラメータは html.escape してから埋め込む）
+CONSENT_TEMPLATE = Template("""
+    <html>
+        <head><title>OAuth 2.0 Authorization</title></head>
+        <body>
+            <h2>ログイン</h2>
+            <form method="post" action="/authorize/consent">
+                <input type="hidden" name="client_id" value="$client_id">
+                <input type="hidden" name="redirect_uri" value="$redirect_uri">
+                <input type="hidden" name="state" value="$state">
+                <input type="hidden" name="scope" value="$scope">
+                <div>
+                    <label>Username: <input type="text" name="username" value="demo-user"></label>
+                </div>
+                <div>
+                    <label>Password: <input type="password" name="password" value="demo-password"></label>
+                </div>
+                <div style="margin-top: 20px;">
+                    <p>クライアント「$client_id」が以下の権限を要求しています：</p>
+                    <p><strong>$scope_label</strong></p>
+                </div>
+                <button type="submit">許可する</button>
+            </form>
+        </body>
+    </html>
+""")
+
+
 @app.get("/authorize")
 async def authorize(
     response_type: str,
@@ -32,11 +111,12 @@ async def authorize(
     クライアントからのリクエストを受け取り、ユーザーにログイン・同意画面を表示
     """
     # クライアントIDの検証
-    if client_id not in storage.clients:
+    client = await storage.get_client(client_id)
+    if not client:
         raise HTTPException(status_code=400, detail="Invalid client_id")
 
     # redirect_uriの検証
-    if redirect_uri not in storage.clients[client_id]["redirect_uris"]:
+    if redirect_uri not in client["redirect_uris"]:
         raise HTTPException(status_code=400, detail="Invalid redirect_uri")
 
     # response_typeの検証（認可コードフローのみサポート）
@@ -44,31 +124,13 @@ async def authorize(
         raise HTTPException(status_code=400, detail="Unsupported response_type")
 
     # ログイン・同意画面を表示（簡易実装）
-    html_content = f"""
-    <html>
-        <head><title>OAuth 2.0 Authorization</title></head>
-        <body>
-            <h2>ログイン</h2>
-            <form method="post" action="/authorize/consent">
-                <input type="hidden" name="client_id" value="{client_id}">
-                <input type="hidden" name="redirect_uri" value="{redirect_uri}">
-                <input type="hidden" name="state" value="{state or ''}">
-                <input type="hidden" name="scope" value="{scope or ''}">
-                <div>
-                    <label>Username: <input type="text" name="username" value="demo-user"></label>
-                </div>
-                <div>
-                    <label>Password: <input type="password" name="password" value="demo-password"></label>
-                </div>
-                <div style="margin-top: 20px;">
-                    <p>クライアント「{client_id}」が以下の権限を要求しています：</p>
-                    <p><strong>{scope or 'read'}</strong></p>
-                </div>
-                <button type="submit">許可する</button>
-            </form>
-        </body>
-    </html>
-    """
+    html_content = CONSENT_TEMPLATE.substitute(
+        client_id=escape(client_id),
+        redirect_uri=escape(redirect_uri),
+        state=escape(state or ""),
+        scope=escape(scope or ""),
+        scope_label=escape(scope or "read"),
+    )
     return HTMLResponse(content=html_content)
 
 
@@ -85,20 +147,31 @@ async def authorize_consent(
     ユーザーの同意処理
     ログイン情報を検証し、認可コードを発行してクライアントにリダイレクト
     """
+    # クライアントID・redirect_uri・スコープの検証（同意画面を経由しない POST もあるため再度行う）
+    client = await storage.get_client(client_id)
+    if not client:
+        raise HTTPException(status_code=400, detail="Invalid client_id")
+    if redirect_uri not in client["redirect_uris"]:
+        raise HTTPException(status_code=400, detail="Invalid redirect_uri")
+    if len(scope) > MAX_SCOPE_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid scope")
+
     # ユーザー認証
-    user = storage.users.get(username)
-    if not user or user["password"] != password:
+    user = await storage.get_user(username)
+    # ユーザーがいなくてもダミーのハッシュで検証する（応答時間でユーザー名の有無がわからないように）
+    password_hash = user["password_hash"] if user else passwords.DUMMY_PASSWORD_HASH
+    if not await passwords.verifier.check_async(password, password_hash) or not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # 認可コードを生成
     auth_code = secrets.token_urlsafe(32)
-    storage.auth_codes[auth_code] = {
+    await storage.save_auth_code(auth_code, {
         "client_id": client_id,
         "redirect_uri": redirect_uri,
         "username": username,
         "scope": scope,
         "expires_at": datetime.now() + timedelta(minutes=10),
-    }
+    })
 
     # クライアントにリダイレクト
     redirect_url = f"{redirect_uri}?code={auth_code}"
@@ -108,133 +181,626 @@ async def authorize_consent(
     return RedirectResponse(url=redirect_url, status_code=302)
 
 
+# リフレッシュトークンの有効期限
+REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+ACCESS_TOKEN_LIFETIME = timedelta(hours=1)
+
+
+async def revoke_family(family_id: str, expires_at: datetime) -> None:
+    """ファミリーを失効させ、このプロセスの JWT 拒否リストにもすぐに登録する"""
+    await storage.revoke_family(family_id, expires_at)
+    # ファミリーの JWT は遅くとも今から ACCESS_TOKEN_LIFETIME 後に期限切れになる
+    jwt_tokens.deny_list.revoke_family(family_id, (datetime.now() + ACCESS_TOKEN_LIFETIME).timestamp())
+
+
 @app.post("/token")
 async def token(
     grant_type: str = Form(...),
     code: Optional[str] = Form(None),
     redirect_uri: Optional[str] = Form(None),
+    refresh_token: Optional[str] = Form(None),
     client_id: Optional[str] = Form(None),
     client_secret: Optional[str] = Form(None),
 ):
     """
     トークンエンドポイント
-    認可コードをアクセストークンに交換
+    認可コード・リフレッシュトークンをアクセストークンに交換
     """
-    if grant_type != "authorization_code":
+    if grant_type not in ("authorization_code", "refresh_token"):
         raise HTTPException(status_code=400, detail="Unsupported grant_type")
 
     # クライアント認証
-    client = storage.clients.get(client_id)
-    if not client or client["client_secret"] != client_secret:
+    client = await storage.get_client(client_id)
+    if not client or not await passwords.check_client_secret_async(
+        client_id, client_secret, client["client_secret_hash"]
+    ):
         raise HTTPException(status_code=401, detail="Invalid client credentials")
 
-    # 認可コードの検証
-    auth_code_data = storage.auth_codes.get(code)
+    if grant_type == "refresh_token":
+        return await refresh_token_grant(refresh_token, client_id)
+
+    # 認可コードを検証して取り出す（使い捨て）
+    # 期限・redirect_uri・クライアントID の検証と削除をまとめて行い、同じコードの同時交換は1つだけが成功する
+    # （--workers で複数プロセスが同じストレージを使う場合も含む）
+    now = datetime.now()
+    auth_code_data = await storage.pop_auth_code_if_valid(code, lambda data: (
+        now <= data["expires_at"]
+        and data["redirect_uri"] == redirect_uri
+        and data["client_id"] == client_id
+    ))
     if not auth_code_data:
         raise HTTPException(status_code=400, detail="Invalid authorization code")
 
-    # 有効期限チェック
-    if datetime.now() > auth_code_data["expires_at"]:
-        del storage.auth_codes[code]
-        raise HTTPException(status_code=400, detail="Authorization code expired")
-
-    # クライアントIDとredirect_uriの一致を確認
-    if (auth_code_data["client_id"] != client_id or
-        auth_code_data["redirect_uri"] != redirect_uri):
-        raise HTTPException(status_code=400, detail="Invalid request")
-
-    # アクセストークンを生成
-    access_token = secrets.token_urlsafe(32)
-    storage.access_tokens[access_token] = {
-        "username": auth_code_data["username"],
-        "client_id": client_id,
-        "scope": auth_code_data["scope"],
-        "expires_at": datetime.now() + timedelta(hours=1),
-    }
+    # 新しいトークンファミリーとして発行
+    return await issue_tokens(
+        auth_code_data["username"], client_id, auth_code_data["scope"], secrets.token_urlsafe(16)
+    )
 
-    # 認可コードを削除（使い捨て）
-    del storage.auth_codes[code]
+
+async def refresh_token_grant(refresh_token: Optional[str], client_id: str) -> dict:
+    """
+    リフレッシュトークンによるアクセストークンの再発行
+    リフレッシュトークンは使い捨て（ローテーション）で、使用済みのものが再提示されたら
+    漏洩とみなしてファミリー全体を失効させる
+    """
+    refresh_data = await storage.get_refresh_token(refresh_token) if refresh_token else None
+    if not refresh_data or refresh_data["client_id"] != client_id:
+        raise HTTPException(status_code=400, detail="Invalid refresh token")
+
+    family_id = refresh_data["family_id"]
+
+    # 使用済みトークンの再利用 → ファミリー内のアクセストークン・リフレッシュトークンをまとめて無効化
+    if refresh_data["used"]:
+        await revoke_family(family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
+        raise HTTPException(status_code=400, detail="Refresh token reused")
+
+    if await storage.is_family_revoked(family_id) or datetime.now() > refresh_data["expires_at"]:
+        raise HTTPException(status_code=400, detail="Invalid refresh token")
+
+    # 未使用 → 使用済みの書き換えに成功したリクエストだけが新しいトークンを受け取る
+    # 同じトークンで同時に来た他方（別のワーカーを含む）は再利用として扱う
+    if not await storage.mark_refresh_token_used(refresh_token):
+        await revoke_family(family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
+        raise HTTPException(status_code=400, detail="Refresh token reused")
+
+    return await issue_tokens(refresh_data["username"], client_id, refresh_data["scope"], family_id)
+
+
+async def issue_tokens(username: str, client_id: str, scope: str, family_id: str) -> dict:
+    """アクセストークンとリフレッシュトークンを発行してトークンレスポンスを返す"""
+    now = datetime.now()
+    expires_at = now + ACCESS_TOKEN_LIFETIME
+    if jwt_tokens.TOKEN_FORMAT == "jwt":
+        # 署名付き JWT（ストレージには保存しない）
+        access_token = jwt_tokens.key_ring.encode({
+            "jti": secrets.token_urlsafe(16),
+            "fam": family_id,
+            "username": username,
+            "client_id": client_id,
+            "scope": scope,
+            # 一括失効（shm の失効時刻）と比べるため小数秒まで持つ
+            "iat": now.timestamp(),
+            "exp": int(expires_at.timestamp()),
+        })
+    else:
+        access_token = secrets.token_urlsafe(32)
+        await storage.save_access_token(access_token, {
+            "username": username,
+            "client_id": client_id,
+            "scope": scope,
+            "family_id": family_id,
+            "expires_at": expires_at,
+        })
+
+    refresh_token = secrets.token_urlsafe(32)
+    await storage.save_refresh_token(refresh_token, {
+        "username": username,
+        "client_id": client_id,
+        "scope": scope,
+        "family_id": family_id,
+        "used": False,
+        "expires_at": now + REFRESH_TOKEN_LIFETIME,
+    })
 
     return {
         "access_token": access_token,
         "token_type": "Bearer",
         "expires_in": 3600,
-        "scope": auth_code_data["scope"],
+        "refresh_token": refresh_token,
+        "scope": scope,
     }
 
 
+async def authenticate_client(
+    basic: Optional[HTTPBasicCredentials],
+    client_id: Optional[str],
+    client_secret: Optional[str],
+) -> Optional[str]:
+    """
+    クライアント認証（client_secret_basic / client_secret_post）
+    認証できたら client_id を返す
+    """
+    if basic:
+        client_id, client_secret = basic.username, basic.password
+
+    client = await storage.get_client(client_id)
+    if not client or not await passwords.check_client_secret_async(
+        client_id, client_secret, client["client_secret_hash"]
+    ):
+        return None
+    return client_id
+
+
+# 失効させた JWT の jti はファミリーと同じ失効表に、この接頭辞を付けて保存する（全ワーカーで共有）
+REVOKED_JTI_PREFIX = "jti:"
+
+
+async def is_jwt_family_revoked(family_id: str, exp: float, claims: Optional[dict] = None) -> bool:
+    """JWT のファミリーが失効しているか（拒否リストを見て、ストレージは family_recheck 秒に1回だけ引く）
+
+    REVOKED_JTI_PREFIX を付けた jti も同じ経路で確認する。claims を渡すと、一括失効の前に発行された
+    JWT（iat で判定）もファミリーごと失効として扱う
+    """
+    deny_list = jwt_tokens.deny_list
+    if deny_list.is_family_revoked(family_id):
+        return True
+    if not deny_list.needs_family_check(family_id, time.time()):
+        return False
+    # 別のワーカー・一括失効で失効したファミリーを拒否リストに反映する
+    revoked = await storage.is_family_revoked(family_id)
+    if not revoked and claims and "iat" in claims:
+        revoked = await storage.is_bulk_revoked(claims["username"], claims["client_id"], claims["iat"])
+    if revoked:
+        deny_list.revoke_family(family_id, exp)
+        return True
+    return False
+
+
+async def decode_jwt_token(token: str) -> Optional[dict]:
+    """署名付き JWT をローカルで検証し、token_data と同じ形で返す"""
+    claims = jwt_tokens.key_ring.decode(token)
+    if not claims or jwt_tokens.deny_list.is_revoked(claims["jti"]):
+        return None
+    # 別のワーカーで失効した jti
+    if await is_jwt_family_revoked(REVOKED_JTI_PREFIX + claims["jti"], claims["exp"]):
+        return None
+    # ファミリーが失効していれば署名が正しくても無効
+    if "fam" in claims and await is_jwt_family_revoked(claims["fam"], claims["exp"], claims):
+        return None
+    return {
+        "username": claims["username"],
+        "client_id": claims["client_id"],
+        "scope": claims["scope"],
+        "expires_at": datetime.fromtimestamp(claims["exp"]),
+    }
+
+
+async def introspection_payload(token: str) -> dict:
+    """トークンのイントロスペクション結果（RFC 7662）"""
+    if token.count(".") == 2:
+        token_data = await decode_jwt_token(token)
+    else:
+        token_data = await storage.get_access_token(token)
+
+    if not token_data or datetime.now() > token_data["expires_at"]:
+        return {"active": False}
+
+    return {
+        "active": True,
+        "token_type": "Bearer",
+        "scope": token_data["scope"],
+        "client_id": token_data["client_id"],
+        "username": token_data["username"],
+        "exp": int(token_data["expires_at"].timestamp()),
+    }
+
+
+@app.post("/introspect")
+async def introspect(
+    token: str = Form(...),
+    token_type_hint: Optional[str] = Form(None),
+    client_id: Optional[str] = Form(None),
+    client_secret: Optional[str] = Form(None),
+    basic: Optional[HTTPBasicCredentials] = Depends(client_basic),
+):
+    """
+    イントロスペクションエンドポイント（RFC 7662）
+    リソースサーバーがトークンの有効性と属性を問い合わせる
+    """
+    if not await authenticate_client(basic, client_id, client_secret):
+        raise HTTPException(status_code=401, detail="Invalid client credentials")
+
+    return await introspection_payload(token)
+
+
+@app.post("/introspect/batch")
+async def introspect_batch(
+    token: List[str] = Form([]),
+    client_id: Optional[str] = Form(None),
+    client_secret: Optional[str] = Form(None),
+    basic: Optional[HTTPBasicCredentials] = Depends(client_basic),
+):
+    """
+    イントロスペクションエンドポイント（バッチ）
+    token パラメータを複数指定し、同じ順序で結果を返す
+    """
+    if not await authenticate_client(basic, client_id, client_secret):
+        raise HTTPException(status_code=401, detail="Invalid client credentials")
+
+    return {"results": [await introspection_payload(t) for t in token]}
+
+
+async def revoke_token(token: str, token_type_hint: Optional[str], client_id: str):
+    """
+    クライアント自身に発行されたトークンを失効
+    リフレッシュトークンは同じ認可から発行されたアクセストークンもまとめて無効化する
+    """
+    kinds = ["access_token", "refresh_token"]
+    if token_type_hint == "refresh_token":
+        kinds.reverse()
+
+    for kind in kinds:
+        if kind == "access_token":
+            if token.count(".") == 2:
+                # JWT は拒否リストに jti を登録し、別のワーカー向けにストレージにも保存する
+                claims = jwt_tokens.key_ring.decode(token)
+                if claims and claims["client_id"] == client_id:
+                    jwt_tokens.deny_list.revoke(claims["jti"], claims["exp"])
+                    await storage.revoke_family(
+                        REVOKED_JTI_PREFIX + claims["jti"], datetime.fromtimestamp(claims["exp"])
+                    )
+                    return
+                continue
+            token_data = await storage.get_access_token(token)
+            if token_data and token_data["client_id"] == client_id:
+                await storage.delete_access_token(token)
+                return
+        else:
+            refresh_data = await storage.get_refresh_token(token)
+            if refresh_data and refresh_data["client_id"] == client_id:
+                await revoke_family(refresh_data["family_id"], refresh_data["expires_at"])
+                await storage.delete_refresh_token(token)
+                return
+
+
+@app.post("/revoke")
+async def revoke(
+    token: str = Form(...),
+    token_type_hint: Optional[str] = Form(None),
+    client_id: Optional[str] = Form(None),
+    client_secret: Optional[str] = Form(None),
+    basic: Optional[HTTPBasicCredentials] = Depends(client_basic),
+):
+    """
+    トークン失効エンドポイント（RFC 7009）
+    不明なトークンでも 200 を返す
+    """
+    client_id = await authenticate_client(basic, client_id, client_secret)
+    if not client_id:
+        raise HTTPException(status_code=401, detail="Invalid client credentials")
+
+    await revoke_token(token, token_type_hint, client_id)
+    return Response(status_code=200)
+
+
+@app.post("/admin/revoke")
+async def admin_revoke(
+    username: Optional[str] = Form(None),
+    client_id: Optional[str] = Form(None),
+    x_admin_token: str = Header(""),
+):
+    """
+    ユーザー・クライアント単位の一括失効（管理用）
+    username または client_id を指定する
+    """
+    # str どうしの compare_digest は ASCII 以外で TypeError になるため bytes で比べる
+    if not secrets.compare_digest(x_admin_token.encode("utf-8", "surrogateescape"), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+    if username:
+        revoked = await storage.revoke_user_tokens(username)
+    elif client_id:
+        revoked = await storage.revoke_client_tokens(client_id)
+    else:
+        raise HTTPException(status_code=400, detail="username or client_id is required")
+
+    return {"revoked": revoked}
+
+
+# ===== 条件付きレスポンス（ETag） =====
+
+# Bearer トークンで保護されたレスポンスなので共有キャッシュには保存させず、毎回 ETag で再検証させる
+CACHE_CONTROL = "private, no-cache"
+# /api/me・/api/profile は変更が少ないため、PROFILE_MAX_AGE 秒は再検証なしで使わせる（0 なら毎回再検証）
+PROFILE_MAX_AGE = int(os.environ.get("PROFILE_MAX_AGE", "5"))
+PROFILE_CACHE_CONTROL = f"private, max-age={PROFILE_MAX_AGE}" if PROFILE_MAX_AGE > 0 else CACHE_CONTROL
+
+
+def make_etag(kind: str, username: str, version: int) -> str:
+    """ストレージのバージョンカウンタから強い ETag を作る（ユーザーごとに異なる値になるよう username の CRC を含める）"""
+    return '"%s-%d-%08x"' % (kind, version, zlib.crc32(username.encode()))
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    """If-None-Match が etag と一致するか（弱い比較）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return any(tag.strip() in ("*", etag, "W/" + etag) for tag in header.split(","))
+
+
+def not_modified(etag: str, cache_control: str = CACHE_CONTROL) -> Response:
+    """304（本文を作らない・シリアライズしない）"""
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def cached_json(body: bytes, etag: str, cache_control: str = CACHE_CONTROL) -> Response:
+    """シリアライズ済みのバイト列をそのまま返す（jsonable_encoder・JSONResponse のエンコードを通さない）"""
+    return Response(
+        content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": cache_control},
+    )
+
+
+def with_etag(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+
+# ===== 投稿一覧のページング・ストリーミング =====
+
+NDJSON = "application/x-ndjson"
+# 1ページの件数（limit のデフォルトと上限）
+POSTS_PAGE_SIZE = 100
+POSTS_MAX_PAGE_SIZE = 1000
+# ストリーミング時にストレージから一度に読む件数
+POSTS_STREAM_CHUNK = 500
+
+
+def prefers_ndjson(accept: str) -> bool:
+    """Accept ヘッダーで application/json より NDJSON を優先するか（Flask 版の best_match と同じ判定）
+
+    それぞれのメディアタイプに最も具体的に一致する範囲の q を比べ、同じなら一致した範囲が具体的な方、それも同じなら JSON
+    （q=0 は受け付けない。"application/x-ndjson;q=0" や "*/*" では JSON を返す）
+    """
+    # (q, 具体性) の最大。具体性は type/subtype = 2、type/* = 1、*/* = 0
+    matches = {"application/json": (0.0, -1), NDJSON: (0.0, -1)}
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        for offer, (best_quality, best_specificity) in matches.items():
+            if media_type == offer:
+                specificity = 2
+            elif media_type == offer.split("/")[0] + "/*":
+                specificity = 1
+            elif media_type == "*/*":
+                specificity = 0
+            else:
+                continue
+            if specificity > best_specificity:
+                matches[offer] = (quality, specificity)
+    ndjson, json_ = matches[NDJSON], matches["application/json"]
+    return ndjson[0] > 0 and ndjson > json_
+
+
+async def stream_posts(fetch, after: Optional[int], limit: Optional[int]):
+    """fetch(after, 件数) で投稿を POSTS_STREAM_CHUNK 件ずつ読んで NDJSON の行を返す（投稿数によらずメモリは一定）"""
+    while limit is None or limit > 0:
+        chunk = POSTS_STREAM_CHUNK if limit is None else min(POSTS_STREAM_CHUNK, limit)
+        posts = await fetch(after, chunk)
+        for post in posts:
+            yield json.dumps(post) + "\n"
+        if len(posts) < chunk:
+            return
+        after = posts[-1]["id"]
+        if limit is not None:
+            limit -= len(posts)
+
+
 # ===== リソースサーバーのエンドポイント =====
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     アクセストークンを検証する依存関数
     """
     token = credentials.credentials
-    token_data = storage.access_tokens.get(token)
+
+    # 署名付き JWT はストレージを引かずにローカルで検証
+    if token.count(".") == 2:
+        token_data = await decode_jwt_token(token)
+        if not token_data:
+            raise HTTPException(status_code=401, detail="Invalid access token")
+        return token_data
+
+    token_data = await storage.get_access_token(token)
 
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid access token")
 
     # 有効期限チェック
     if datetime.now() > token_data["expires_at"]:
-        del storage.access_tokens[token]
+        await storage.delete_access_token(token)
         raise HTTPException(status_code=401, detail="Access token expired")
 
     return token_data
 
 
+async def verify_token_remote(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    認可サーバーの /introspect でアクセストークンを検証する依存関数
+    """
+    try:
+        result = await introspection_validator.introspect(credentials.credentials)
+    except IntrospectionError:
+        # トークンが無効とは限らないので 401 にしない（クライアントに再ログインさせない）
+        raise HTTPException(
+            status_code=503, detail="Token introspection failed", headers=INTROSPECTION_UNAVAILABLE_HEADERS,
+        )
+    if not result.get("active"):
+        raise HTTPException(
+            status_code=401, detail="Invalid access token", headers={"WWW-Authenticate": 'Bearer error="invalid_token"'},
+        )
+
+    return {
+        "username": result["username"],
+        "client_id": result["client_id"],
+        "scope": result.get("scope", ""),
+        "expires_at": datetime.fromtimestamp(result["exp"]),
+    }
+
+
+# /api/* で使うトークン検証（リソースサーバー単独運用時はイントロスペクション）
+token_dependency = verify_token_remote if introspection_validator else verify_token
+
+
 @app.get("/api/me")
-async def get_user_info(token_data: dict = Depends(verify_token)):
+async def get_user_info(request: Request, token_data: dict = Depends(token_dependency)):
     """
     保護されたAPIエンドポイント
     アクセストークンで認証されたユーザー情報を返す
     """
     username = token_data["username"]
-    user = storage.users.get(username)
-
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    return {
-        "username": username,
-        "name": user["name"],
-        "email": user["email"],
-    }
+    # バージョンはデータより先に読む（後に読むと、新しい ETag で古い本文を返すことがある）
+    version = await storage.get_user_version(username)
+    etag = make_etag("me", username, version)
+    if if_none_match(request, etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("me", username, version)
+    if body is None:
+        user = await storage.get_user(username)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        body = response_cache.put("me", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
 
 @app.get("/api/profile")
-async def get_user_profile(token_data: dict = Depends(verify_token)):
+async def get_user_profile(request: Request, token_data: dict = Depends(token_dependency)):
     """
     ユーザープロフィール取得
     """
     username = token_data["username"]
-    user = storage.users.get(username)
+    version = await storage.get_user_version(username)
+    etag = make_etag("profile", username, version)
+    if if_none_match(request, etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("profile", username, version)
+    if body is None:
+        user = await storage.get_user(username)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        body = response_cache.put("profile", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+            "bio": user.get("bio", ""),
+            "location": user.get("location", ""),
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
 
+@app.get("/api/posts")
+async def get_user_posts(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=POSTS_MAX_PAGE_SIZE),
+    after: Optional[int] = Query(None, ge=INT64_MIN, le=INT64_MAX),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    token_data: dict = Depends(token_dependency),
+):
+    """
+    ユーザーの投稿一覧を取得（カーソルページング）
+
+    - limit: 件数（デフォルト POSTS_PAGE_SIZE、最大 POSTS_MAX_PAGE_SIZE）
+    - after: 前のページの next_cursor（この id の投稿より後を返す）
+    - since・until: created_at の範囲（エポック秒または ISO 8601、since を含み until を含まない）
+      指定すると created_at 順（索引の二分探索で範囲を求める）、省略すると id 順
+    - Accept: application/x-ndjson なら1行1件でストリーミングする（limit を省略するとすべて）
+    """
+    username = token_data["username"]
+    try:
+        since_epoch, until_epoch = (None if value is None else parse_timestamp(value) for value in (since, until))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid since/until")
+
+    if since_epoch is None and until_epoch is None:
+        async def fetch(after, count):
+            return await storage.get_posts_page(username, after, count)
+    else:
+        async def fetch(after, count):
+            return await storage.get_posts_range(username, since_epoch, until_epoch, after, count)
+
+    if prefers_ndjson(request.headers.get("accept", "")):
+        # ページを読みながら返すため、途中で投稿が追加されることがある（ETag は付けない）
+        return StreamingResponse(
+            stream_posts(fetch, after, limit), media_type=NDJSON, headers={"Cache-Control": CACHE_CONTROL},
+        )
+
+    etag = make_etag("posts", username, await storage.get_posts_version(username))
+    if if_none_match(request, etag):
+        return not_modified(etag)
+    limit = limit or POSTS_PAGE_SIZE
+    # 1件多く読んで次のページがあるかを判定する
+    posts = await fetch(after, limit + 1)
+    next_cursor = posts[limit - 1]["id"] if len(posts) > limit else None
+
+    with_etag(response, etag)
     return {
         "username": username,
-        "name": user["name"],
-        "email": user["email"],
-        "bio": user.get("bio", ""),
-        "location": user.get("location", ""),
+        "posts": posts[:limit],
+        # ユーザーの投稿数（ページの件数ではない。続きがあるかは next_cursor で判定する）
+        "total": await storage.count_posts(username),
+        "next_cursor": next_cursor,
     }
 
 
-@app.get("/api/posts")
-async def get_user_posts(token_data: dict = Depends(verify_token)):
+@app.get("/api/posts/{post_id}")
+async def get_user_post(post_id: int, request: Request, response: Response, token_data: dict = Depends(token_dependency)):
     """
-    ユーザーの投稿一覧を取得
+    投稿を取得（id のハッシュで引く）
     """
     username = token_data["username"]
-    posts = storage.posts.get(username, [])
+    etag = make_etag(f"post{post_id}", username, await storage.get_posts_version(username))
+    if if_none_match(request, etag):
+        return not_modified(etag)
+    # SQLite に渡せない id は存在しない投稿として扱う
+    post = await storage.get_post(username, post_id) if in_int64_range(post_id) else None
 
-    return {
-        "username": username,
-        "posts": posts,
-        "total": len(posts),
-    }
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+
+    with_etag(response, etag)
+    return post
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    運用メトリクス（ライブエントリ数とスイープコスト）
+    """
+    stats = await storage.stats()
+    stats["client_secret_cache"] = passwords.credential_cache.stats()
+    stats["response_cache"] = response_cache.stats()
+    stats["rate_limit"] = rate_limiter.stats()
+    if introspection_validator:
+        stats["introspection"] = introspection_validator.stats()
+    return stats
 
 
 @app.get("/")
@@ -247,10 +813,14 @@ async def root():
         "endpoints": {
             "authorize": "/authorize",
             "token": "/token",
+            "introspection": "/introspect",
+            "revocation": "/revoke",
             "user_info": "/api/me",
             "user_profile": "/api/profile",
             "user_posts": "/api/posts",
+            "user_post": "/api/posts/{post_id}",
         },
+        "supported_grant_types": ["authorization_code", "refresh_token"],
     }
 
 
@@ -0,0 +1,126 @@
+"""
+クライアントのセッションストア（TTL 付き LRU）
+
+session_id -> セッションの dict を保持する。すべての操作は O(1)
+
+- エントリごとに有効期限を持ち、期限切れのものは読まない（Cookie の max_age と同じ TTL を渡す）
+  extend で期限を延ばせる（Cookie を再発行するときに同じだけ延ばす）
+- maxsize 件を超えたら最も長く使われていないセッションから捨てる（メモリの上限）
+- 期限切れのエントリは run_sweeper で定期的に削除する
+  TTL ごとに作成（延長）順の OrderedDict を持つ。同じ TTL なら作成順と期限順が一致するので、先頭から期限切れを取り出せる
+
+イベントループ内でのみ使う（スレッドセーフではない）
+
+環境変数:
+- SESSION_STORE_SIZE: 保持するセッション数の上限（デフォルト 10000）
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """TTL 付き LRU のセッションストア"""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = int(os.environ.get("SESSION_STORE_SIZE", "10000")) if maxsize is None else maxsize
+        # session_id -> (セッション, 有効期限, TTL)。LRU 順（末尾が最近使われたもの）
+        self._entries = OrderedDict()
+        # TTL -> 作成（延長）順の session_id（値は有効期限）
+        self._by_ttl = {}
+        self.evictions = 0
+        self.expirations = 0
+
+    def set(self, session_id, data, ttl, now=None):
+        """セッションを保存（同じ session_id があれば置き換え、有効期限を now + ttl にする）"""
+        now = time.time() if now is None else now
+        self._remove(session_id)
+        expires_at = now + ttl
+        self._entries[session_id] = (data, expires_at, ttl)
+        self._by_ttl.setdefault(ttl, OrderedDict())[session_id] = expires_at
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, session_id, now=None, touch=True):
+        """有効なセッションの dict（なければ None）。dict を書き換えるとそのまま保存される
+
+        touch=False なら LRU の順序を変えない（バックグラウンドの処理が使ってもセッションを延命しない）
+        """
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        if entry[1] <= (time.time() if now is None else now):
+            self._remove(session_id)
+            self.expirations += 1
+            return None
+        if touch:
+            self._entries.move_to_end(session_id)
+        return entry[0]
+
+    def extend(self, session_id, ttl, now=None):
+        """有効なセッションの有効期限を now + ttl に延ばす（LRU の順序は変えない）。延ばしたら True"""
+        now = time.time() if now is None else now
+        entry = self._entries.get(session_id)
+        if entry is None or entry[1] <= now:
+            return False
+        expires_at = now + ttl
+        self._entries[session_id] = (entry[0], expires_at, ttl)
+        if ttl != entry[2]:
+            del self._by_ttl[entry[2]][session_id]
+        # 同じ TTL の中では最も遅い期限になるので末尾に移す（作成順 = 期限順を保つ）
+        queue = self._by_ttl.setdefault(ttl, OrderedDict())
+        queue[session_id] = expires_at
+        queue.move_to_end(session_id)
+        return True
+
+    def pop(self, session_id):
+        """セッションを削除して返す（なければ None）"""
+        entry = self._remove(session_id)
+        return entry[0] if entry else None
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            del self._by_ttl[entry[2]][session_id]
+        return entry
+
+    def sweep(self, batch_size=1000, now=None):
+        """期限切れのセッションを最大 batch_size 件削除し、削除した数を返す"""
+        now = time.time() if now is None else now
+        removed = 0
+        for queue in self._by_ttl.values():
+            while queue and removed < batch_size:
+                session_id, expires_at = next(iter(queue.items()))
+                if expires_at > now:
+                    break
+                self._remove(session_id)
+                removed += 1
+        self.expirations += removed
+        return removed
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+async def run_sweeper(store, interval=30.0, batch_size=1000):
+    """期限切れのセッションを定期的に削除する asyncio タスク（1回の削除件数を batch_size に抑える）"""
+    while True:
+        if store.sweep(batch_size) == batch_size:
+            # 削除しきれなかった場合は他のタスクに譲ってから続行
+            await asyncio.sleep(0)
+            continue
+        await asyncio.sleep(interval)
@@ -0,0 +1,577 @@
+"""
+OAuth 2.0 ストレージ（SQLite 実装）
+
+- WAL モードで複数プロセスから同じDBファイルを共有できる
+- SQL は定数にして sqlite3 のステートメントキャッシュ（プリペアドステートメント）を再利用する
+- expires_at に索引を張り、期限切れの削除は索引のレンジスキャンで行う
+- 書き込みはすべてすぐにコミットする（他のプロセスから見える前にレスポンスを返さない）。
+  以前はリフレッシュトークンの削除だけをまとめてコミットしていたが、別のワーカーから削除済みの
+  トークンが見えるうえ、まとめる対象がほかにないのでやめた
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from expiry import SweepStats
+from passwords import hash_password
+from post_index import parse_timestamp
+from storage import DEMO_CLIENTS, DEMO_USERS, DEMO_POSTS
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    client_id TEXT PRIMARY KEY,
+    client_secret TEXT NOT NULL,  -- scrypt のハッシュ（passwords.py）
+    redirect_uris TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,  -- scrypt のハッシュ（passwords.py）
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    bio TEXT NOT NULL,
+    location TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,  -- 更新のたびに増える（ETag に使う）
+    posts_version INTEGER NOT NULL DEFAULT 1  -- 投稿を追加するたびに増える
+);
+CREATE TABLE IF NOT EXISTS posts (
+    username TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    created_epoch INTEGER NOT NULL DEFAULT 0,  -- created_at のエポック秒（範囲検索用）
+    PRIMARY KEY (username, id)
+);
+CREATE TABLE IF NOT EXISTS auth_codes (
+    code TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    redirect_uri TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_auth_codes_expires_at ON auth_codes (expires_at);
+CREATE TABLE IF NOT EXISTS access_tokens (
+    token TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    family_id TEXT,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_access_tokens_expires_at ON access_tokens (expires_at);
+CREATE INDEX IF NOT EXISTS idx_access_tokens_username ON access_tokens (username);
+CREATE INDEX IF NOT EXISTS idx_access_tokens_client_id ON access_tokens (client_id);
+CREATE TABLE IF NOT EXISTS refresh_tokens (
+    token TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    family_id TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires_at ON refresh_tokens (expires_at);
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_username ON refresh_tokens (username);
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_client_id ON refresh_tokens (client_id);
+CREATE TABLE IF NOT EXISTS revoked_families (
+    family_id TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_revoked_families_expires_at ON revoked_families (expires_at);
+"""
+
+SELECT_CLIENT = "SELECT client_secret, redirect_uris FROM clients WHERE client_id = ?"
+SELECT_USER = "SELECT password, name, email, bio, location FROM users WHERE username = ?"
+SELECT_PLAINTEXT_PASSWORDS = "SELECT username, password FROM users WHERE password NOT LIKE 'scrypt$%'"
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?"
+SELECT_PLAINTEXT_CLIENT_SECRETS = "SELECT client_id, client_secret FROM clients WHERE client_secret NOT LIKE 'scrypt$%'"
+UPDATE_CLIENT_SECRET = "UPDATE clients SET client_secret = ? WHERE client_id = ?"
+SELECT_POSTS = "SELECT id, title, content, created_at FROM posts WHERE username = ? ORDER BY id"
+# 主キー (username, id) の索引をレンジスキャンする（LIMIT -1 は上限なし）
+SELECT_POSTS_PAGE = (
+    "SELECT id, title, content, created_at FROM posts WHERE username = ? AND id > ? ORDER BY id LIMIT ?"
+)
+SELECT_USER_VERSION = "SELECT version FROM users WHERE username = ?"
+SELECT_POSTS_VERSION = "SELECT posts_version FROM users WHERE username = ?"
+INSERT_POST = (
+    "INSERT OR REPLACE INTO posts (username, id, title, content, created_at, created_epoch) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SELECT_POST = "SELECT id, title, content, created_at FROM posts WHERE username = ? AND id = ?"
+# 主キー (username, id) の索引だけで数える
+COUNT_POSTS = "SELECT COUNT(*) FROM posts WHERE username = ?"
+# (username, created_epoch, id) の索引をレンジスキャンする
+# カーソル（前のページの最後の投稿）より後は (created_epoch, id) の行値で比較する
+SELECT_POSTS_RANGE = (
+    "SELECT id, title, content, created_at FROM posts "
+    "WHERE username = ?1 AND created_epoch >= ?2 AND created_epoch < ?3 "
+    "ORDER BY created_epoch, id LIMIT ?4"
+)
+SELECT_POSTS_RANGE_AFTER = (
+    "SELECT id, title, content, created_at FROM posts "
+    "WHERE username = ?1 AND created_epoch >= ?2 AND created_epoch < ?3 "
+    "AND (created_epoch, id) > (SELECT created_epoch, id FROM posts WHERE username = ?1 AND id = ?5) "
+    "ORDER BY created_epoch, id LIMIT ?4"
+)
+# since・until を省略したときの範囲
+MIN_EPOCH = -(1 << 62)
+MAX_EPOCH = 1 << 62
+BUMP_POSTS_VERSION = "UPDATE users SET posts_version = posts_version + 1 WHERE username = ?"
+# update_user で更新できる列
+USER_FIELDS = ("name", "email", "bio", "location")
+
+INSERT_AUTH_CODE = (
+    "INSERT OR REPLACE INTO auth_codes (code, client_id, redirect_uri, scope, username, expires_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SELECT_AUTH_CODE = (
+    "SELECT client_id, redirect_uri, scope, username, expires_at FROM auth_codes WHERE code = ?"
+)
+DELETE_AUTH_CODE = "DELETE FROM auth_codes WHERE code = ?"
+
+INSERT_ACCESS_TOKEN = (
+    "INSERT OR REPLACE INTO access_tokens (token, client_id, scope, username, family_id, expires_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+# 失効したファミリーのトークンは主キー引きの NOT EXISTS で除外する
+SELECT_ACCESS_TOKEN = (
+    "SELECT client_id, scope, username, family_id, expires_at FROM access_tokens AS t WHERE token = ? "
+    "AND NOT EXISTS (SELECT 1 FROM revoked_families AS r WHERE r.family_id = t.family_id)"
+)
+DELETE_ACCESS_TOKEN = "DELETE FROM access_tokens WHERE token = ?"
+
+INSERT_REFRESH_TOKEN = (
+    "INSERT OR REPLACE INTO refresh_tokens (token, client_id, scope, username, family_id, used, expires_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SELECT_REFRESH_TOKEN = (
+    "SELECT client_id, scope, username, family_id, used, expires_at FROM refresh_tokens WHERE token = ?"
+)
+MARK_REFRESH_TOKEN_USED = "UPDATE refresh_tokens SET used = 1 WHERE token = ? AND used = 0"
+DELETE_REFRESH_TOKEN = "DELETE FROM refresh_tokens WHERE token = ?"
+
+INSERT_REVOKED_FAMILY = (
+    "INSERT OR REPLACE INTO revoked_families (family_id, expires_at) VALUES (?, ?)"
+)
+SELECT_REVOKED_FAMILY = "SELECT 1 FROM revoked_families WHERE family_id = ?"
+
+
+def _revoke_by(column):
+    """username / client_id の索引で対象のトークンだけを失効する SQL"""
+    return (
+        # リフレッシュトークンのファミリーを失効（同じファミリーの JWT なども無効になる）
+        "INSERT OR REPLACE INTO revoked_families (family_id, expires_at) "
+        f"SELECT family_id, MAX(expires_at) FROM refresh_tokens WHERE {column} = ? GROUP BY family_id",
+        f"DELETE FROM access_tokens WHERE {column} = ?",
+        f"DELETE FROM refresh_tokens WHERE {column} = ?",
+    )
+
+
+REVOKE_USER_TOKENS = _revoke_by("username")
+REVOKE_CLIENT_TOKENS = _revoke_by("client_id")
+
+# 期限切れの削除（expires_at の索引を使って古い順に最大 N 件）
+SWEEP_AUTH_CODES = (
+    "DELETE FROM auth_codes WHERE code IN "
+    "(SELECT code FROM auth_codes WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)"
+)
+SWEEP_ACCESS_TOKENS = (
+    "DELETE FROM access_tokens WHERE token IN "
+    "(SELECT token FROM access_tokens WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)"
+)
+SWEEP_REFRESH_TOKENS = (
+    "DELETE FROM refresh_tokens WHERE token IN "
+    "(SELECT token FROM refresh_tokens WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)"
+)
+SWEEP_REVOKED_FAMILIES = (
+    "DELETE FROM revoked_families WHERE family_id IN "
+    "(SELECT family_id FROM revoked_families WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)"
+)
+SWEEPS = (SWEEP_AUTH_CODES, SWEEP_ACCESS_TOKENS, SWEEP_REFRESH_TOKENS, SWEEP_REVOKED_FAMILIES)
+HAS_EXPIRED = (
+    "SELECT EXISTS (SELECT 1 FROM auth_codes WHERE expires_at <= ?1) "
+    "OR EXISTS (SELECT 1 FROM access_tokens WHERE expires_at <= ?1) "
+    "OR EXISTS (SELECT 1 FROM refresh_tokens WHERE expires_at <= ?1) "
+    "OR EXISTS (SELECT 1 FROM revoked_families WHERE expires_at <= ?1)"
+)
+
+
+class SQLiteStorage:
+    """SQLite（WAL）ストレージ"""
+
+    # ファイル I/O でブロックする（async_storage.py はスレッドで実行する）
+    blocking_io = True
+
+    def __init__(self, path):
+        self.path = path
+
+        self._conn = sqlite3.connect(
+            path,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._seed()
+
+        # 1つのコネクションを複数スレッドで共有するためのロック
+        self._lock = threading.RLock()
+        self.commits = 0
+        self.sweep_stats = SweepStats()
+
+    def _migrate(self):
+        """旧スキーマの DB ファイルを移行
+
+        family_id・バージョン・created_epoch 列の追加、平文パスワード・クライアントシークレットのハッシュ化
+        """
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(posts)")]
+        if "created_epoch" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE posts ADD COLUMN created_epoch INTEGER NOT NULL DEFAULT 0")
+                rows = self._conn.execute("SELECT username, id, created_at FROM posts").fetchall()
+                self._conn.executemany(
+                    "UPDATE posts SET created_epoch = ? WHERE username = ? AND id = ?",
+                    [(parse_timestamp(created_at), username, post_id) for username, post_id, created_at in rows],
+                )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_posts_created_epoch ON posts (username, created_epoch, id)"
+        )
+
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(users)")]
+        for column in ("version", "posts_version"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 1")
+                self._conn.commit()
+
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(access_tokens)")]
+        if "family_id" not in columns:
+            self._conn.execute("ALTER TABLE access_tokens ADD COLUMN family_id TEXT")
+            self._conn.commit()
+
+        rows = self._conn.execute(SELECT_PLAINTEXT_PASSWORDS).fetchall()
+        if rows:
+            with self._conn:
+                for username, password in rows:
+                    self._conn.execute(UPDATE_PASSWORD, (hash_password(password), username))
+
+        rows = self._conn.execute(SELECT_PLAINTEXT_CLIENT_SECRETS).fetchall()
+        if rows:
+            with self._conn:
+                for client_id, client_secret in rows:
+                    self._conn.execute(UPDATE_CLIENT_SECRET, (hash_password(client_secret), client_id))
+
+    def _seed(self):
+        """デモデータを投入（既存の行は上書きしない）"""
+        with self._conn:
+            for client_id, client in DEMO_CLIENTS.items():
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO clients VALUES (?, ?, ?)",
+                    (client_id, client["client_secret_hash"], json.dumps(client["redirect_uris"])),
+                )
+            for username, user in DEMO_USERS.items():
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password, name, email, bio, location) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (username, user["password_hash"], user["name"], user["email"], user["bio"], user["location"]),
+                )
+            for username, posts in DEMO_POSTS.items():
+                for post in posts:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO posts VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            username, post["id"], post["title"], post["content"], post["created_at"],
+                            parse_timestamp(post["created_at"]),
+                        ),
+                    )
+
+    # ===== コミット制御 =====
+
+    def _write(self, sql, params):
+        """書き込みを実行してすぐにコミット（認可コード・トークンの発行と失効）
+
+        別のワーカーに届いた次のリクエスト（コードの交換・トークンの検証）から見えるようにする
+        """
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self.commits += 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _fetchone(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    # ===== クライアント・ユーザー・投稿 =====
+
+    def get_client(self, client_id):
+        row = self._fetchone(SELECT_CLIENT, (client_id,))
+        if row is None:
+            return None
+        return {"client_secret_hash": row[0], "redirect_uris": json.loads(row[1])}
+
+    def get_user(self, username):
+        row = self._fetchone(SELECT_USER, (username,))
+        if row is None:
+            return None
+        return {"password_hash": row[0], "name": row[1], "email": row[2], "bio": row[3], "location": row[4]}
+
+    def get_posts(self, username):
+        with self._lock:
+            rows = self._conn.execute(SELECT_POSTS, (username,)).fetchall()
+        return [
+            {"id": row[0], "title": row[1], "content": row[2], "created_at": row[3]}
+            for row in rows
+        ]
+
+    def get_posts_page(self, username, after, limit):
+        params = (username, -1 if after is None else after, -1 if limit is None else limit)
+        with self._lock:
+            rows = self._conn.execute(SELECT_POSTS_PAGE, params).fetchall()
+        return [
+            {"id": row[0], "title": row[1], "content": row[2], "created_at": row[3]}
+            for row in rows
+        ]
+
+    def get_posts_range(self, username, since, until, after, limit):
+        params = [
+            username,
+            MIN_EPOCH if since is None else since,
+            MAX_EPOCH if until is None else until,
+            -1 if limit is None else limit,
+        ]
+        sql = SELECT_POSTS_RANGE
+        if after is not None:
+            sql = SELECT_POSTS_RANGE_AFTER
+            params.append(after)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            {"id": row[0], "title": row[1], "content": row[2], "created_at": row[3]}
+            for row in rows
+        ]
+
+    def get_post(self, username, post_id):
+        row = self._fetchone(SELECT_POST, (username, post_id))
+        if row is None:
+            return None
+        return {"id": row[0], "title": row[1], "content": row[2], "created_at": row[3]}
+
+    def count_posts(self, username):
+        return self._fetchone(COUNT_POSTS, (username,))[0]
+
+    def get_user_version(self, username):
+        row = self._fetchone(SELECT_USER_VERSION, (username,))
+        return row[0] if row else 0
+
+    def get_posts_version(self, username):
+        row = self._fetchone(SELECT_POSTS_VERSION, (username,))
+        return row[0] if row else 0
+
+    def update_user(self, username, fields):
+        """ユーザー情報（USER_FIELDS の列）を更新してバージョンを上げる（すぐにコミットする）"""
+        columns = [column for column in USER_FIELDS if column in fields]
+        assignments = "".join(f"{column} = ?, " for column in columns)
+        sql = f"UPDATE users SET {assignments}version = version + 1 WHERE username = ?"
+        with self._lock:
+            self._conn.execute(sql, [fields[column] for column in columns] + [username])
+            self._commit()
+
+    def add_post(self, username, post):
+        """投稿を追加して投稿一覧のバージョンを上げる（すぐにコミットする）"""
+        with self._lock:
+            self._conn.execute(INSERT_POST, (
+                username, post["id"], post["title"], post["content"], post["created_at"],
+                parse_timestamp(post["created_at"]),
+            ))
+            self._conn.execute(BUMP_POSTS_VERSION, (username,))
+            self._commit()
+
+    # ===== 認可コード =====
+
+    def save_auth_code(self, code, data):
+        self._write(INSERT_AUTH_CODE, (
+            code,
+            data["client_id"],
+            data["redirect_uri"],
+            data["scope"],
+            data["username"],
+            data["expires_at"].timestamp(),
+        ))
+
+    def get_auth_code(self, code):
+        row = self._fetchone(SELECT_AUTH_CODE, (code,))
+        if row is None:
+            return None
+        return {
+            "client_id": row[0],
+            "redirect_uri": row[1],
+            "scope": row[2],
+            "username": row[3],
+            "expires_at": datetime.fromtimestamp(row[4]),
+        }
+
+    def delete_auth_code(self, code):
+        self._write(DELETE_AUTH_CODE, (code,))
+
+    def pop_auth_code_if_valid(self, code, is_valid):
+        """検証と削除を1つのロック内で行い、削除できた場合だけ返す
+
+        別のプロセスが先に削除していれば rowcount が 0 になる
+        """
+        with self._lock:
+            data = self.get_auth_code(code)
+            if data is None or not is_valid(data):
+                return None
+            deleted = self._conn.execute(DELETE_AUTH_CODE, (code,)).rowcount
+            # 他のプロセスからも削除済みに見えるよう、すぐにコミットする
+            self._commit()
+        return data if deleted else None
+
+    # ===== アクセストークン =====
+
+    def save_access_token(self, token, data):
+        self._write(INSERT_ACCESS_TOKEN, (
+            token,
+            data["client_id"],
+            data["scope"],
+            data["username"],
+            data.get("family_id"),
+            data["expires_at"].timestamp(),
+        ))
+
+    def get_access_token(self, token):
+        row = self._fetchone(SELECT_ACCESS_TOKEN, (token,))
+        if row is None:
+            return None
+        return {
+            "client_id": row[0],
+            "scope": row[1],
+            "username": row[2],
+            "family_id": row[3],
+            "expires_at": datetime.fromtimestamp(row[4]),
+        }
+
+    def delete_access_token(self, token):
+        self._write(DELETE_ACCESS_TOKEN, (token,))
+
+    # ===== リフレッシュトークン =====
+
+    def save_refresh_token(self, token, data):
+        self._write(INSERT_REFRESH_TOKEN, (
+            token,
+            data["client_id"],
+            data["scope"],
+            data["username"],
+            data["family_id"],
+            int(data.get("used", False)),
+            data["expires_at"].timestamp(),
+        ))
+
+    def get_refresh_token(self, token):
+        row = self._fetchone(SELECT_REFRESH_TOKEN, (token,))
+        if row is None:
+            return None
+        return {
+            "client_id": row[0],
+            "scope": row[1],
+            "username": row[2],
+            "family_id": row[3],
+            "used": bool(row[4]),
+            "expires_at": datetime.fromtimestamp(row[5]),
+        }
+
+    def mark_refresh_token_used(self, token):
+        # used = 0 の行だけを更新する（別のプロセスが先に使用済みにしていれば rowcount が 0）
+        # 再利用の検出に使うため、他のプロセスから見えるようすぐにコミットする
+        with self._lock:
+            marked = self._conn.execute(MARK_REFRESH_TOKEN_USED, (token,)).rowcount
+            self._commit()
+        return marked == 1
+
+    # ===== トークンファミリーの失効 =====
+
+    def revoke_family(self, family_id, expires_at):
+        with self._lock:
+            self._conn.execute(INSERT_REVOKED_FAMILY, (family_id, expires_at.timestamp()))
+            self._commit()
+
+    def is_family_revoked(self, family_id):
+        return self._fetchone(SELECT_REVOKED_FAMILY, (family_id,)) is not None
+
+    def is_bulk_revoked(self, username, client_id, issued_at):
+        # 一括失効はリフレッシュトークンのファミリーの失効として記録する
+        return False
+
+    # ===== 失効 =====
+
+    def delete_refresh_token(self, token):
+        self._write(DELETE_REFRESH_TOKEN, (token,))
+
+    def _revoke(self, statements, owner):
+        with self._lock:
+            revoke_families, delete_access_tokens, delete_refresh_tokens = statements
+            self._conn.execute(revoke_families, (owner,))
+            revoked = self._conn.execute(delete_access_tokens, (owner,)).rowcount
+            revoked += self._conn.execute(delete_refresh_tokens, (owner,)).rowcount
+            self._commit()
+        return revoked
+
+    def revoke_user_tokens(self, username):
+        """ユーザーのトークンをすべて失効（username の索引を使う）"""
+        return self._revoke(REVOKE_USER_TOKENS, username)
+
+    def revoke_client_tokens(self, client_id):
+        """クライアントのトークンをすべて失効（client_id の索引を使う）"""
+        return self._revoke(REVOKE_CLIENT_TOKENS, client_id)
+
+    # ===== 期限切れの削除 =====
+
+    def has_expired(self, now):
+        return bool(self._fetchone(HAS_EXPIRED, (now,))[0])
+
+    def sweep_expired(self, max_batch=1000):
+        """期限切れのエントリを最大 max_batch 件削除"""
+        start = time.perf_counter()
+        now = time.time()
+
+        with self._lock:
+            removed = 0
+            for sql in SWEEPS:
+                if removed >= max_batch:
+                    break
+                removed += self._conn.execute(sql, (now, max_batch - removed)).rowcount
+            self._commit()
+
+        self.sweep_stats.record(removed, (time.perf_counter() - start) * 1000)
+        return removed
+
+    def stats(self):
+        """ライブエントリ数とスイープコスト"""
+        with self._lock:
+            live_auth_codes = self._conn.execute("SELECT COUNT(*) FROM auth_codes").fetchone()[0]
+            live_access_tokens = self._conn.execute("SELECT COUNT(*) FROM access_tokens").fetchone()[0]
+            live_refresh_tokens = self._conn.execute("SELECT COUNT(*) FROM refresh_tokens").fetchone()[0]
+            revoked_families = self._conn.execute("SELECT COUNT(*) FROM revoked_families").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "live_auth_codes": live_auth_codes,
+            "live_access_tokens": live_access_tokens,
+            "live_refresh_tokens": live_refresh_tokens,
+            "revoked_families": revoked_families,
+            "commits": self.commits,
+            "sweep": self.sweep_stats.as_dict(),
+        }
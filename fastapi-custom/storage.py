@@ -1,59 +1,386 @@
 """
-OAuth 2.0 ストレージ（インメモリ実装）
+OAuth 2.0 ストレージ
 
-本番環境ではDBを使用すること
+server.py はバックエンドプロトコル（StorageBackend）経由でのみデータにアクセスする
+環境変数 STORAGE_BACKEND でバックエンドを切り替える
+
+- memory: インメモリ実装（デフォルト、再起動でデータは消える）
+- sqlite: SQLite（WAL）実装（sqlite_storage.py、複数プロセスで共有可能）
+- shm: 共有メモリ実装（shm_storage.py、同一ホストの複数ワーカーで共有可能）
 """
 
+import copy
+import os
+import time
+from datetime import datetime
+from typing import Callable, Optional, Protocol
+
+from expiry import ExpiryIndex, SweepStats
+from passwords import hash_password
+from post_index import PostIndex
+from records import AuthCodeRecord, AccessTokenRecord, RefreshTokenRecord, to_epoch
+
+
+# ===== デモデータ =====
+
+# クライアント情報
+DEMO_CLIENTS = {
+    "demo-client-id": {
+        "client_secret_hash": hash_password("demo-client-secret"),
+        "redirect_uris": ["http://localhost:5001/callback"],
+    }
+}
+
+# ユーザー情報（簡易的なユーザーDB）
+DEMO_USERS = {
+    "demo-user": {
+        "password_hash": hash_password("demo-password"),
+        "name": "Demo User",
+        "email": "demo@example.com",
+        "bio": "OAuth 2.0 デモユーザーです",
+        "location": "Tokyo, Japan",
+    }
+}
+
+# サンプルデータ（投稿）
+DEMO_POSTS = {
+    "demo-user": [
+        {
+            "id": 1,
+            "title": "OAuth 2.0 入門",
+            "content": "OAuth 2.0 認可コードフローについて学びました。",
+            "created_at": "2025-10-01T10:00:00Z",
+        },
+        {
+            "id": 2,
+            "title": "FastAPI で OAuth サーバー構築",
+            "content": "FastAPI を使って認可サーバーを実装しました。",
+            "created_at": "2025-10-02T15:30:00Z",
+        },
+        {
+            "id": 3,
+            "title": "アクセストークンの管理",
+            "content": "トークンの有効期限管理について理解が深まりました。",
+            "created_at": "2025-10-03T09:15:00Z",
+        },
+    ]
+}
+
+
+# ===== バックエンドプロトコル =====
+
+class StorageBackend(Protocol):
+    """ストレージバックエンドが実装するインターフェース
+
+    認可コード・アクセストークン・リフレッシュトークンは expires_at（datetime）を含む dict で受け渡す
+    （取得結果は dict と同じキーで読めるオブジェクトの場合がある。memory は records.py のレコード）
+    アクセストークン・リフレッシュトークンは family_id（同じ認可から発行されたトークンの系列）を持つ
+    """
+
+    # クライアント・ユーザー・投稿
+    def get_client(self, client_id: str) -> Optional[dict]: ...
+    def get_user(self, username: str) -> Optional[dict]: ...
+    def get_posts(self, username: str) -> list: ...
+    # id 順に after より後の投稿を最大 limit 件（after・limit が None なら先頭から・すべて）
+    def get_posts_page(self, username: str, after: Optional[int], limit: Optional[int]) -> list: ...
+    # created_at 順に since 以上 until 未満（エポック秒）の投稿を最大 limit 件（after は前のページの最後の投稿の id）
+    def get_posts_range(
+        self, username: str, since: Optional[int], until: Optional[int], after: Optional[int], limit: Optional[int],
+    ) -> list: ...
+    def get_post(self, username: str, post_id: int) -> Optional[dict]: ...
+    def count_posts(self, username: str) -> int: ...
+    # ユーザー・投稿一覧のバージョン（更新のたびに増える。ETag に使う）
+    def get_user_version(self, username: str) -> int: ...
+    def get_posts_version(self, username: str) -> int: ...
+    def update_user(self, username: str, fields: dict) -> None: ...
+    def add_post(self, username: str, post: dict) -> None: ...
+
+    # 認可コード（有効期限10分）
+    def save_auth_code(self, code: str, data: dict) -> None: ...
+    def get_auth_code(self, code: str) -> Optional[dict]: ...
+    def delete_auth_code(self, code: str) -> None: ...
+    # is_valid(認可コード) が真なら取り出して削除（同じコードの同時交換は1つのリクエストだけが成功する）
+    def pop_auth_code_if_valid(self, code: str, is_valid: Callable[[dict], bool]) -> Optional[dict]: ...
+
+    # アクセストークン（有効期限1時間）
+    def save_access_token(self, token: str, data: dict) -> None: ...
+    def get_access_token(self, token: str) -> Optional[dict]: ...
+    def delete_access_token(self, token: str) -> None: ...
+
+    # リフレッシュトークン（有効期限30日、ローテーションで使い捨て）
+    def save_refresh_token(self, token: str, data: dict) -> None: ...
+    def get_refresh_token(self, token: str) -> Optional[dict]: ...
+    # 未使用なら使用済みにして True を返す（同じトークンの同時ローテーションで True を受け取るのは1つだけ）
+    def mark_refresh_token_used(self, token: str) -> bool: ...
+
+    # トークンファミリーの失効（ファミリー内の全トークンを O(1) で無効化）
+    def revoke_family(self, family_id: str, expires_at: datetime) -> None: ...
+    def is_family_revoked(self, family_id: str) -> bool: ...
+    # issued_at に発行されたトークンが一括失効の対象か（ストレージに保存しない JWT 用。
+    # 一括失効をファミリーの失効として記録するバックエンドは常に False）
+    def is_bulk_revoked(self, username: str, client_id: str, issued_at: float) -> bool: ...
 
-class Storage:
-    """インメモリストレージ"""
+    # トークンの失効（ユーザー・クライアント単位は対象のトークンだけを引いて失効、件数を返す）
+    def delete_refresh_token(self, token: str) -> None: ...
+    def revoke_user_tokens(self, username: str) -> int: ...
+    def revoke_client_tokens(self, client_id: str) -> int: ...
+
+    # 期限切れエントリの削除と運用メトリクス
+    def has_expired(self, now: float) -> bool: ...
+    def sweep_expired(self, max_batch: int = 1000) -> int: ...
+    def stats(self) -> dict: ...
+
+
+# ===== インメモリ実装 =====
+
+class MemoryStorage:
+    """インメモリストレージ
+
+    認可コード・トークンは __slots__ のレコード（records.py）に変換して保持する
+    """
 
     def __init__(self):
-        # クライアント情報
-        self.clients = {
-            "demo-client-id": {
-                "client_secret": "demo-client-secret",
-                "redirect_uris": ["http://localhost:5001/callback"],
-            }
-        }
+        self.clients = copy.deepcopy(DEMO_CLIENTS)
+        self.users = copy.deepcopy(DEMO_USERS)
+        # 投稿はユーザーごとの索引（post_index.py。id のハッシュ・id 順・created_at 順）
+        self.posts = {username: PostIndex(posts) for username, posts in copy.deepcopy(DEMO_POSTS).items()}
+        # ユーザー・投稿一覧のバージョン（更新のたびに増える。ETag に使う）
+        self.user_versions = dict.fromkeys(self.users, 1)
+        self.posts_versions = dict.fromkeys(self.posts, 1)
         # 認可コード（有効期限10分）
         self.auth_codes = {}
         # アクセストークン（有効期限1時間）
         self.access_tokens = {}
-        # ユーザー情報（簡易的なユーザーDB）
-        self.users = {
-            "demo-user": {
-                "password": "demo-password",
-                "name": "Demo User",
-                "email": "demo@example.com",
-                "bio": "OAuth 2.0 デモユーザーです",
-                "location": "Tokyo, Japan",
-            }
-        }
-        # サンプルデータ（投稿）
-        self.posts = {
-            "demo-user": [
-                {
-                    "id": 1,
-                    "title": "OAuth 2.0 入門",
-                    "content": "OAuth 2.0 認可コードフローについて学びました。",
-                    "created_at": "2025-10-01T10:00:00Z",
-                },
-                {
-                    "id": 2,
-                    "title": "FastAPI で OAuth サーバー構築",
-                    "content": "FastAPI を使って認可サーバーを実装しました。",
-                    "created_at": "2025-10-02T15:30:00Z",
-                },
-                {
-                    "id": 3,
-                    "title": "アクセストークンの管理",
-                    "content": "トークンの有効期限管理について理解が深まりました。",
-                    "created_at": "2025-10-03T09:15:00Z",
-                },
-            ]
+        # リフレッシュトークン（有効期限30日）
+        self.refresh_tokens = {}
+        # 失効したトークンファミリー（family_id -> 失効情報の有効期限（エポック秒））
+        self.revoked_families = {}
+        # セカンダリインデックス（username / client_id -> {(テーブル名, トークン)}）
+        self.user_index = {}
+        self.client_index = {}
+        # 認可コード・トークン・失効ファミリーの有効期限インデックス
+        self.expiry_index = ExpiryIndex()
+        # スイープの統計情報
+        self.sweep_stats = SweepStats()
+
+    def get_client(self, client_id):
+        return self.clients.get(client_id)
+
+    def get_user(self, username):
+        return self.users.get(username)
+
+    def get_posts(self, username):
+        index = self.posts.get(username)
+        return index.all() if index else []
+
+    def get_posts_page(self, username, after, limit):
+        index = self.posts.get(username)
+        return index.page(after, limit) if index else []
+
+    def get_posts_range(self, username, since, until, after, limit):
+        index = self.posts.get(username)
+        return index.range(since, until, after, limit) if index else []
+
+    def get_post(self, username, post_id):
+        index = self.posts.get(username)
+        return index.get(post_id) if index else None
+
+    def count_posts(self, username):
+        index = self.posts.get(username)
+        return len(index) if index else 0
+
+    def get_user_version(self, username):
+        return self.user_versions.get(username, 0)
+
+    def get_posts_version(self, username):
+        return self.posts_versions.get(username, 0)
+
+    def update_user(self, username, fields):
+        """ユーザー情報を更新してバージョンを上げる
+
+        読み出し中のリクエストが古い値と新しい値を混ぜないよう、dict は置き換える
+        バージョンはデータの後に上げる（先に上げると、新しい ETag で古い本文を返すことがある）
+        """
+        user = self.users.get(username)
+        if user is None:
+            return
+        self.users[username] = {**user, **fields}
+        self.user_versions[username] += 1
+
+    def add_post(self, username, post):
+        """投稿を追加して投稿一覧のバージョンを上げる"""
+        self.posts.setdefault(username, PostIndex()).add(post)
+        self.posts_versions[username] = self.posts_versions.get(username, 0) + 1
+
+    def save_auth_code(self, code, data):
+        """認可コードを保存（有効期限インデックスにも登録）"""
+        record = AuthCodeRecord.from_dict(data)
+        self.auth_codes[code] = record
+        self.expiry_index.push(record.expires, "auth_codes", code)
+
+    def get_auth_code(self, code):
+        return self.auth_codes.get(code)
+
+    def delete_auth_code(self, code):
+        self.auth_codes.pop(code, None)
+
+    def pop_auth_code_if_valid(self, code, is_valid):
+        # イベントループ上で await を挟まずに実行するので、検証と削除の間に他のリクエストは割り込まない
+        data = self.auth_codes.get(code)
+        if data is None or not is_valid(data):
+            return None
+        return self.auth_codes.pop(code)
+
+    def save_access_token(self, token, data):
+        """アクセストークンを保存（有効期限インデックスにも登録）"""
+        record = AccessTokenRecord.from_dict(data)
+        self.access_tokens[token] = record
+        self.expiry_index.push(record.expires, "access_tokens", token)
+        self._index("access_tokens", token, record)
+
+    def get_access_token(self, token):
+        data = self.access_tokens.get(token)
+        # 失効したファミリーのトークンは無効（見つけたら削除）
+        if data and data.family_id in self.revoked_families:
+            self._remove("access_tokens", token)
+            return None
+        return data
+
+    def delete_access_token(self, token):
+        self._remove("access_tokens", token)
+
+    def save_refresh_token(self, token, data):
+        """リフレッシュトークンを保存（有効期限インデックスにも登録）"""
+        record = RefreshTokenRecord.from_dict(data)
+        self.refresh_tokens[token] = record
+        self.expiry_index.push(record.expires, "refresh_tokens", token)
+        self._index("refresh_tokens", token, record)
+
+    def get_refresh_token(self, token):
+        return self.refresh_tokens.get(token)
+
+    def mark_refresh_token_used(self, token):
+        data = self.refresh_tokens.get(token)
+        if data is None or data.used:
+            return False
+        data.used = True
+        return True
+
+    def revoke_family(self, family_id, expires_at):
+        """ファミリーを失効（ファミリー内の最後のトークンが切れるまで保持）"""
+        expires = to_epoch(expires_at)
+        self.revoked_families[family_id] = expires
+        self.expiry_index.push(expires, "revoked_families", family_id)
+
+    def is_family_revoked(self, family_id):
+        return family_id in self.revoked_families
+
+    def is_bulk_revoked(self, username, client_id, issued_at):
+        # 一括失効はリフレッシュトークンのファミリーの失効として記録する
+        return False
+
+    # ===== セカンダリインデックスと一括失効 =====
+
+    def _index(self, table_name, token, entry):
+        key = (table_name, token)
+        self.user_index.setdefault(entry.username, set()).add(key)
+        self.client_index.setdefault(entry.client_id, set()).add(key)
+
+    def _unindex(self, table_name, token, entry):
+        key = (table_name, token)
+        for index, owner in ((self.user_index, entry.username), (self.client_index, entry.client_id)):
+            keys = index.get(owner)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[owner]
+
+    def _remove(self, table_name, token):
+        """トークンを削除してインデックスからも外す"""
+        entry = getattr(self, table_name).pop(token, None)
+        if entry is not None:
+            self._unindex(table_name, token, entry)
+        return entry
+
+    def delete_refresh_token(self, token):
+        self._remove("refresh_tokens", token)
+
+    def _revoke_all(self, keys):
+        """インデックスから引いたトークンを失効（リフレッシュトークンはファミリーごと）"""
+        revoked = 0
+        for table_name, token in list(keys):
+            entry = self._remove(table_name, token)
+            if entry is None:
+                continue
+            revoked += 1
+            # 同じファミリーの JWT なども無効化する
+            if table_name == "refresh_tokens":
+                self.revoke_family(entry.family_id, entry.expires_at)
+        return revoked
+
+    def revoke_user_tokens(self, username):
+        """ユーザーのトークンをすべて失効（そのユーザーのトークン数に比例）"""
+        return self._revoke_all(self.user_index.get(username, ()))
+
+    def revoke_client_tokens(self, client_id):
+        """クライアントのトークンをすべて失効（そのクライアントのトークン数に比例）"""
+        return self._revoke_all(self.client_index.get(client_id, ()))
+
+    def has_expired(self, now):
+        return self.expiry_index.has_expired(now)
+
+    def sweep_expired(self, max_batch=1000):
+        """期限切れのエントリを最大 max_batch 件削除"""
+        start = time.perf_counter()
+        now = time.time()
+        removed = 0
+
+        for _, table_name, key in self.expiry_index.pop_expired(now, max_batch):
+            table = getattr(self, table_name)
+            entry = table.get(key)
+            # 交換済み・削除済みならスキップ
+            if entry is None:
+                continue
+            expires = entry if isinstance(entry, int) else entry.expires
+            if expires > now:
+                continue
+            if table_name in ("access_tokens", "refresh_tokens"):
+                self._remove(table_name, key)
+            else:
+                table.pop(key, None)
+            removed += 1
+
+        self.sweep_stats.record(removed, (time.perf_counter() - start) * 1000)
+        return removed
+
+    def stats(self):
+        """ライブエントリ数とスイープコスト"""
+        return {
+            "backend": "memory",
+            "live_auth_codes": len(self.auth_codes),
+            "live_access_tokens": len(self.access_tokens),
+            "live_refresh_tokens": len(self.refresh_tokens),
+            "revoked_families": len(self.revoked_families),
+            "indexed_users": len(self.user_index),
+            "indexed_clients": len(self.client_index),
+            "expiry_index_size": len(self.expiry_index),
+            "sweep": self.sweep_stats.as_dict(),
         }
 
 
+def create_storage(backend=None) -> StorageBackend:
+    """環境変数 STORAGE_BACKEND に応じたバックエンドを作成"""
+    backend = backend or os.environ.get("STORAGE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(os.environ.get("STORAGE_SQLITE_PATH", "oauth.db"))
+    if backend == "shm":
+        from shm_storage import SharedMemoryStorage
+        return SharedMemoryStorage(os.environ.get("STORAGE_SHM_DIR"))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
 # グローバルストレージインスタンス
-storage = Storage()
+storage = create_storage()
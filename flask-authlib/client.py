@@ -4,11 +4,51 @@ OAuth 2.0 クライアントアプリケーション (Flask + Authlib版)
 Authlib を使用した実装
 認可コードフローを使用してアクセストークンを取得し、
 保護されたAPIに継続的にアクセスする
+
+OAuth2Session はユーザーのトークンを持つためリクエストごとに作るが、
+接続プール（HTTPAdapter）はプロセスで1つを共有し、認可サーバー・APIへの接続を使い回す
+
+環境変数:
+- HTTP_POOL_SIZE: 使い回す接続数（デフォルト 10。ワーカースレッド数に合わせる）
+- HTTP_TIMEOUT: タイムアウト秒数（デフォルト 10）
+- HTTP_RETRIES: 接続エラー・502・503 を再試行する回数（デフォルト 2、POST は接続エラーのみ）
+- HTTP_RETRY_BACKOFF: 再試行の間隔の係数（デフォルト 0.2 → 0.2秒, 0.4秒, ...）
+
+API のレスポンスはログインごとにキャッシュし、ETag で再検証する（api_cache.py、API_CACHE_* の環境変数）
 """
 
 from flask import Flask, request, session, render_template_string, redirect, jsonify
 from authlib.integrations.requests_client import OAuth2Session
+import os
 import secrets
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from api_cache import ApiResponseCache
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+
+
+def create_http_adapter() -> HTTPAdapter:
+    """接続プールと再試行を設定した HTTPAdapter を作成"""
+    pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+    retry = Retry(
+        total=int(os.environ.get("HTTP_RETRIES", "2")),
+        backoff_factor=float(os.environ.get("HTTP_RETRY_BACKOFF", "0.2")),
+        # 502・503 を再試行するのは冪等なメソッドだけ（認可コードの交換を2回送らない）
+        status_forcelist=(502, 503),
+        respect_retry_after_header=True,
+        # 再試行しても失敗したら、例外ではなく最後のレスポンスを返す
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+
+# すべての OAuth2Session で共有する接続プール（スレッドセーフ）
+http_adapter = create_http_adapter()
+
+# /api/call/<endpoint> のレスポンスキャッシュ（キーはアクセストークン＝ログインごとに異なる）
+api_cache = ApiResponseCache()
 
 app = Flask(__name__)
 app.secret_key = "flask-authlib-secret-key-change-in-production"
@@ -19,19 +59,27 @@ OAUTH_CONFIG = {
     "client_secret": "demo-client-secret",
     "authorization_endpoint": "http://localhost:5000/authorize",
     "token_endpoint": "http://localhost:5000/token",
+    "revocation_endpoint": "http://localhost:5000/revoke",
     "redirect_uri": "http://localhost:5001/callback",
     "api_base": "http://localhost:5000/api",
 }
 
 
 def get_oauth_client(token=None):
-    """OAuth2Session インスタンスを作成"""
-    return OAuth2Session(
+    """OAuth2Session インスタンスを作成（接続は共有の http_adapter から取る）
+
+    close() すると共有の接続プールまで閉じるため、呼び出し側では閉じない
+    """
+    client = OAuth2Session(
         client_id=OAUTH_CONFIG["client_id"],
         client_secret=OAUTH_CONFIG["client_secret"],
         redirect_uri=OAUTH_CONFIG["redirect_uri"],
         token=token,
+        default_timeout=HTTP_TIMEOUT,
     )
+    client.mount("http://", http_adapter)
+    client.mount("https://", http_adapter)
+    return client
 
 
 @app.route("/")
@@ -81,6 +129,7 @@ def login():
     ユーザーを認可サーバーにリダイレクト
     """
     # 古いセッションデータをクリア
+    api_cache.invalidate((session.get("token") or {}).get("access_token"))
     session.clear()
 
     # CSRF対策用のstateパラメータを生成
@@ -247,26 +296,65 @@ def call_api(endpoint):
     if not token:
         return jsonify({"error": "Not authenticated"}), 401
 
+    access_token = token.get("access_token")
+    cached = api_cache.get(access_token, endpoint)
+    if cached and cached[2]:
+        return app.response_class(cached[0], mimetype="application/json")
+
     # Authlib の OAuth2Session を使ってAPIを呼び出し
     client = get_oauth_client(token=token)
 
     # Authlib が自動的に Authorization ヘッダーを付与
-    response = client.get(f"{OAUTH_CONFIG['api_base']}/{endpoint}")
+    # （保存済みのレスポンスがあれば、変更されていないか ETag で確認する）
+    headers = {"If-None-Match": cached[1]} if cached and cached[1] else None
+    response = client.get(f"{OAUTH_CONFIG['api_base']}/{endpoint}", headers=headers)
+
+    if response.status_code == 304 and cached:
+        api_cache.revalidated(access_token, endpoint, response.headers.get("Cache-Control", ""))
+        return app.response_class(cached[0], mimetype="application/json")
 
     if response.status_code != 200:
         return jsonify({"error": response.text, "status_code": response.status_code})
 
-    return jsonify(response.json())
+    api_cache.set(
+        access_token, endpoint, response.content,
+        response.headers.get("ETag"), response.headers.get("Cache-Control", ""),
+    )
+    return app.response_class(response.content, mimetype="application/json")
 
 
 @app.route("/logout")
 def logout():
     """
     ログアウト
+    認可サーバー側のトークンも失効させる（Authlib の revoke_token）
     """
+    token = session.get("token")
+    if token:
+        # リフレッシュトークンを失効させると、同じ認可のアクセストークンも無効になる
+        hint = "refresh_token" if token.get("refresh_token") else "access_token"
+        try:
+            get_oauth_client().revoke_token(
+                OAUTH_CONFIG["revocation_endpoint"],
+                token=token.get(hint),
+                token_type_hint=hint,
+                timeout=5,
+            )
+        except Exception:
+            # 認可サーバーに届かなくてもローカルのログアウトは行う
+            pass
+
+    if token:
+        api_cache.invalidate(token.get("access_token"))
     session.clear()
     return redirect("/")
 
 
+@app.route("/metrics")
+def metrics():
+    """API レスポンスキャッシュの統計（リソースサーバーへのリクエストをどれだけ減らせたか）"""
+    return jsonify({"api_cache": api_cache.stats()})
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001, debug=True)
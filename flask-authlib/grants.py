@@ -4,13 +4,22 @@ OAuth 2.0 Grants と Validators
 Authlib の Grant と Validator を実装
 """
 
+from authlib.consts import default_json_headers
 from authlib.oauth2.rfc6749 import grants
+from authlib.oauth2.rfc6749.errors import InvalidGrantError, OAuth2Error
 from authlib.oauth2.rfc6750 import BearerTokenValidator
+from authlib.oauth2.rfc7009 import RevocationEndpoint
+from authlib.oauth2.rfc7662 import IntrospectionEndpoint
 from datetime import datetime, timedelta
-from models import AuthorizationCode
+from introspection import IntrospectionError
+from models import AuthorizationCode, Token, RefreshToken
 from storage import storage
 
 
+# リフレッシュトークンの有効期限
+REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+
+
 class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
     """認可コードグラント（Authlib）"""
 
@@ -26,51 +35,89 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
             username=request.user["username"],
             expires_at=datetime.now() + timedelta(minutes=10),
         )
-        storage.auth_codes[code] = auth_code
+        storage.save_auth_code(code, auth_code)
 
     def query_authorization_code(self, code, client):
-        """認可コードを取得"""
-        auth_code = storage.auth_codes.get(code)
-        if not auth_code:
-            return None
+        """認可コードを取得
 
-        # 期限切れチェック
-        if datetime.now() > auth_code.expires_at:
+        期限・クライアントIDを検証して取り出す（使い捨て）
+        検証と削除をまとめて行い、同じコードの同時交換は1つのリクエストだけが成功する
+        """
+        now = datetime.now()
+        return storage.pop_auth_code_if_valid(code, lambda auth_code: (
+            now <= auth_code.expires_at and auth_code.client_id == client.client_id
+        ))
+
+    def delete_authorization_code(self, authorization_code):
+        """認可コードを削除（query_authorization_code で取り出し済み）"""
+
+    def authenticate_user(self, authorization_code):
+        """ユーザー情報を取得"""
+        username = authorization_code.username
+        user = storage.get_user(username)
+        if user:
+            return {"username": username}
+        return None
+
+
+class RefreshTokenGrant(grants.RefreshTokenGrant):
+    """リフレッシュトークングラント（Authlib）
+
+    リフレッシュトークンは使い捨て（ローテーション）で、使用済みのものが再提示されたら
+    漏洩とみなしてファミリー全体を失効させる
+    """
+
+    TOKEN_ENDPOINT_AUTH_METHODS = ['client_secret_post', 'client_secret_basic']
+    INCLUDE_NEW_REFRESH_TOKEN = True
+
+    def authenticate_refresh_token(self, refresh_token):
+        """リフレッシュトークンを取得"""
+        token = storage.get_refresh_token(refresh_token)
+        if not token:
             return None
 
-        # クライアントIDチェック
-        if auth_code.client_id != client.client_id:
+        # 使用済みトークンの再利用 → ファミリー内のアクセストークン・リフレッシュトークンをまとめて無効化
+        if token.used:
+            storage.revoke_family(token.family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
             return None
 
-        return auth_code
+        if token.is_expired() or storage.is_family_revoked(token.family_id):
+            return None
 
-    def delete_authorization_code(self, authorization_code):
-        """認可コードを削除（使い捨て）"""
-        code = authorization_code.code
-        if code in storage.auth_codes:
-            del storage.auth_codes[code]
+        return token
 
-    def authenticate_user(self, authorization_code):
+    def authenticate_user(self, refresh_token):
         """ユーザー情報を取得"""
-        username = authorization_code.username
-        user = storage.users.get(username)
+        username = refresh_token.username
+        user = storage.get_user(username)
         if user:
             return {"username": username}
         return None
 
+    def revoke_old_credential(self, refresh_token):
+        """使ったリフレッシュトークンを使用済みにする（再利用の検出に使う）
+
+        未使用 → 使用済みの書き換えに負けた（同じトークンで同時に来た別のリクエストが先に使った）場合は
+        再利用とみなしてファミリーを失効させる。発行したばかりのトークンも同じファミリーなので無効になる
+        """
+        if not storage.mark_refresh_token_used(refresh_token.refresh_token):
+            storage.revoke_family(refresh_token.family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
+            raise InvalidGrantError("Refresh token reused")
+
 
 class MyBearerTokenValidator(BearerTokenValidator):
     """Bearer トークンの検証（Authlib）"""
 
     def authenticate_token(self, token_string):
         """トークンを検証"""
-        token = storage.access_tokens.get(token_string)
+        token = storage.get_access_token(token_string)
 
         if not token:
             return None
 
         # 期限切れチェック
         if token.is_expired():
+            storage.delete_access_token(token_string)
             return None
 
         return token
@@ -79,4 +126,117 @@ class MyBearerTokenValidator(BearerTokenValidator):
         return False
 
     def token_revoked(self, token):
-        return False
+        return token.is_revoked()
+
+
+class IntrospectionUnavailableError(OAuth2Error):
+    """認可サーバーの /introspect に問い合わせられない（トークンが無効とは限らないので 401 にしない）"""
+
+    error = "temporarily_unavailable"
+    description = "Token introspection failed"
+    status_code = 503
+
+    def get_headers(self):
+        headers = super().get_headers()
+        headers.append(("WWW-Authenticate", f'Bearer error="{self.error}", error_description="{self.description}"'))
+        headers.append(("Retry-After", "1"))
+        return headers
+
+
+class IntrospectionBearerTokenValidator(MyBearerTokenValidator):
+    """Bearer トークンの検証（認可サーバーの /introspect に問い合わせ）
+
+    リソースサーバーを認可サーバーと別プロセスで動かすときに使う
+    """
+
+    def __init__(self, introspection_validator, **kwargs):
+        super().__init__(**kwargs)
+        self.introspection_validator = introspection_validator
+
+    def authenticate_token(self, token_string):
+        """トークンを検証（結果は TTL 付き LRU にキャッシュされる）"""
+        try:
+            result = self.introspection_validator.introspect(token_string)
+        except IntrospectionError:
+            raise IntrospectionUnavailableError()
+        if not result.get("active"):
+            return None
+
+        return Token(
+            access_token=token_string,
+            token_type=result.get("token_type", "Bearer"),
+            scope=result.get("scope", ""),
+            expires_at=datetime.fromtimestamp(result["exp"]),
+            client_id=result["client_id"],
+            username=result["username"],
+        )
+
+
+class MyRevocationEndpoint(RevocationEndpoint):
+    """トークン失効エンドポイント（RFC 7009）"""
+
+    CLIENT_AUTH_METHODS = ['client_secret_basic', 'client_secret_post']
+
+    def query_token(self, token_string, token_type_hint):
+        """アクセストークン・リフレッシュトークンを取得（token_type_hint の種類を先に探す）"""
+        lookups = [storage.get_access_token, storage.get_refresh_token]
+        if token_type_hint == 'refresh_token':
+            lookups.reverse()
+        for lookup in lookups:
+            token = lookup(token_string)
+            if token:
+                return token
+        return None
+
+    def revoke_token(self, token, request):
+        """トークンを失効（リフレッシュトークンは同じ認可のアクセストークンもまとめて無効化）"""
+        if isinstance(token, RefreshToken):
+            storage.revoke_family(token.family_id, token.expires_at)
+            storage.delete_refresh_token(token.refresh_token)
+        else:
+            token.revoked = True
+            storage.delete_access_token(token.access_token)
+
+
+class MyIntrospectionEndpoint(IntrospectionEndpoint):
+    """イントロスペクションエンドポイント（RFC 7662）"""
+
+    CLIENT_AUTH_METHODS = ['client_secret_basic', 'client_secret_post']
+
+    def query_token(self, token_string, token_type_hint):
+        """トークンを取得"""
+        return storage.get_access_token(token_string)
+
+    def check_permission(self, token, client, request):
+        """登録済みクライアント（リソースサーバー）なら問い合わせを許可"""
+        return True
+
+    def introspect_token(self, token):
+        """トークンのメタデータを返す"""
+        return {
+            "active": True,
+            "token_type": token.token_type,
+            "scope": token.get_scope(),
+            "client_id": token.client_id,
+            "username": token.username,
+            "exp": int(token.expires_at.timestamp()),
+        }
+
+
+class BatchIntrospectionEndpoint(MyIntrospectionEndpoint):
+    """イントロスペクションエンドポイント（バッチ）
+
+    token パラメータを複数指定し、同じ順序で結果を返す
+    """
+
+    ENDPOINT_NAME = 'introspection_batch'
+
+    def create_endpoint_response(self, request):
+        client = self.authenticate_endpoint_client(request)
+        results = []
+        for token_string in request.form.getlist('token'):
+            token = self.query_token(token_string, None)
+            if token and not self.check_permission(token, client, request):
+                token = None
+            results.append(self.create_introspection_payload(token))
+        return 200, {"results": results}, default_json_headers
@@ -2,18 +2,30 @@
 OAuth 2.0 モデルクラス (Authlib Mixin 実装)
 
 Authlib が要求する ClientMixin, AuthorizationCodeMixin, TokenMixin を実装
+
+認可コード・トークンは件数が多いため __slots__ で持つ
+- 有効期限は整数のエポック秒（expires）で持ち、expires_at で datetime を返す
+- client_id / username / scope は sys.intern して全インスタンスで同じ文字列オブジェクトを共有する
+- AuthorizationCodeMixin / TokenMixin は __slots__ を持たず、継承するとインスタンスごとに
+  __dict__ ができるため継承しない（Authlib は isinstance で確認せず、同じメソッドがあればよい）
 """
 
-from authlib.oauth2.rfc6749 import ClientMixin, AuthorizationCodeMixin, TokenMixin
+import sys
+import time
 from datetime import datetime
 
+from authlib.oauth2.rfc6749 import ClientMixin
+
+import passwords
+
 
 class Client(ClientMixin):
     """クライアント（Authlib が要求）"""
 
-    def __init__(self, client_id, client_secret, client_name, redirect_uris, grant_types, response_types, scope, token_endpoint_auth_method):
+    def __init__(self, client_id, client_secret_hash, client_name, redirect_uris, grant_types, response_types, scope, token_endpoint_auth_method):
         self.client_id = client_id
-        self.client_secret = client_secret
+        # クライアントシークレットは scrypt のハッシュ（passwords.py）で持つ
+        self.client_secret_hash = client_secret_hash
         self.client_name = client_name
         self.redirect_uris = redirect_uris
         self.grant_types = grant_types
@@ -36,7 +48,7 @@ class Client(ClientMixin):
         return redirect_uri in self.redirect_uris
 
     def check_client_secret(self, client_secret):
-        return self.client_secret == client_secret
+        return passwords.check_client_secret(self.client_id, client_secret, self.client_secret_hash)
 
     def check_response_type(self, response_type):
         return response_type in self.response_types
@@ -50,16 +62,22 @@ class Client(ClientMixin):
         return True
 
 
-class AuthorizationCode(AuthorizationCodeMixin):
-    """認可コード（Authlib が要求）"""
+class AuthorizationCode:
+    """認可コード（Authlib が要求、AuthorizationCodeMixin と同じメソッドを実装）"""
+
+    __slots__ = ("code", "client_id", "redirect_uri", "scope", "username", "expires")
 
     def __init__(self, code, client_id, redirect_uri, scope, username, expires_at):
         self.code = code
-        self.client_id = client_id
-        self.redirect_uri = redirect_uri
-        self.scope = scope
-        self.username = username
-        self.expires_at = expires_at
+        self.client_id = sys.intern(client_id)
+        self.redirect_uri = sys.intern(redirect_uri)
+        self.scope = sys.intern(scope)
+        self.username = sys.intern(username)
+        self.expires = int(expires_at.timestamp())
+
+    @property
+    def expires_at(self):
+        return datetime.fromtimestamp(self.expires)
 
     def get_redirect_uri(self):
         return self.redirect_uri
@@ -68,16 +86,26 @@ class AuthorizationCode(AuthorizationCodeMixin):
         return self.scope
 
 
-class Token(TokenMixin):
-    """トークン（Authlib が要求）"""
+class Token:
+    """トークン（Authlib が要求、TokenMixin と同じメソッドを実装）"""
 
-    def __init__(self, access_token, token_type, scope, expires_at, client_id, username):
+    __slots__ = ("access_token", "token_type", "scope", "expires", "client_id", "username", "family_id", "revoked")
+
+    def __init__(self, access_token, token_type, scope, expires_at, client_id, username, family_id=None):
         self.access_token = access_token
-        self.token_type = token_type
-        self.scope = scope
-        self.expires_at = expires_at
-        self.client_id = client_id
-        self.username = username
+        self.token_type = sys.intern(token_type)
+        self.scope = sys.intern(scope)
+        self.expires = int(expires_at.timestamp())
+        self.client_id = sys.intern(client_id)
+        self.username = sys.intern(username)
+        # 同じ認可から発行されたトークンの系列（リフレッシュで引き継ぐ）
+        self.family_id = family_id
+        # 失効エンドポイントで失効させたか
+        self.revoked = False
+
+    @property
+    def expires_at(self):
+        return datetime.fromtimestamp(self.expires)
 
     def check_client(self, client):
         """トークンが指定されたクライアントに発行されたか確認"""
@@ -86,12 +114,12 @@ class Token(TokenMixin):
     def get_client(self):
         """トークンに関連付けられたクライアントを返す"""
         from storage import storage
-        return storage.clients.get(self.client_id)
+        return storage.get_client(self.client_id)
 
     def get_user(self):
         """トークンに関連付けられたユーザーを返す"""
         from storage import storage
-        user = storage.users.get(self.username)
+        user = storage.get_user(self.username)
         if user:
             return {"username": self.username}
         return None
@@ -102,12 +130,46 @@ class Token(TokenMixin):
 
     def get_expires_in(self):
         """トークンの有効期限（秒）を返す"""
-        return int((self.expires_at - datetime.now()).total_seconds())
+        return int(self.expires - time.time())
 
     def is_expired(self):
         """トークンが期限切れか確認"""
-        return datetime.now() > self.expires_at
+        return time.time() > self.expires
 
     def is_revoked(self):
         """トークンが無効化されているか確認"""
-        return False
+        return self.revoked
+
+
+class RefreshToken:
+    """リフレッシュトークン（RefreshTokenGrant に渡す）
+
+    ローテーションで使い捨てにするため、使用済みかどうかを持つ
+    """
+
+    __slots__ = ("refresh_token", "scope", "expires", "client_id", "username", "family_id", "used")
+
+    def __init__(self, refresh_token, scope, expires_at, client_id, username, family_id, used=False):
+        self.refresh_token = refresh_token
+        self.scope = sys.intern(scope)
+        self.expires = int(expires_at.timestamp())
+        self.client_id = sys.intern(client_id)
+        self.username = sys.intern(username)
+        self.family_id = family_id
+        self.used = used
+
+    @property
+    def expires_at(self):
+        return datetime.fromtimestamp(self.expires)
+
+    def check_client(self, client):
+        """トークンが指定されたクライアントに発行されたか確認"""
+        return self.client_id == client.get_client_id()
+
+    def get_scope(self):
+        """トークンのスコープを返す"""
+        return self.scope
+
+    def is_expired(self):
+        """トークンが期限切れか確認"""
+        return time.time() > self.expires
@@ -0,0 +1,107 @@
+"""
+投稿の索引（インメモリストレージ用）
+
+ユーザーごとに次の索引を持ち、投稿の取り出し・範囲検索をリストの走査なしで行う
+
+- id -> 投稿 のハッシュ（/api/posts/{id}）
+- id の昇順リスト（カーソルページング）
+- created_at の昇順リスト（since・until の範囲検索）
+  値は (created_at のエポック秒 << 32) | id の整数。同じ時刻の投稿は id 順に並び、
+  bisect で範囲の両端と「この投稿より後」の位置を求められる
+
+時刻は int のエポック秒。since は含み、until は含まない
+id・時刻は SQLite の INTEGER と同じ64ビット符号付きの範囲に限る（範囲外の値はバックエンドによらず同じ扱いにする）
+"""
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from typing import Optional
+
+# created_at の索引で id を詰める下位ビット数（id は 0 以上 2^32 未満）
+ID_BITS = 32
+# SQLite の INTEGER の範囲
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def in_int64_range(value: int) -> bool:
+    return INT64_MIN <= value <= INT64_MAX
+
+
+def parse_timestamp(value) -> int:
+    """エポック秒（数字）または ISO 8601（"2025-10-01T10:00:00Z"、タイムゾーンなしは UTC）をエポック秒に変換"""
+    value = str(value).strip()
+    if value.lstrip("-").isdigit():
+        if not in_int64_range(int(value)):
+            raise ValueError(f"Timestamp out of range: {value}")
+        return int(value)
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+class PostIndex:
+    """1ユーザーの投稿の索引（スレッドセーフ）"""
+
+    def __init__(self, posts=()):
+        self._by_id = {}
+        self._ids = []
+        self._created = []
+        # id -> created_at の索引の値
+        self._keys = {}
+        self._lock = threading.Lock()
+        # 初期データはまとめて並べ替える（1件ずつ insort すると件数の2乗に比例する）
+        for post in posts:
+            self._by_id[post["id"]] = post
+            self._keys[post["id"]] = (parse_timestamp(post["created_at"]) << ID_BITS) | post["id"]
+        self._ids = sorted(self._by_id)
+        self._created = sorted(self._keys.values())
+
+    def add(self, post):
+        """投稿を追加（同じ id があれば置き換える）"""
+        post_id = post["id"]
+        key = (parse_timestamp(post["created_at"]) << ID_BITS) | post_id
+        with self._lock:
+            old_key = self._keys.get(post_id)
+            if old_key is None:
+                insort(self._ids, post_id)
+            else:
+                del self._created[bisect_left(self._created, old_key)]
+            insort(self._created, key)
+            self._keys[post_id] = key
+            self._by_id[post_id] = post
+
+    def get(self, post_id) -> Optional[dict]:
+        return self._by_id.get(post_id)
+
+    def all(self) -> list:
+        """すべての投稿（id 順）"""
+        with self._lock:
+            return [self._by_id[post_id] for post_id in self._ids]
+
+    def page(self, after: Optional[int], limit: Optional[int]) -> list:
+        """id 順に after より後の投稿を最大 limit 件"""
+        with self._lock:
+            start = 0 if after is None else bisect_right(self._ids, after)
+            end = len(self._ids) if limit is None else start + limit
+            return [self._by_id[post_id] for post_id in self._ids[start:end]]
+
+    def range(self, since: Optional[int], until: Optional[int], after: Optional[int], limit: Optional[int]) -> list:
+        """created_at 順に since 以上 until 未満の投稿を最大 limit 件（after は前のページの最後の投稿の id）"""
+        mask = (1 << ID_BITS) - 1
+        with self._lock:
+            start = 0 if since is None else bisect_left(self._created, since << ID_BITS)
+            end = len(self._created) if until is None else bisect_left(self._created, until << ID_BITS)
+            if after is not None:
+                after_key = self._keys.get(after)
+                if after_key is None:
+                    return []
+                start = max(start, bisect_right(self._created, after_key))
+            if limit is not None:
+                end = min(end, start + limit)
+            return [self._by_id[key & mask] for key in self._created[start:end]]
+
+    def __len__(self):
+        return len(self._ids)
@@ -4,25 +4,49 @@ OAuth 2.0 認可サーバー + リソースサーバー (Flask + Authlib版)
 Authlib を使用した実装（モジュール分割版）
 """
 
-from flask import Flask, request, render_template_string, jsonify, redirect
+from flask import Flask, request, jsonify, redirect
+import json
+import os
+import zlib
 from authlib.integrations.flask_oauth2 import AuthorizationServer, ResourceProtector
 from authlib.integrations.flask_oauth2 import current_token
 import secrets
 from datetime import datetime, timedelta
 
-from models import Token, AuthorizationCode
+from models import Token, AuthorizationCode, RefreshToken
 from storage import storage
-from grants import AuthorizationCodeGrant, MyBearerTokenValidator
+from grants import (
+    REFRESH_TOKEN_LIFETIME,
+    AuthorizationCodeGrant,
+    RefreshTokenGrant,
+    MyBearerTokenValidator,
+    IntrospectionBearerTokenValidator,
+    MyRevocationEndpoint,
+    MyIntrospectionEndpoint,
+    BatchIntrospectionEndpoint,
+)
+from expiry import Sweeper
+from introspection import create_validator
+import passwords
+from post_index import in_int64_range, parse_timestamp
+from response_cache import response_cache
+from ratelimit import RateLimiter, limit_from_env
 
 app = Flask(__name__)
 app.secret_key = "flask-authlib-server-secret-key-change-in-production"
+# トークンレスポンスにリフレッシュトークンを含める
+app.config["OAUTH2_REFRESH_TOKEN_GENERATOR"] = True
+
+# 期限切れの認可コード・アクセストークンをバックグラウンドで削除
+sweeper = Sweeper(storage, interval=1.0, batch_size=1000)
+sweeper.start()
 
 
 # ===== Authlib の設定 =====
 
 def query_client(client_id):
     """クライアント情報を取得（Authlib が呼び出す）"""
-    return storage.clients.get(client_id)
+    return storage.get_client(client_id)
 
 
 def save_token(token, request):
@@ -30,30 +54,118 @@ def save_token(token, request):
     # request.user は authenticate_user の戻り値
     user = request.user
     access_token_str = token["access_token"]
+    now = datetime.now()
+
+    # リフレッシュ時は元のファミリーを引き継ぎ、認可コード交換時は新しいファミリーを作る
+    if request.refresh_token:
+        family_id = request.refresh_token.family_id
+    else:
+        family_id = secrets.token_urlsafe(16)
 
     token_obj = Token(
         access_token=access_token_str,
         token_type=token["token_type"],
         scope=token.get("scope", ""),
-        expires_at=datetime.now() + timedelta(seconds=token["expires_in"]),
-        client_id=request.client_id,
+        expires_at=now + timedelta(seconds=token["expires_in"]),
+        client_id=request.client.get_client_id(),
         username=user["username"],
+        family_id=family_id,
     )
-    storage.access_tokens[access_token_str] = token_obj
+    storage.save_access_token(access_token_str, token_obj)
+
+    if "refresh_token" in token:
+        storage.save_refresh_token(token["refresh_token"], RefreshToken(
+            refresh_token=token["refresh_token"],
+            scope=token.get("scope", ""),
+            expires_at=now + REFRESH_TOKEN_LIFETIME,
+            client_id=request.client.get_client_id(),
+            username=user["username"],
+            family_id=family_id,
+        ))
 
 
 # AuthorizationServer のインスタンス作成
 authorization = AuthorizationServer()
 authorization.init_app(app, query_client=query_client, save_token=save_token)
 authorization.register_grant(AuthorizationCodeGrant)
+authorization.register_grant(RefreshTokenGrant)
+authorization.register_endpoint(MyRevocationEndpoint)
+authorization.register_endpoint(MyIntrospectionEndpoint)
+authorization.register_endpoint(BatchIntrospectionEndpoint)
+
+# INTROSPECTION_URL 設定時は認可サーバーに問い合わせてトークンを検証（リソースサーバー単独運用）
+introspection_validator = create_validator()
+
+# 管理API（一括失効）の認証トークン（X-Admin-Token ヘッダーで渡す）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "demo-admin-token")
+
+# 同意処理で受け付けるスコープの最大長（認可コードと一緒に保存するため）
+MAX_SCOPE_LENGTH = 512
+
+# /token は IP ごと・client_id ごと、同意処理（POST /authorize）は IP ごと・IP + username ごとのレート制限
+rate_limiter = RateLimiter({
+    "/token": limit_from_env("RATE_LIMIT_TOKEN", "10:20"),
+    "/authorize": limit_from_env("RATE_LIMIT_CONSENT", "1:5"),
+}, ip_limits={
+    "/authorize": limit_from_env("RATE_LIMIT_CONSENT_IP", "10:50"),
+}, user_paths=["/authorize"])
+
+
+@app.before_request
+def rate_limit():
+    """制限対象のエンドポイントで上限を超えたら 429 を返す（GET /authorize の同意画面は制限しない）"""
+    if request.method != "POST" or not rate_limiter.applies(request.path):
+        return None
+    client_id = request.form.get("client_id")
+    if not client_id and request.authorization:
+        client_id = request.authorization.username
+    key = rate_limiter.key_for(request.path, request.remote_addr, client_id, request.form.get("username"))
+    retry_after = rate_limiter.check(request.path, request.remote_addr, key)
+    if not retry_after:
+        return None
+    return jsonify({"error": "too_many_requests"}), 429, {"Retry-After": str(retry_after)}
 
 # ResourceProtector のインスタンス作成
 require_oauth = ResourceProtector()
-require_oauth.register_token_validator(MyBearerTokenValidator())
+if introspection_validator:
+    require_oauth.register_token_validator(IntrospectionBearerTokenValidator(introspection_validator))
+else:
+    require_oauth.register_token_validator(MyBearerTokenValidator())
 
 
 # ===== 認可サーバーのエンドポイント =====
 
+# ログイン・同意画面（起動時に1回だけコンパイルする。パラメータは自動でエスケープされる）
+CONSENT_TEMPLATE = app.jinja_env.from_string("""
+    <html>
+        <head><title>OAuth 2.0 Authorization (Flask + Authlib)</title></head>
+        <body>
+            <h2>ログイン (Flask + Authlib版)</h2>
+            <form method="post" action="/authorize">
+                <input type="hidden" name="response_type" value="{{ response_type }}">
+                <input type="hidden" name="client_id" value="{{ client_id }}">
+                <input type="hidden" name="redirect_uri" value="{{ redirect_uri }}">
+                <input type="hidden" name="state" value="{{ state }}">
+                <input type="hidden" name="scope" value="{{ scope }}">
+
+                <p>クライアント: {{ client_name }}</p>
+                <p>スコープ: {{ scope }}</p>
+
+                <label>ユーザー名: </label>
+                <input type="text" name="username" value="demo-user" required>
+                <br><br>
+
+                <label>パスワード: </label>
+                <input type="password" name="password" value="demo-password" required>
+                <br><br>
+
+                <button type="submit">許可する</button>
+            </form>
+        </body>
+    </html>
+""")
+
+
 @app.route("/authorize", methods=['GET', 'POST'])
 def authorize_route():
     """
@@ -69,7 +181,7 @@ def authorize_route():
         scope = request.args.get('scope', '')
 
         # クライアントIDの検証
-        client = storage.clients.get(client_id)
+        client = storage.get_client(client_id)
         if not client:
             return "Invalid client_id", 400
 
@@ -77,44 +189,36 @@ def authorize_route():
         if redirect_uri not in client.redirect_uris:
             return "Invalid redirect_uri", 400
 
-        html = f"""
-        <html>
-            <head><title>OAuth 2.0 Authorization (Flask + Authlib)</title></head>
-            <body>
-                <h2>ログイン (Flask + Authlib版)</h2>
-                <form method="post" action="/authorize">
-                    <input type="hidden" name="response_type" value="{response_type}">
-                    <input type="hidden" name="client_id" value="{client_id}">
-                    <input type="hidden" name="redirect_uri" value="{redirect_uri}">
-                    <input type="hidden" name="state" value="{state}">
-                    <input type="hidden" name="scope" value="{scope}">
-
-                    <p>クライアント: {client.client_name}</p>
-                    <p>スコープ: {scope}</p>
-
-                    <label>ユーザー名: </label>
-                    <input type="text" name="username" value="demo-user" required>
-                    <br><br>
-
-                    <label>パスワード: </label>
-                    <input type="password" name="password" value="demo-password" required>
-                    <br><br>
-
-                    <button type="submit">許可する</button>
-                </form>
-            </body>
-        </html>
-        """
-
-        return render_template_string(html)
+        return CONSENT_TEMPLATE.render(
+            response_type=response_type,
+            client_id=client_id,
+            redirect_uri=redirect_uri,
+            state=state,
+            scope=scope,
+            client_name=client.client_name,
+        )
 
     # POST - ユーザー認証 + 認可コード発行
+    client_id = request.form.get('client_id')
+    redirect_uri = request.form.get('redirect_uri')
+    scope = request.form.get('scope', '')
     username = request.form.get('username')
     password = request.form.get('password')
 
+    # クライアントID・redirect_uri・スコープの検証（同意画面を経由しない POST もあるため再度行う）
+    client = storage.get_client(client_id)
+    if not client:
+        return "Invalid client_id", 400
+    if redirect_uri not in client.redirect_uris:
+        return "Invalid redirect_uri", 400
+    if len(scope) > MAX_SCOPE_LENGTH:
+        return "Invalid scope", 400
+
     # ユーザー認証
-    user = storage.users.get(username)
-    if not user or user["password"] != password:
+    user = storage.get_user(username)
+    # ユーザーがいなくてもダミーのハッシュで検証する（応答時間でユーザー名の有無がわからないように）
+    password_hash = user["password_hash"] if user else passwords.DUMMY_PASSWORD_HASH
+    if not passwords.verifier.check(password, password_hash) or not user:
         return "Invalid credentials", 401
 
     # 認可コード生成
@@ -123,16 +227,15 @@ def authorize_route():
     # 認可コードを保存
     auth_code = AuthorizationCode(
         code=code,
-        client_id=request.form.get('client_id'),
-        redirect_uri=request.form.get('redirect_uri'),
-        scope=request.form.get('scope', ''),
+        client_id=client_id,
+        redirect_uri=redirect_uri,
+        scope=scope,
         username=username,
         expires_at=datetime.now() + timedelta(minutes=10),
     )
-    storage.auth_codes[code] = auth_code
+    storage.save_auth_code(code, auth_code)
 
     # クライアントにリダイレクト
-    redirect_uri = request.form.get('redirect_uri')
     state = request.form.get('state', '')
 
     redirect_url = f"{redirect_uri}?code={code}"
@@ -146,11 +249,167 @@ def authorize_route():
 def issue_token():
     """
     トークンエンドポイント（Authlib が処理）
-    認可コードをアクセストークンと交換
+    認可コード・リフレッシュトークンをアクセストークンと交換
     """
     return authorization.create_token_response()
 
 
+@app.route("/revoke", methods=['POST'])
+def revoke():
+    """
+    トークン失効エンドポイント（Authlib が処理、RFC 7009）
+    """
+    return authorization.create_endpoint_response(MyRevocationEndpoint.ENDPOINT_NAME)
+
+
+@app.route("/admin/revoke", methods=['POST'])
+def admin_revoke():
+    """
+    ユーザー・クライアント単位の一括失効（管理用）
+    username または client_id を指定する
+    """
+    # str どうしの compare_digest は ASCII 以外で TypeError になるため bytes で比べる
+    admin_token = request.headers.get('X-Admin-Token', '').encode("utf-8", "surrogateescape")
+    if not secrets.compare_digest(admin_token, ADMIN_TOKEN.encode()):
+        return jsonify({"error": "unauthorized"}), 401
+
+    username = request.form.get('username')
+    client_id = request.form.get('client_id')
+    if username:
+        revoked = storage.revoke_user_tokens(username)
+    elif client_id:
+        revoked = storage.revoke_client_tokens(client_id)
+    else:
+        return jsonify({"error": "invalid_request"}), 400
+
+    return jsonify({"revoked": revoked})
+
+
+@app.route("/introspect", methods=['POST'])
+def introspect():
+    """
+    イントロスペクションエンドポイント（Authlib が処理）
+    リソースサーバーがトークンの有効性と属性を問い合わせる
+    """
+    return authorization.create_endpoint_response(MyIntrospectionEndpoint.ENDPOINT_NAME)
+
+
+@app.route("/introspect/batch", methods=['POST'])
+def introspect_batch():
+    """
+    イントロスペクションエンドポイント（バッチ）
+    token パラメータを複数指定し、同じ順序で結果を返す
+    """
+    return authorization.create_endpoint_response(BatchIntrospectionEndpoint.ENDPOINT_NAME)
+
+
+# ===== 条件付きレスポンス（ETag） =====
+
+# Bearer トークンで保護されたレスポンスなので共有キャッシュには保存させず、毎回 ETag で再検証させる
+CACHE_CONTROL = "private, no-cache"
+# /api/me・/api/profile は変更が少ないため、PROFILE_MAX_AGE 秒は再検証なしで使わせる（0 なら毎回再検証）
+PROFILE_MAX_AGE = int(os.environ.get("PROFILE_MAX_AGE", "5"))
+PROFILE_CACHE_CONTROL = f"private, max-age={PROFILE_MAX_AGE}" if PROFILE_MAX_AGE > 0 else CACHE_CONTROL
+
+
+def make_etag(kind, username, version):
+    """ストレージのバージョンカウンタから強い ETag を作る（ユーザーごとに異なる値になるよう username の CRC を含める）"""
+    return "%s-%d-%08x" % (kind, version, zlib.crc32(username.encode()))
+
+
+def not_modified(etag, cache_control=CACHE_CONTROL):
+    """304（本文を作らない）"""
+    return with_etag(app.response_class(status=304), etag, cache_control)
+
+
+def cached_json(body, etag, cache_control=CACHE_CONTROL):
+    """シリアライズ済みのバイト列をそのまま返す（jsonify を通さない）"""
+    return with_etag(app.response_class(body, mimetype="application/json"), etag, cache_control)
+
+
+def with_etag(response, etag, cache_control=CACHE_CONTROL):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+# ===== 投稿一覧のページング・ストリーミング =====
+
+NDJSON = "application/x-ndjson"
+# 1ページの件数（limit のデフォルトと上限）
+POSTS_PAGE_SIZE = 100
+POSTS_MAX_PAGE_SIZE = 1000
+# ストリーミング時にストレージから一度に読む件数
+POSTS_STREAM_CHUNK = 500
+
+
+def stream_posts(fetch, after, limit):
+    """fetch(after, 件数) で投稿を POSTS_STREAM_CHUNK 件ずつ読んで NDJSON の行を返す（投稿数によらずメモリは一定）"""
+    while limit is None or limit > 0:
+        chunk = POSTS_STREAM_CHUNK if limit is None else min(POSTS_STREAM_CHUNK, limit)
+        posts = fetch(after, chunk)
+        for post in posts:
+            yield json.dumps(post) + "\n"
+        if len(posts) < chunk:
+            return
+        after = posts[-1]["id"]
+        if limit is not None:
+            limit -= len(posts)
+
+
+def posts_response(username):
+    """
+    投稿一覧のレスポンス（カーソルページング）
+
+    - limit: 件数（デフォルト POSTS_PAGE_SIZE、最大 POSTS_MAX_PAGE_SIZE）
+    - after: 前のページの next_cursor（この id の投稿より後を返す）
+    - since・until: created_at の範囲（エポック秒または ISO 8601、since を含み until を含まない）
+      指定すると created_at 順（索引の二分探索で範囲を求める）、省略すると id 順
+    - Accept: application/x-ndjson なら1行1件でストリーミングする（limit を省略するとすべて）
+    """
+    limit = request.args.get("limit", type=int)
+    after = request.args.get("after", type=int)
+    if limit is not None and not 1 <= limit <= POSTS_MAX_PAGE_SIZE:
+        return jsonify({"error": "invalid_request"}), 400
+    if after is not None and not in_int64_range(after):
+        return jsonify({"error": "invalid_request"}), 400
+    try:
+        since, until = (
+            None if value is None else parse_timestamp(value)
+            for value in (request.args.get("since"), request.args.get("until"))
+        )
+    except ValueError:
+        return jsonify({"error": "invalid_request"}), 400
+
+    if since is None and until is None:
+        def fetch(after, count):
+            return storage.get_posts_page(username, after, count)
+    else:
+        def fetch(after, count):
+            return storage.get_posts_range(username, since, until, after, count)
+
+    if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        # ページを読みながら返すため、途中で投稿が追加されることがある（ETag は付けない）
+        return app.response_class(
+            stream_posts(fetch, after, limit), mimetype=NDJSON, headers={"Cache-Control": CACHE_CONTROL},
+        )
+
+    # バージョンはデータより先に読む（後に読むと、新しい ETag で古い本文を返すことがある）
+    etag = make_etag("posts", username, storage.get_posts_version(username))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    limit = limit or POSTS_PAGE_SIZE
+    # 1件多く読んで次のページがあるかを判定する
+    posts = fetch(after, limit + 1)
+    next_cursor = posts[limit - 1]["id"] if len(posts) > limit else None
+
+    return with_etag(jsonify({
+        "username": username,
+        "posts": posts[:limit],
+        "next_cursor": next_cursor,
+    }), etag)
+
+
 # ===== リソースサーバーのエンドポイント（保護されたAPI） =====
 
 @app.route("/api/me")
@@ -159,13 +418,22 @@ def get_user_info():
     """ユーザー情報取得API（Authlib が自動でトークン検証）"""
     token = current_token
     username = token.username
-    user = storage.users.get(username)
-
-    return jsonify({
-        "username": username,
-        "name": user["name"],
-        "email": user["email"],
-    })
+    # バージョンはデータより先に読む（後に読むと、新しい ETag で古い本文を返すことがある）
+    version = storage.get_user_version(username)
+    etag = make_etag("me", username, version)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("me", username, version)
+    if body is None:
+        user = storage.get_user(username)
+        body = response_cache.put("me", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
 
 @app.route("/api/profile")
@@ -177,15 +445,23 @@ def get_user_profile():
     """
     token = current_token
     username = token.username
-    user = storage.users.get(username)
-
-    return jsonify({
-        "username": username,
-        "name": user["name"],
-        "email": user["email"],
-        "bio": user["bio"],
-        "location": user["location"],
-    })
+    version = storage.get_user_version(username)
+    etag = make_etag("profile", username, version)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("profile", username, version)
+    if body is None:
+        user = storage.get_user(username)
+        body = response_cache.put("profile", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+            "bio": user["bio"],
+            "location": user["location"],
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
 
 @app.route("/api/posts")
@@ -193,16 +469,42 @@ def get_user_profile():
 def get_user_posts():
     """
     ユーザーの投稿一覧取得API
-    Bearer トークンで保護されたリソース
+    Bearer トークンで保護されたリソース（limit・after でページング）
     """
     token = current_token
     username = token.username
-    posts = storage.posts.get(username, [])
+    return posts_response(username)
 
-    return jsonify({
-        "username": username,
-        "posts": posts,
-    })
+
+@app.route("/api/posts/<int:post_id>")
+@require_oauth()
+def get_user_post(post_id):
+    """投稿の取得API（id のハッシュで引く）"""
+    token = current_token
+    username = token.username
+    etag = make_etag(f"post{post_id}", username, storage.get_posts_version(username))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    # SQLite に渡せない id は存在しない投稿として扱う
+    post = storage.get_post(username, post_id) if in_int64_range(post_id) else None
+
+    if post is None:
+        return jsonify({"error": "not_found"}), 404
+    return with_etag(jsonify(post), etag)
+
+
+# ===== 運用メトリクス =====
+
+@app.route("/metrics")
+def metrics():
+    """ライブエントリ数とスイープコスト（ノードのサイジング用）"""
+    stats = storage.stats()
+    stats["client_secret_cache"] = passwords.credential_cache.stats()
+    stats["response_cache"] = response_cache.stats()
+    stats["rate_limit"] = rate_limiter.stats()
+    if introspection_validator:
+        stats["introspection"] = introspection_validator.stats()
+    return jsonify(stats)
 
 
 # ===== サーバー情報 =====
@@ -217,9 +519,11 @@ def root():
         "endpoints": {
             "authorization": "http://localhost:5000/authorize",
             "token": "http://localhost:5000/token",
+            "introspection": "http://localhost:5000/introspect",
+            "revocation": "http://localhost:5000/revoke",
             "userinfo": "http://localhost:5000/api/me",
         },
-        "supported_grant_types": ["authorization_code"],
+        "supported_grant_types": ["authorization_code", "refresh_token"],
     })
 
 
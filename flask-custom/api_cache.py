@@ -0,0 +1,134 @@
+"""
+API レスポンスのキャッシュ（クライアント側）
+
+/api/call/<endpoint> の結果を (セッション, エンドポイント) ごとに保持し、リソースサーバーへのリクエストを減らす
+
+- 取得から ttl 秒以内はリソースサーバーに問い合わせずに返す
+  レスポンスの Cache-Control に従い、ttl は上限として使う（max-age が短ければそちら、no-cache なら毎回問い合わせる、
+  no-store なら保存しない）
+- 期限を過ぎたら If-None-Match（前回の ETag）を付けて問い合わせ、304 なら保存済みの本文を返す
+  （サーバーは本文を作らず、転送量も減る）
+- ログアウト時にセッションのエントリをまとめて削除する
+- maxsize 件を超えたら最も長く使われていないエントリから捨てる
+
+本文はリソースサーバーが返したバイト列のまま保持する（返すときに JSON をパース・エンコードし直さない）
+
+環境変数:
+- API_CACHE_TTL: 問い合わせずに返す秒数の上限（デフォルト 5。0 なら毎回 ETag で再検証する）
+- API_CACHE_SIZE: 保持するエントリ数の上限（デフォルト 10000）
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def freshness_lifetime(cache_control, ttl):
+    """Cache-Control から問い合わせずに返せる秒数を求める（ttl が上限。no-store なら None）"""
+    lifetime = ttl
+    for directive in cache_control.lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "no-store":
+            return None
+        if name == "no-cache":
+            # 保存はするが、毎回 ETag で再検証する
+            lifetime = 0
+        elif name == "max-age":
+            try:
+                lifetime = min(lifetime, max(0, int(value.strip('" '))))
+            except ValueError:
+                # 解釈できない max-age は期限切れとして扱う（RFC 9111 4.2.1）
+                lifetime = 0
+    return lifetime
+
+
+class ApiResponseCache:
+    """(セッション, エンドポイント) ごとの TTL・ETag 付き LRU キャッシュ（スレッドセーフ）"""
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = float(os.environ.get("API_CACHE_TTL", "5")) if ttl is None else ttl
+        self.maxsize = int(os.environ.get("API_CACHE_SIZE", "10000")) if maxsize is None else maxsize
+        # (セッション, エンドポイント) -> [本文, ETag, 問い合わせずに返せる期限, その秒数]。LRU 順
+        self._entries = OrderedDict()
+        # セッション -> そのセッションのエンドポイント（ログアウト時の削除用）
+        self._by_session = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, session_key, endpoint, now=None):
+        """保存済みの (本文, ETag, 問い合わせ不要か) を返す（なければ None）
+
+        呼び出し1回を API 呼び出し1回として数え、問い合わせ不要なら hits に数える
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self.requests += 1
+            entry = self._entries.get((session_key, endpoint))
+            if entry is None:
+                return None
+            self._entries.move_to_end((session_key, endpoint))
+            fresh = entry[2] > now
+            if fresh:
+                self.hits += 1
+            return entry[0], entry[1], fresh
+
+    def set(self, session_key, endpoint, body, etag, cache_control="", now=None):
+        """200 のレスポンスを保存（期限は Cache-Control と ttl の短い方。no-store なら保存しない）"""
+        lifetime = freshness_lifetime(cache_control, self.ttl)
+        if lifetime is None:
+            return
+        now = time.time() if now is None else now
+        key = (session_key, endpoint)
+        with self._lock:
+            self._entries[key] = [body, etag, now + lifetime, lifetime]
+            self._entries.move_to_end(key)
+            self._by_session.setdefault(session_key, set()).add(endpoint)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def revalidated(self, session_key, endpoint, cache_control="", now=None):
+        """304 を受け取ったエントリの期限を延ばす（304 に Cache-Control がなければ保存時の秒数）"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self.not_modified += 1
+            entry = self._entries.get((session_key, endpoint))
+            if entry is not None:
+                if cache_control:
+                    entry[3] = freshness_lifetime(cache_control, self.ttl)
+                # 304 の no-store は以後保存しない
+                if entry[3] is None:
+                    self._discard((session_key, endpoint))
+                else:
+                    entry[2] = now + entry[3]
+
+    def invalidate(self, session_key):
+        """セッションのエントリをすべて削除（ログアウト時）"""
+        with self._lock:
+            for endpoint in list(self._by_session.get(session_key, ())):
+                self._discard((session_key, endpoint))
+
+    def _discard(self, key):
+        del self._entries[key]
+        endpoints = self._by_session[key[0]]
+        endpoints.discard(key[1])
+        if not endpoints:
+            del self._by_session[key[0]]
+
+    def stats(self):
+        upstream = self.requests - self.hits
+        return {
+            "size": len(self._entries),
+            "ttl": self.ttl,
+            "requests": self.requests,
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+            "upstream_requests": upstream,
+            # キャッシュがなければ requests 回問い合わせていた
+            "upstream_reduction": self.hits / self.requests if self.requests else 0.0,
+        }
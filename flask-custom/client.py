@@ -4,11 +4,55 @@ OAuth 2.0 クライアントアプリケーション (Flask版)
 Flask による自前実装
 認可コードフローを使用してアクセストークンを取得し、
 保護されたAPIに継続的にアクセスする
+
+認可サーバー・APIへのリクエストは、プロセスで1つの requests.Session（接続プール）で送る
+（requests.get などのモジュール関数は、呼ぶたびに TCP 接続からやり直す）
+
+環境変数:
+- HTTP_POOL_SIZE: 使い回す接続数（デフォルト 10。ワーカースレッド数に合わせる）
+- HTTP_TIMEOUT: タイムアウト秒数（デフォルト 10）
+- HTTP_RETRIES: 接続エラー・502・503 を再試行する回数（デフォルト 2、POST は接続エラーのみ）
+- HTTP_RETRY_BACKOFF: 再試行の間隔の係数（デフォルト 0.2 → 0.2秒, 0.4秒, ...）
+
+API のレスポンスはログインごとにキャッシュし、ETag で再検証する（api_cache.py、API_CACHE_* の環境変数）
 """
 
 from flask import Flask, request, session, render_template_string, redirect, jsonify
+import os
 import requests
 import secrets
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from api_cache import ApiResponseCache
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+
+
+def create_http_session() -> requests.Session:
+    """接続プールと再試行を設定した requests.Session を作成"""
+    pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+    retry = Retry(
+        total=int(os.environ.get("HTTP_RETRIES", "2")),
+        backoff_factor=float(os.environ.get("HTTP_RETRY_BACKOFF", "0.2")),
+        # 502・503 を再試行するのは冪等なメソッドだけ（認可コードの交換を2回送らない）
+        status_forcelist=(502, 503),
+        respect_retry_after_header=True,
+        # 再試行しても失敗したら、例外ではなく最後のレスポンスを返す
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+# 認可サーバー・APIへの共有セッション（接続プールはスレッドセーフ。Cookie は使わない）
+http = create_http_session()
+
+# /api/call/<endpoint> のレスポンスキャッシュ（キーはアクセストークン＝ログインごとに異なる）
+api_cache = ApiResponseCache()
 
 app = Flask(__name__)
 app.secret_key = "flask-custom-client-secret-key-change-in-production"
@@ -19,6 +63,7 @@ OAUTH_CONFIG = {
     "client_secret": "demo-client-secret",
     "authorization_endpoint": "http://localhost:5000/authorize",
     "token_endpoint": "http://localhost:5000/token",
+    "revocation_endpoint": "http://localhost:5000/revoke",
     "redirect_uri": "http://localhost:5001/callback",
     "api_base": "http://localhost:5000/api",
 }
@@ -71,6 +116,7 @@ def login():
     ユーザーを認可サーバーにリダイレクト
     """
     # 古いセッションデータをクリア
+    api_cache.invalidate(session.get("access_token"))
     session.clear()
 
     # CSRF対策用のstateパラメータを生成
@@ -104,7 +150,7 @@ def callback():
         return "<h1>Error: Invalid state parameter</h1>", 400
 
     # トークンエンドポイントにリクエスト
-    response = requests.post(
+    response = http.post(
         OAUTH_CONFIG["token_endpoint"],
         data={
             "grant_type": "authorization_code",
@@ -113,6 +159,7 @@ def callback():
             "client_id": OAUTH_CONFIG["client_id"],
             "client_secret": OAUTH_CONFIG["client_secret"],
         },
+        timeout=HTTP_TIMEOUT,
     )
 
     if response.status_code != 200:
@@ -232,26 +279,64 @@ def call_api(endpoint):
     if not access_token:
         return jsonify({"error": "Not authenticated"}), 401
 
-    # APIを呼び出し
-    response = requests.get(
-        f"{OAUTH_CONFIG['api_base']}/{endpoint}",
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
+    cached = api_cache.get(access_token, endpoint)
+    if cached and cached[2]:
+        return app.response_class(cached[0], mimetype="application/json")
+
+    # APIを呼び出し（保存済みのレスポンスがあれば、変更されていないか ETag で確認する）
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if cached and cached[1]:
+        headers["If-None-Match"] = cached[1]
+    response = http.get(f"{OAUTH_CONFIG['api_base']}/{endpoint}", headers=headers, timeout=HTTP_TIMEOUT)
+
+    if response.status_code == 304 and cached:
+        api_cache.revalidated(access_token, endpoint, response.headers.get("Cache-Control", ""))
+        return app.response_class(cached[0], mimetype="application/json")
 
     if response.status_code != 200:
         return jsonify({"error": response.text, "status_code": response.status_code})
 
-    return jsonify(response.json())
+    api_cache.set(
+        access_token, endpoint, response.content,
+        response.headers.get("ETag"), response.headers.get("Cache-Control", ""),
+    )
+    return app.response_class(response.content, mimetype="application/json")
 
 
 @app.route("/logout")
 def logout():
     """
     ログアウト
+    認可サーバー側のトークンも失効させる
     """
+    token_data = session.get('token_data') or {}
+    # リフレッシュトークンを失効させると、同じ認可のアクセストークンも無効になる
+    token = token_data.get("refresh_token") or token_data.get("access_token")
+    if token:
+        try:
+            http.post(
+                OAUTH_CONFIG["revocation_endpoint"],
+                data={
+                    "token": token,
+                    "client_id": OAUTH_CONFIG["client_id"],
+                    "client_secret": OAUTH_CONFIG["client_secret"],
+                },
+                timeout=5,
+            )
+        except requests.RequestException:
+            # 認可サーバーに届かなくてもローカルのログアウトは行う
+            pass
+
+    api_cache.invalidate(session.get("access_token"))
     session.clear()
     return redirect("/")
 
 
+@app.route("/metrics")
+def metrics():
+    """API レスポンスキャッシュの統計（リソースサーバーへのリクエストをどれだけ減らせたか）"""
+    return jsonify({"api_cache": api_cache.stats()})
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001, debug=True)
@@ -0,0 +1,165 @@
+"""
+トークンイントロスペクション（RFC 7662）のリソースサーバー側バリデーター
+
+リソースサーバー（/api/*）を認可サーバーと別プロセスで動かすときに使う
+環境変数 INTROSPECTION_URL を設定すると有効になる
+
+- 接続プール付きの requests.Session で認可サーバーの /introspect を呼ぶ
+- 結果を TTL 付き LRU にキャッシュし、同じトークンの検証では認可サーバーを呼ばない
+- 認可サーバーに届かない・エラーを返したときは IntrospectionError（結果はキャッシュしない。リソースサーバーは 503 を返す）
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class IntrospectionError(Exception):
+    """認可サーバーの /introspect に問い合わせられなかった（接続・タイムアウト・HTTP エラー・不正な応答）"""
+
+
+class TTLCache:
+    """TTL 付き LRU キャッシュ（スレッドセーフ）"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class IntrospectionValidator:
+    """認可サーバーの /introspect を呼び、結果をキャッシュするバリデーター"""
+
+    def __init__(self, url, client_id, client_secret, cache_size=10000, cache_ttl=30.0,
+                 negative_ttl=5.0, pool_size=16, timeout=2.0):
+        self.url = url
+        self.batch_url = url.rstrip("/") + "/batch"
+        self.auth = (client_id, client_secret)
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.cache = TTLCache(cache_size)
+        self.errors = 0
+
+        # 認可サーバーへの接続を使い回す
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _parse(self, response):
+        """応答を検査して JSON を返す（失敗は IntrospectionError にし、呼び出し側でキャッシュしない）"""
+        try:
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            self.errors += 1
+            raise IntrospectionError(str(e)) from e
+        if not isinstance(result, dict):
+            self.errors += 1
+            raise IntrospectionError("Unexpected introspection response")
+        return result
+
+    def _cache_result(self, token, result):
+        now = time.time()
+        if result.get("active"):
+            # トークンの有効期限を超えてキャッシュしない
+            expires_at = min(now + self.cache_ttl, result.get("exp", now))
+        else:
+            expires_at = now + self.negative_ttl
+        self.cache.set(token, result, expires_at)
+
+    def introspect(self, token):
+        """トークンのイントロスペクション結果を返す"""
+        result = self.cache.get(token)
+        if result is not None:
+            return result
+
+        try:
+            response = self.session.post(self.url, data={"token": token}, auth=self.auth, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.errors += 1
+            raise IntrospectionError(str(e)) from e
+        result = self._parse(response)
+        self._cache_result(token, result)
+        return result
+
+    def introspect_many(self, tokens):
+        """複数トークンをまとめて検証（キャッシュにないものだけ1回の呼び出しで問い合わせる）"""
+        results = {token: self.cache.get(token) for token in tokens}
+        misses = [token for token, result in results.items() if result is None]
+
+        if misses:
+            try:
+                response = self.session.post(
+                    self.batch_url, data={"token": misses}, auth=self.auth, timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                self.errors += 1
+                raise IntrospectionError(str(e)) from e
+            batch = self._parse(response).get("results")
+            if not isinstance(batch, list) or len(batch) != len(misses):
+                self.errors += 1
+                raise IntrospectionError("Unexpected introspection response")
+            for token, result in zip(misses, batch):
+                self._cache_result(token, result)
+                results[token] = result
+
+        return [results[token] for token in tokens]
+
+    def stats(self):
+        return {"cache": self.cache.stats(), "errors": self.errors}
+
+    def close(self):
+        self.session.close()
+
+
+def create_validator():
+    """環境変数からバリデーターを作成（INTROSPECTION_URL 未設定なら None）"""
+    url = os.environ.get("INTROSPECTION_URL")
+    if not url:
+        return None
+    return IntrospectionValidator(
+        url,
+        client_id=os.environ.get("INTROSPECTION_CLIENT_ID", "demo-client-id"),
+        client_secret=os.environ.get("INTROSPECTION_CLIENT_SECRET", "demo-client-secret"),
+        cache_ttl=float(os.environ.get("INTROSPECTION_CACHE_TTL", "30")),
+    )
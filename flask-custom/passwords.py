@@ -0,0 +1,200 @@
+"""
+パスワードのハッシュ化と検証
+
+- scrypt でハッシュ化し、"scrypt$N$r$p$salt$hash" の形式で保存する（パラメータを含むため、コストを変えても既存のハッシュを検証できる）
+- ハッシュ計算は CPU を占有するため、上限付きの ProcessPoolExecutor で実行する
+  （Flask のワーカースレッド・FastAPI のイベントループを止めない）
+- クライアントシークレットも同じ形式で保存し、検証に成功した組み合わせを短時間キャッシュする
+  （トークンエンドポイントへの大量のリクエストで毎回ハッシュを計算しない）
+
+環境変数:
+- PASSWORD_SCRYPT_N / PASSWORD_SCRYPT_R / PASSWORD_SCRYPT_P: 新しく作るハッシュのコスト（デフォルト 2^14 / 8 / 1）
+- PASSWORD_HASH_WORKERS: 検証に使うプロセス数（デフォルト min(4, CPU数)、0 でリクエストを処理するスレッドで検証）
+- CLIENT_SECRET_CACHE_TTL: クライアントシークレットの検証結果をキャッシュする秒数（デフォルト 60、0 でキャッシュしない）
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+SCRYPT_N = int(os.environ.get("PASSWORD_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("PASSWORD_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("PASSWORD_SCRYPT_P", 1))
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+CLIENT_SECRET_CACHE_TTL = float(os.environ.get("CLIENT_SECRET_CACHE_TTL", 60))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # scrypt が使うメモリは 128 * n * r バイト（OpenSSL のデフォルト上限 32MB を超えるコストにも対応）
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=max(32 * 1024 * 1024, 256 * n * r), dklen=32,
+    )
+
+
+def hash_password(password: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> str:
+    """パスワードをハッシュ化"""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, n, r, p)
+    return "$".join([
+        "scrypt", str(n), str(r), str(p),
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode(),
+    ])
+
+
+def verify_password(password: Optional[str], password_hash: str) -> bool:
+    """パスワードがハッシュと一致するか（呼び出したプロセスで計算する）"""
+    if not isinstance(password, str):
+        return False
+    try:
+        scheme, n, r, p, salt, digest = password_hash.split("$")
+    except ValueError:
+        return False
+    if scheme != "scrypt":
+        return False
+    expected = base64.b64decode(digest)
+    return hmac.compare_digest(_scrypt(password, base64.b64decode(salt), int(n), int(r), int(p)), expected)
+
+
+class PasswordVerifier:
+    """パスワードの検証をプロセスプールで実行する"""
+
+    def __init__(self, workers: int = HASH_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # 最初の検証時に作成する（インポートしただけではプロセスを起動しない）
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # ワーカーはハッシュ計算だけを行う
+                    # spawn はサーバーのモジュールを再インポートしてしまうため、使える環境では fork
+                    context = None
+                    if "fork" in multiprocessing.get_all_start_methods():
+                        context = multiprocessing.get_context("fork")
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def check(self, password: Optional[str], password_hash: str) -> bool:
+        """検証が終わるまで待つ（Flask のワーカースレッドから呼ぶ。待っている間は GIL を手放す）"""
+        if self.workers == 0:
+            return verify_password(password, password_hash)
+        return self._get_executor().submit(verify_password, password, password_hash).result()
+
+    async def check_async(self, password: Optional[str], password_hash: str) -> bool:
+        """検証を await する（FastAPI から呼ぶ）"""
+        if self.workers == 0:
+            return verify_password(password, password_hash)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), verify_password, password, password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class CredentialCache:
+    """検証に成功したクライアント認証情報の TTL 付き LRU キャッシュ（スレッドセーフ）
+
+    キーは (client_id, シークレットの HMAC)。平文のシークレットは保持しない
+    検証したハッシュも持ち、シークレットのローテーションで保存されたハッシュが変わったら使わない
+    """
+
+    def __init__(self, ttl=CLIENT_SECRET_CACHE_TTL, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # キーの HMAC 用（プロセスごとに生成）
+        self._key_secret = secrets.token_bytes(32)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, client_id, secret):
+        return client_id, hmac.new(self._key_secret, secret.encode(), hashlib.sha256).digest()
+
+    def get(self, client_id, secret, secret_hash):
+        """キャッシュ済みで、保存されたハッシュが検証時と同じなら True"""
+        key = self._key(client_id, secret)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now or entry[0] != secret_hash:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def set(self, client_id, secret, secret_hash):
+        if self.ttl <= 0:
+            return
+        key = self._key(client_id, secret)
+        with self._lock:
+            self._entries[key] = (secret_hash, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, client_id):
+        """クライアントのエントリをすべて削除（シークレットのローテーション時）"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == client_id]:
+                del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# グローバルインスタンス
+verifier = PasswordVerifier()
+credential_cache = CredentialCache()
+
+# 存在しないユーザーのログインでも同じコストの検証を行うためのハッシュ（応答時間でユーザー名を推測させない）
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_urlsafe(16))
+
+
+def check_client_secret(client_id: str, client_secret: Optional[str], secret_hash: str) -> bool:
+    """クライアントシークレットを検証（Flask から呼ぶ。成功した組み合わせはキャッシュする）"""
+    if not isinstance(client_secret, str):
+        return False
+    if credential_cache.get(client_id, client_secret, secret_hash):
+        return True
+    if not verifier.check(client_secret, secret_hash):
+        return False
+    credential_cache.set(client_id, client_secret, secret_hash)
+    return True
+
+
+async def check_client_secret_async(client_id: str, client_secret: Optional[str], secret_hash: str) -> bool:
+    """クライアントシークレットを検証（FastAPI から呼ぶ。成功した組み合わせはキャッシュする）"""
+    if not isinstance(client_secret, str):
+        return False
+    if credential_cache.get(client_id, client_secret, secret_hash):
+        return True
+    if not await verifier.check_async(client_secret, secret_hash):
+        return False
+    credential_cache.set(client_id, client_secret, secret_hash)
+    return True
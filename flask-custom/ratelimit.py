@@ -0,0 +1,156 @@
+"""
+トークンバケットによるレート制限
+
+/token は接続元 IP ごと・client_id ごと、同意処理（ログイン）は IP ごと・IP + username ごとのトークンバケットで制限する
+上限を超えたら 429 と Retry-After を返す（server.py の before_request）
+
+- バケットは OrderedDict の表に [残りトークン, 最終更新時刻] で持つ
+- 満杯に戻るまでの時間（burst / rate）以上使われていないバケットは満杯と同じなので、古い順に捨てる
+- 表が max_keys を超えたら最も長く使われていないキーから捨てる（大量の IP からのリクエストでもメモリが増え続けない）
+
+環境変数（"毎秒の回数:バースト" の形式、"0" で制限しない。負の値・1 未満のバーストは起動時に ValueError）:
+- RATE_LIMIT_TOKEN: /token（デフォルト 10:20）
+- RATE_LIMIT_CONSENT: 同意処理の IP + username ごと（デフォルト 1:5）
+- RATE_LIMIT_CONSENT_IP: 同意処理の IP ごと（デフォルト 10:50、NAT の背後の複数ユーザーを見込んで高めにする）
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def limit_from_env(name, default):
+    """環境変数 name を (rate, burst) に変換（"0"・空・毎秒の回数が 0 なら制限しない = None）
+
+    数値でない値・負の値・1 未満のバーストは ValueError（起動時に設定ミスに気づけるようにする）
+    """
+    value = os.environ.get(name, default).strip()
+    if value in ("0", ""):
+        return None
+    rate_text, _, burst_text = value.partition(":")
+    try:
+        rate = float(rate_text)
+        burst = float(burst_text or rate_text)
+    except ValueError:
+        raise ValueError(f'{name}={value!r}: expected "rate:burst" (e.g. "10:20"), or "0" to disable') from None
+    if not (math.isfinite(rate) and math.isfinite(burst)) or rate < 0 or burst < 0:
+        raise ValueError(f"{name}={value!r}: rate and burst must be finite and non-negative")
+    if rate == 0:
+        return None
+    if burst < 1:
+        raise ValueError(f"{name}={value!r}: burst must be at least 1 (or set {name}=0 to disable)")
+    return rate, burst
+
+
+class TokenBuckets:
+    """キーごとのトークンバケット（期限付きの表、スレッドセーフ）"""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        if not rate > 0 or not burst >= 1:
+            raise ValueError(f"rate must be positive and burst at least 1 (got {rate}:{burst})")
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # この時間使われていなければ満杯に戻っている
+        self.idle_ttl = burst / rate
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, now):
+        """トークンを1つ使う。使えたら 0、足りなければ次に使えるまでの秒数を返す"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+                bucket = self._buckets[key] = [tokens, now]
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(key)
+            bucket[1] = now
+
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                wait = 0.0
+            else:
+                bucket[0] = tokens
+                wait = (1 - tokens) / self.rate
+
+            # 古いバケットを1つずつ捨てる（満杯に戻ったもの、または上限超過分）
+            oldest_key, oldest = next(iter(self._buckets.items()))
+            if len(self._buckets) > self.max_keys or now - oldest[1] >= self.idle_ttl:
+                if oldest_key != key:
+                    del self._buckets[oldest_key]
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter:
+    """エンドポイントごとに IP・キーのトークンバケットを持つレート制限
+
+    キーは client_id。user_paths のパス（同意処理）は IP + username にする
+    （同じクライアントを使う全ユーザーで1つのバケットを共有しないように）
+    """
+
+    def __init__(self, limits, ip_limits=None, user_paths=()):
+        """limits: パス -> キーごとの (rate, burst)。ip_limits: パス -> IP ごとの (rate, burst)（省略したパスは limits と同じ）"""
+        ip_limits = ip_limits or {}
+        # パス -> (IP ごとのバケット, キーごとのバケット)（制限しない方は None）
+        self.rules = {}
+        for path, limit in limits.items():
+            ip_limit = ip_limits.get(path, limit)
+            if limit is None and ip_limit is None:
+                continue
+            self.rules[path] = (
+                TokenBuckets(*ip_limit) if ip_limit else None,
+                TokenBuckets(*limit) if limit else None,
+            )
+        self.user_paths = set(user_paths)
+        self.limited = 0
+
+    def applies(self, path):
+        return path in self.rules
+
+    def key_for(self, path, ip=None, client_id=None, username=None):
+        """path のキーごとのバケットに使うキー"""
+        if path in self.user_paths:
+            return f"{username}@{ip}" if username else None
+        return client_id
+
+    def check(self, path, ip=None, key=None):
+        """IP・キー（key_for）それぞれのバケットからトークンを使う。制限するなら Retry-After の秒数、しないなら 0"""
+        rule = self.rules.get(path)
+        if rule is None:
+            return 0
+        by_ip, by_key = rule
+        now = time.monotonic()
+        wait = 0.0
+        if ip and by_ip is not None:
+            wait = by_ip.take(ip, now)
+        if key and by_key is not None and not wait:
+            wait = by_key.take(key, now)
+        if not wait:
+            return 0
+        self.limited += 1
+        return max(1, math.ceil(wait))
+
+    def stats(self):
+        def bucket_stats(buckets):
+            if buckets is None:
+                return None
+            return {"rate": buckets.rate, "burst": buckets.burst, "keys": len(buckets)}
+
+        return {
+            "limited": self.limited,
+            "rules": {
+                path: {
+                    "ip": bucket_stats(by_ip),
+                    "key": "ip+username" if path in self.user_paths else "client_id",
+                    "by_key": bucket_stats(by_key),
+                }
+                for path, (by_ip, by_key) in self.rules.items()
+            },
+        }
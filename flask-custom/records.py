@@ -0,0 +1,100 @@
+"""
+認可コード・トークンのレコード（インメモリストレージ用）
+
+dict の代わりに __slots__ のオブジェクトで保持し、1件あたりのメモリを抑える
+
+- 有効期限は整数のエポック秒（expires）で持ち、expires_at で datetime を返す
+- client_id / username / scope は sys.intern して全レコードで同じ文字列オブジェクトを共有する
+- トークン文字列自体はストレージの dict のキーにだけ持つ（値に重複させない）
+- record["username"] のように dict と同じ形でも読める（server.py は dict と区別しない）
+"""
+
+import sys
+from datetime import datetime
+
+
+def to_epoch(expires_at: datetime) -> int:
+    return int(expires_at.timestamp())
+
+
+class Record:
+    """レコードの基底クラス（dict と同じ読み方を提供）"""
+
+    __slots__ = ()
+
+    @property
+    def expires_at(self) -> datetime:
+        return datetime.fromtimestamp(self.expires)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class AuthCodeRecord(Record):
+    """認可コード"""
+
+    __slots__ = ("client_id", "redirect_uri", "scope", "username", "expires")
+
+    def __init__(self, client_id, redirect_uri, scope, username, expires):
+        self.client_id = sys.intern(client_id)
+        self.redirect_uri = sys.intern(redirect_uri)
+        self.scope = sys.intern(scope)
+        self.username = sys.intern(username)
+        self.expires = expires
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["client_id"], data["redirect_uri"], data["scope"], data["username"],
+            to_epoch(data["expires_at"]),
+        )
+
+
+class AccessTokenRecord(Record):
+    """アクセストークン"""
+
+    __slots__ = ("client_id", "scope", "username", "family_id", "expires")
+
+    # 発行するトークンは Bearer のみ（レコードには持たない）
+    token_type = "Bearer"
+
+    def __init__(self, client_id, scope, username, family_id, expires):
+        self.client_id = sys.intern(client_id)
+        self.scope = sys.intern(scope)
+        self.username = sys.intern(username)
+        self.family_id = family_id
+        self.expires = expires
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["client_id"], data["scope"], data["username"], data.get("family_id"),
+            to_epoch(data["expires_at"]),
+        )
+
+
+class RefreshTokenRecord(Record):
+    """リフレッシュトークン"""
+
+    __slots__ = ("client_id", "scope", "username", "family_id", "used", "expires")
+
+    def __init__(self, client_id, scope, username, family_id, used, expires):
+        self.client_id = sys.intern(client_id)
+        self.scope = sys.intern(scope)
+        self.username = sys.intern(username)
+        self.family_id = family_id
+        self.used = used
+        self.expires = expires
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["client_id"], data["scope"], data["username"], data["family_id"],
+            bool(data.get("used")), to_epoch(data["expires_at"]),
+        )
@@ -4,16 +4,66 @@ OAuth 2.0 認可サーバー + リソースサーバー (Flask版)
 Flask による自前実装
 """
 
-from flask import Flask, request, render_template_string, redirect, jsonify
+from flask import Flask, request, redirect, jsonify
+import json
+import os
 import secrets
+import zlib
 from typing import Optional
 from datetime import datetime, timedelta
 from functools import wraps
 
 from storage import storage
+from expiry import Sweeper
+from introspection import IntrospectionError, create_validator
+import passwords
+from post_index import in_int64_range, parse_timestamp
+from response_cache import response_cache
+from ratelimit import RateLimiter, limit_from_env
 
 app = Flask(__name__)
 
+# 期限切れの認可コード・アクセストークンをバックグラウンドで削除
+sweeper = Sweeper(storage, interval=1.0, batch_size=1000)
+sweeper.start()
+
+# INTROSPECTION_URL 設定時は認可サーバーに問い合わせてトークンを検証（リソースサーバー単独運用）
+introspection_validator = create_validator()
+# 認可サーバーに問い合わせられないときの 503 のヘッダー
+INTROSPECTION_UNAVAILABLE_HEADERS = {
+    "WWW-Authenticate": 'Bearer error="temporarily_unavailable", error_description="Token introspection failed"',
+    "Retry-After": "1",
+}
+
+# 管理API（一括失効）の認証トークン（X-Admin-Token ヘッダーで渡す）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "demo-admin-token")
+
+# 同意処理で受け付けるスコープの最大長（認可コードと一緒に保存するため）
+MAX_SCOPE_LENGTH = 512
+
+# /token は IP ごと・client_id ごと、同意処理は IP ごと・IP + username ごとのレート制限
+rate_limiter = RateLimiter({
+    "/token": limit_from_env("RATE_LIMIT_TOKEN", "10:20"),
+    "/authorize/consent": limit_from_env("RATE_LIMIT_CONSENT", "1:5"),
+}, ip_limits={
+    "/authorize/consent": limit_from_env("RATE_LIMIT_CONSENT_IP", "10:50"),
+}, user_paths=["/authorize/consent"])
+
+
+@app.before_request
+def rate_limit():
+    """制限対象のエンドポイントで上限を超えたら 429 を返す"""
+    if request.method != "POST" or not rate_limiter.applies(request.path):
+        return None
+    client_id = request.form.get("client_id")
+    if not client_id and request.authorization:
+        client_id = request.authorization.username
+    key = rate_limiter.key_for(request.path, request.remote_addr, client_id, request.form.get("username"))
+    retry_after = rate_limiter.check(request.path, request.remote_addr, key)
+    if not retry_after:
+        return None
+    return jsonify({"error": "too_many_requests"}), 429, {"Retry-After": str(retry_after)}
+
 
 # ===== トークン検証デコレータ =====
 
@@ -31,13 +81,26 @@ def require_oauth(f):
             return jsonify({"error": "Invalid authorization header"}), 401
 
         token = parts[1]
-        token_data = storage.access_tokens.get(token)
+
+        # 別プロセスの認可サーバーに問い合わせ（結果はキャッシュされる）
+        if introspection_validator:
+            try:
+                result = introspection_validator.introspect(token)
+            except IntrospectionError:
+                # トークンが無効とは限らないので 401 にしない（クライアントに再ログインさせない）
+                return jsonify({"error": "temporarily_unavailable"}), 503, INTROSPECTION_UNAVAILABLE_HEADERS
+            if not result.get("active"):
+                return jsonify({"error": "Invalid token"}), 401, {"WWW-Authenticate": 'Bearer error="invalid_token"'}
+            return f(token_data_from_introspection(result), *args, **kwargs)
+
+        token_data = storage.get_access_token(token)
 
         if not token_data:
             return jsonify({"error": "Invalid token"}), 401
 
         # 期限切れチェック
         if datetime.now() > token_data["expires_at"]:
+            storage.delete_access_token(token)
             return jsonify({"error": "Token expired"}), 401
 
         # token_data を関数に渡す
@@ -46,47 +109,34 @@ def require_oauth(f):
     return decorated_function
 
 
-# ===== 認可サーバーのエンドポイント =====
-
-@app.route("/authorize")
-def authorize():
-    """
-    認可エンドポイント
-    クライアントからのリクエストを受け取り、ユーザーにログイン・同意画面を表示
-    """
-    response_type = request.args.get('response_type')
-    client_id = request.args.get('client_id')
-    redirect_uri = request.args.get('redirect_uri')
-    state = request.args.get('state', '')
-    scope = request.args.get('scope', '')
-
-    # クライアントIDの検証
-    if client_id not in storage.clients:
-        return "Invalid client_id", 400
+def token_data_from_introspection(result):
+    """イントロスペクション結果を token_data と同じ形に変換"""
+    return {
+        "token_type": result.get("token_type", "Bearer"),
+        "scope": result.get("scope", ""),
+        "expires_at": datetime.fromtimestamp(result["exp"]),
+        "username": result["username"],
+        "client_id": result["client_id"],
+    }
 
-    # redirect_uriの検証
-    if redirect_uri not in storage.clients[client_id]["redirect_uris"]:
-        return "Invalid redirect_uri", 400
 
-    # response_typeの検証（認可コードフローのみサポート）
-    if response_type != "code":
-        return "Unsupported response_type", 400
+# ===== 認可サーバーのエンドポイント =====
 
-    # ログイン・同意画面を表示（簡易実装）
-    html = f"""
+# ログイン・同意画面（起動時に1回だけコンパイルする。パラメータは自動でエスケープされる）
+CONSENT_TEMPLATE = app.jinja_env.from_string("""
     <html>
         <head><title>OAuth 2.0 Authorization (Flask)</title></head>
         <body>
             <h2>ログイン (Flask版)</h2>
             <form method="post" action="/authorize/consent">
-                <input type="hidden" name="client_id" value="{client_id}">
-                <input type="hidden" name="redirect_uri" value="{redirect_uri}">
-                <input type="hidden" name="response_type" value="{response_type}">
-                <input type="hidden" name="state" value="{state}">
-                <input type="hidden" name="scope" value="{scope}">
+                <input type="hidden" name="client_id" value="{{ client_id }}">
+                <input type="hidden" name="redirect_uri" value="{{ redirect_uri }}">
+                <input type="hidden" name="response_type" value="{{ response_type }}">
+                <input type="hidden" name="state" value="{{ state }}">
+                <input type="hidden" name="scope" value="{{ scope }}">
 
                 <p>クライアント: Demo Client</p>
-                <p>スコープ: {scope}</p>
+                <p>スコープ: {{ scope }}</p>
 
                 <label>ユーザー名: </label>
                 <input type="text" name="username" value="demo-user" required>
@@ -100,9 +150,42 @@ def authorize():
             </form>
         </body>
     </html>
+""")
+
+
+@app.route("/authorize")
+def authorize():
     """
+    認可エンドポイント
+    クライアントからのリクエストを受け取り、ユーザーにログイン・同意画面を表示
+    """
+    response_type = request.args.get('response_type')
+    client_id = request.args.get('client_id')
+    redirect_uri = request.args.get('redirect_uri')
+    state = request.args.get('state', '')
+    scope = request.args.get('scope', '')
 
-    return render_template_string(html)
+    # クライアントIDの検証
+    client = storage.get_client(client_id)
+    if not client:
+        return "Invalid client_id", 400
+
+    # redirect_uriの検証
+    if redirect_uri not in client["redirect_uris"]:
+        return "Invalid redirect_uri", 400
+
+    # response_typeの検証（認可コードフローのみサポート）
+    if response_type != "code":
+        return "Unsupported response_type", 400
+
+    # ログイン・同意画面を表示（簡易実装）
+    return CONSENT_TEMPLATE.render(
+        client_id=client_id,
+        redirect_uri=redirect_uri,
+        response_type=response_type,
+        state=state,
+        scope=scope,
+    )
 
 
 @app.route("/authorize/consent", methods=['POST'])
@@ -118,23 +201,34 @@ def authorize_consent():
     state = request.form.get('state', '')
     scope = request.form.get('scope', '')
 
+    # クライアントID・redirect_uri・スコープの検証（同意画面を経由しない POST もあるため再度行う）
+    client = storage.get_client(client_id)
+    if not client:
+        return "Invalid client_id", 400
+    if redirect_uri not in client["redirect_uris"]:
+        return "Invalid redirect_uri", 400
+    if len(scope) > MAX_SCOPE_LENGTH:
+        return "Invalid scope", 400
+
     # ユーザー認証
-    user = storage.users.get(username)
-    if not user or user["password"] != password:
+    user = storage.get_user(username)
+    # ユーザーがいなくてもダミーのハッシュで検証する（応答時間でユーザー名の有無がわからないように）
+    password_hash = user["password_hash"] if user else passwords.DUMMY_PASSWORD_HASH
+    if not passwords.verifier.check(password, password_hash) or not user:
         return "Invalid credentials", 401
 
     # 認可コード生成
     code = secrets.token_urlsafe(32)
 
     # 認可コードを保存
-    storage.auth_codes[code] = {
+    storage.save_auth_code(code, {
         "code": code,
         "client_id": client_id,
         "redirect_uri": redirect_uri,
         "scope": scope,
         "username": username,
         "expires_at": datetime.now() + timedelta(minutes=10),
-    }
+    })
 
     # クライアントにリダイレクト
     redirect_url = f"{redirect_uri}?code={code}"
@@ -144,68 +238,354 @@ def authorize_consent():
     return redirect(redirect_url, code=302)
 
 
+# リフレッシュトークンの有効期限
+REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+
+
 @app.route("/token", methods=['POST'])
 def token():
     """
     トークンエンドポイント
-    認可コードをアクセストークンと交換
+    認可コード・リフレッシュトークンをアクセストークンと交換
     """
     grant_type = request.form.get('grant_type')
-    code = request.form.get('code')
-    redirect_uri = request.form.get('redirect_uri')
     client_id = request.form.get('client_id')
     client_secret = request.form.get('client_secret')
 
     # grant_type の検証
-    if grant_type != "authorization_code":
+    if grant_type not in ("authorization_code", "refresh_token"):
         return jsonify({"error": "unsupported_grant_type"}), 400
 
     # クライアント認証
-    client = storage.clients.get(client_id)
-    if not client or client["client_secret"] != client_secret:
+    client = storage.get_client(client_id)
+    if not client or not passwords.check_client_secret(
+        client_id, client_secret, client["client_secret_hash"]
+    ):
         return jsonify({"error": "invalid_client"}), 401
 
-    # 認可コード検証
-    auth_code_data = storage.auth_codes.get(code)
+    if grant_type == "refresh_token":
+        return refresh_token_grant(client_id)
+
+    code = request.form.get('code')
+    redirect_uri = request.form.get('redirect_uri')
+
+    # 認可コードを検証して取り出す（使い捨て）
+    # 期限・redirect_uri・クライアントID の検証と削除をまとめて行い、同じコードの同時交換は1つだけが成功する
+    now = datetime.now()
+    auth_code_data = storage.pop_auth_code_if_valid(code, lambda data: (
+        now <= data["expires_at"]
+        and data["redirect_uri"] == redirect_uri
+        and data["client_id"] == client_id
+    ))
     if not auth_code_data:
         return jsonify({"error": "invalid_grant"}), 400
 
-    # 期限切れチェック
-    if datetime.now() > auth_code_data["expires_at"]:
+    # 新しいトークンファミリーとして発行
+    return issue_tokens(
+        auth_code_data["username"], client_id, auth_code_data["scope"], secrets.token_urlsafe(16)
+    )
+
+
+def refresh_token_grant(client_id):
+    """
+    リフレッシュトークンによるアクセストークンの再発行
+    リフレッシュトークンは使い捨て（ローテーション）で、使用済みのものが再提示されたら
+    漏洩とみなしてファミリー全体を失効させる
+    """
+    refresh_token = request.form.get('refresh_token')
+    refresh_data = storage.get_refresh_token(refresh_token) if refresh_token else None
+    if not refresh_data or refresh_data["client_id"] != client_id:
+        return jsonify({"error": "invalid_grant"}), 400
+
+    family_id = refresh_data["family_id"]
+
+    # 使用済みトークンの再利用 → ファミリー内のアクセストークン・リフレッシュトークンをまとめて無効化
+    if refresh_data["used"]:
+        storage.revoke_family(family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
         return jsonify({"error": "invalid_grant"}), 400
 
-    # redirect_uri の検証
-    if auth_code_data["redirect_uri"] != redirect_uri:
+    if storage.is_family_revoked(family_id) or datetime.now() > refresh_data["expires_at"]:
         return jsonify({"error": "invalid_grant"}), 400
 
-    # クライアントID の検証
-    if auth_code_data["client_id"] != client_id:
+    # 未使用 → 使用済みの書き換えに成功したリクエストだけが新しいトークンを受け取る
+    # 同じトークンで同時に来た他方（別のスレッド・プロセスを含む）は再利用として扱う
+    if not storage.mark_refresh_token_used(refresh_token):
+        storage.revoke_family(family_id, datetime.now() + REFRESH_TOKEN_LIFETIME)
         return jsonify({"error": "invalid_grant"}), 400
 
-    # アクセストークン生成
+    return issue_tokens(refresh_data["username"], client_id, refresh_data["scope"], family_id)
+
+
+def issue_tokens(username, client_id, scope, family_id):
+    """アクセストークンとリフレッシュトークンを発行してトークンレスポンスを返す"""
     access_token = secrets.token_urlsafe(32)
+    refresh_token = secrets.token_urlsafe(32)
+    now = datetime.now()
 
-    storage.access_tokens[access_token] = {
+    storage.save_access_token(access_token, {
         "access_token": access_token,
         "token_type": "Bearer",
-        "scope": auth_code_data["scope"],
-        "expires_at": datetime.now() + timedelta(hours=1),
-        "username": auth_code_data["username"],
+        "scope": scope,
+        "expires_at": now + timedelta(hours=1),
+        "username": username,
         "client_id": client_id,
-    }
-
-    # 認可コード削除（使い捨て）
-    del storage.auth_codes[code]
+        "family_id": family_id,
+    })
+    storage.save_refresh_token(refresh_token, {
+        "scope": scope,
+        "expires_at": now + REFRESH_TOKEN_LIFETIME,
+        "username": username,
+        "client_id": client_id,
+        "family_id": family_id,
+        "used": False,
+    })
 
     # トークンレスポンス
     return jsonify({
         "access_token": access_token,
         "token_type": "Bearer",
         "expires_in": 3600,
-        "scope": auth_code_data["scope"],
+        "refresh_token": refresh_token,
+        "scope": scope,
     })
 
 
+def authenticate_client():
+    """
+    クライアント認証（client_secret_basic / client_secret_post）
+    認証できたら client_id を返す
+    """
+    if request.authorization and request.authorization.type == 'basic':
+        client_id = request.authorization.username
+        client_secret = request.authorization.password
+    else:
+        client_id = request.form.get('client_id')
+        client_secret = request.form.get('client_secret')
+
+    client = storage.get_client(client_id)
+    if not client or not passwords.check_client_secret(
+        client_id, client_secret, client["client_secret_hash"]
+    ):
+        return None
+    return client_id
+
+
+def introspection_payload(token):
+    """トークンのイントロスペクション結果（RFC 7662）"""
+    token_data = storage.get_access_token(token) if token else None
+    if not token_data or datetime.now() > token_data["expires_at"]:
+        return {"active": False}
+
+    return {
+        "active": True,
+        "token_type": "Bearer",
+        "scope": token_data["scope"],
+        "client_id": token_data["client_id"],
+        "username": token_data["username"],
+        "exp": int(token_data["expires_at"].timestamp()),
+    }
+
+
+@app.route("/introspect", methods=['POST'])
+def introspect():
+    """
+    イントロスペクションエンドポイント（RFC 7662）
+    リソースサーバーがトークンの有効性と属性を問い合わせる
+    """
+    if not authenticate_client():
+        return jsonify({"error": "invalid_client"}), 401
+
+    token = request.form.get('token')
+    if not token:
+        return jsonify({"error": "invalid_request"}), 400
+
+    return jsonify(introspection_payload(token))
+
+
+@app.route("/introspect/batch", methods=['POST'])
+def introspect_batch():
+    """
+    イントロスペクションエンドポイント（バッチ）
+    token パラメータを複数指定し、同じ順序で結果を返す
+    """
+    if not authenticate_client():
+        return jsonify({"error": "invalid_client"}), 401
+
+    tokens = request.form.getlist('token')
+    return jsonify({"results": [introspection_payload(token) for token in tokens]})
+
+
+def revoke_token(token, token_type_hint, client_id):
+    """
+    クライアント自身に発行されたトークンを失効
+    リフレッシュトークンは同じ認可から発行されたアクセストークンもまとめて無効化する
+    """
+    kinds = ["access_token", "refresh_token"]
+    if token_type_hint == "refresh_token":
+        kinds.reverse()
+
+    for kind in kinds:
+        if kind == "access_token":
+            token_data = storage.get_access_token(token)
+            if token_data and token_data["client_id"] == client_id:
+                storage.delete_access_token(token)
+                return
+        else:
+            refresh_data = storage.get_refresh_token(token)
+            if refresh_data and refresh_data["client_id"] == client_id:
+                storage.revoke_family(refresh_data["family_id"], refresh_data["expires_at"])
+                storage.delete_refresh_token(token)
+                return
+
+
+@app.route("/revoke", methods=['POST'])
+def revoke():
+    """
+    トークン失効エンドポイント（RFC 7009）
+    不明なトークンでも 200 を返す
+    """
+    client_id = authenticate_client()
+    if not client_id:
+        return jsonify({"error": "invalid_client"}), 401
+
+    token = request.form.get('token')
+    if not token:
+        return jsonify({"error": "invalid_request"}), 400
+
+    revoke_token(token, request.form.get('token_type_hint'), client_id)
+    return "", 200
+
+
+@app.route("/admin/revoke", methods=['POST'])
+def admin_revoke():
+    """
+    ユーザー・クライアント単位の一括失効（管理用）
+    username または client_id を指定する
+    """
+    # str どうしの compare_digest は ASCII 以外で TypeError になるため bytes で比べる
+    admin_token = request.headers.get('X-Admin-Token', '').encode("utf-8", "surrogateescape")
+    if not secrets.compare_digest(admin_token, ADMIN_TOKEN.encode()):
+        return jsonify({"error": "unauthorized"}), 401
+
+    username = request.form.get('username')
+    client_id = request.form.get('client_id')
+    if username:
+        revoked = storage.revoke_user_tokens(username)
+    elif client_id:
+        revoked = storage.revoke_client_tokens(client_id)
+    else:
+        return jsonify({"error": "invalid_request"}), 400
+
+    return jsonify({"revoked": revoked})
+
+
+# ===== 条件付きレスポンス（ETag） =====
+
+# Bearer トークンで保護されたレスポンスなので共有キャッシュには保存させず、毎回 ETag で再検証させる
+CACHE_CONTROL = "private, no-cache"
+# /api/me・/api/profile は変更が少ないため、PROFILE_MAX_AGE 秒は再検証なしで使わせる（0 なら毎回再検証）
+PROFILE_MAX_AGE = int(os.environ.get("PROFILE_MAX_AGE", "5"))
+PROFILE_CACHE_CONTROL = f"private, max-age={PROFILE_MAX_AGE}" if PROFILE_MAX_AGE > 0 else CACHE_CONTROL
+
+
+def make_etag(kind, username, version):
+    """ストレージのバージョンカウンタから強い ETag を作る（ユーザーごとに異なる値になるよう username の CRC を含める）"""
+    return "%s-%d-%08x" % (kind, version, zlib.crc32(username.encode()))
+
+
+def not_modified(etag, cache_control=CACHE_CONTROL):
+    """304（本文を作らない）"""
+    return with_etag(app.response_class(status=304), etag, cache_control)
+
+
+def cached_json(body, etag, cache_control=CACHE_CONTROL):
+    """シリアライズ済みのバイト列をそのまま返す（jsonify を通さない）"""
+    return with_etag(app.response_class(body, mimetype="application/json"), etag, cache_control)
+
+
+def with_etag(response, etag, cache_control=CACHE_CONTROL):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+# ===== 投稿一覧のページング・ストリーミング =====
+
+NDJSON = "application/x-ndjson"
+# 1ページの件数（limit のデフォルトと上限）
+POSTS_PAGE_SIZE = 100
+POSTS_MAX_PAGE_SIZE = 1000
+# ストリーミング時にストレージから一度に読む件数
+POSTS_STREAM_CHUNK = 500
+
+
+def stream_posts(fetch, after, limit):
+    """fetch(after, 件数) で投稿を POSTS_STREAM_CHUNK 件ずつ読んで NDJSON の行を返す（投稿数によらずメモリは一定）"""
+    while limit is None or limit > 0:
+        chunk = POSTS_STREAM_CHUNK if limit is None else min(POSTS_STREAM_CHUNK, limit)
+        posts = fetch(after, chunk)
+        for post in posts:
+            yield json.dumps(post) + "\n"
+        if len(posts) < chunk:
+            return
+        after = posts[-1]["id"]
+        if limit is not None:
+            limit -= len(posts)
+
+
+def posts_response(username):
+    """
+    投稿一覧のレスポンス（カーソルページング）
+
+    - limit: 件数（デフォルト POSTS_PAGE_SIZE、最大 POSTS_MAX_PAGE_SIZE）
+    - after: 前のページの next_cursor（この id の投稿より後を返す）
+    - since・until: created_at の範囲（エポック秒または ISO 8601、since を含み until を含まない）
+      指定すると created_at 順（索引の二分探索で範囲を求める）、省略すると id 順
+    - Accept: application/x-ndjson なら1行1件でストリーミングする（limit を省略するとすべて）
+    """
+    limit = request.args.get("limit", type=int)
+    after = request.args.get("after", type=int)
+    if limit is not None and not 1 <= limit <= POSTS_MAX_PAGE_SIZE:
+        return jsonify({"error": "invalid_request"}), 400
+    if after is not None and not in_int64_range(after):
+        return jsonify({"error": "invalid_request"}), 400
+    try:
+        since, until = (
+            None if value is None else parse_timestamp(value)
+            for value in (request.args.get("since"), request.args.get("until"))
+        )
+    except ValueError:
+        return jsonify({"error": "invalid_request"}), 400
+
+    if since is None and until is None:
+        def fetch(after, count):
+            return storage.get_posts_page(username, after, count)
+    else:
+        def fetch(after, count):
+            return storage.get_posts_range(username, since, until, after, count)
+
+    if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        # ページを読みながら返すため、途中で投稿が追加されることがある（ETag は付けない）
+        return app.response_class(
+            stream_posts(fetch, after, limit), mimetype=NDJSON, headers={"Cache-Control": CACHE_CONTROL},
+        )
+
+    # バージョンはデータより先に読む（後に読むと、新しい ETag で古い本文を返すことがある）
+    etag = make_etag("posts", username, storage.get_posts_version(username))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    limit = limit or POSTS_PAGE_SIZE
+    # 1件多く読んで次のページがあるかを判定する
+    posts = fetch(after, limit + 1)
+    next_cursor = posts[limit - 1]["id"] if len(posts) > limit else None
+
+    return with_etag(jsonify({
+        "username": username,
+        "posts": posts[:limit],
+        "next_cursor": next_cursor,
+    }), etag)
+
+
 # ===== リソースサーバーのエンドポイント（保護されたAPI） =====
 
 @app.route("/api/me")
@@ -213,13 +593,22 @@ def token():
 def get_user_info(token_data):
     """ユーザー情報取得API"""
     username = token_data["username"]
-    user = storage.users.get(username)
-
-    return jsonify({
-        "username": username,
-        "name": user["name"],
-        "email": user["email"],
-    })
+    # バージョンはデータより先に読む（後に読むと、新しい ETag で古い本文を返すことがある）
+    version = storage.get_user_version(username)
+    etag = make_etag("me", username, version)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("me", username, version)
+    if body is None:
+        user = storage.get_user(username)
+        body = response_cache.put("me", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
 
 @app.route("/api/profile")
@@ -230,15 +619,23 @@ def get_user_profile(token_data):
     Bearer トークンで保護された詳細情報
     """
     username = token_data["username"]
-    user = storage.users.get(username)
-
-    return jsonify({
-        "username": username,
-        "name": user["name"],
-        "email": user["email"],
-        "bio": user["bio"],
-        "location": user["location"],
-    })
+    version = storage.get_user_version(username)
+    etag = make_etag("profile", username, version)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, PROFILE_CACHE_CONTROL)
+
+    # 同じバージョンならシリアライズ済みのバイト列を返す
+    body = response_cache.get("profile", username, version)
+    if body is None:
+        user = storage.get_user(username)
+        body = response_cache.put("profile", username, version, {
+            "username": username,
+            "name": user["name"],
+            "email": user["email"],
+            "bio": user["bio"],
+            "location": user["location"],
+        })
+    return cached_json(body, etag, PROFILE_CACHE_CONTROL)
 
 
 @app.route("/api/posts")
@@ -246,15 +643,40 @@ def get_user_profile(token_data):
 def get_user_posts(token_data):
     """
     ユーザーの投稿一覧取得API
-    Bearer トークンで保護されたリソース
+    Bearer トークンで保護されたリソース（limit・after でページング）
     """
     username = token_data["username"]
-    posts = storage.posts.get(username, [])
+    return posts_response(username)
 
-    return jsonify({
-        "username": username,
-        "posts": posts,
-    })
+
+@app.route("/api/posts/<int:post_id>")
+@require_oauth
+def get_user_post(token_data, post_id):
+    """投稿の取得API（id のハッシュで引く）"""
+    username = token_data["username"]
+    etag = make_etag(f"post{post_id}", username, storage.get_posts_version(username))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    # SQLite に渡せない id は存在しない投稿として扱う
+    post = storage.get_post(username, post_id) if in_int64_range(post_id) else None
+
+    if post is None:
+        return jsonify({"error": "not_found"}), 404
+    return with_etag(jsonify(post), etag)
+
+
+# ===== 運用メトリクス =====
+
+@app.route("/metrics")
+def metrics():
+    """ライブエントリ数とスイープコスト（ノードのサイジング用）"""
+    stats = storage.stats()
+    stats["client_secret_cache"] = passwords.credential_cache.stats()
+    stats["response_cache"] = response_cache.stats()
+    stats["rate_limit"] = rate_limiter.stats()
+    if introspection_validator:
+        stats["introspection"] = introspection_validator.stats()
+    return jsonify(stats)
 
 
 # ===== サーバー情報 =====
@@ -269,9 +691,11 @@ def root():
         "endpoints": {
             "authorization": "http://localhost:5000/authorize",
             "token": "http://localhost:5000/token",
+            "introspection": "http://localhost:5000/introspect",
+            "revocation": "http://localhost:5000/revoke",
             "userinfo": "http://localhost:5000/api/me",
         },
-        "supported_grant_types": ["authorization_code"],
+        "supported_grant_types": ["authorization_code", "refresh_token"],
     })
 
 
@@ -0,0 +1,62 @@
+"""
+ロックをストライプしたシャード分割の dict（インメモリストレージ用）
+
+Flask のサーバーは複数スレッドでリクエストを処理するため、
+認可コードの「読み出し → 検証 → 削除」を1つの操作にする必要がある
+
+- キーのハッシュでシャードを選び、シャードごとのロックで排他する
+- 別のシャードのキーへの操作は別のロックを取るため、1つのグローバルロックで直列化しない
+- pop_if_valid は検証と削除をシャードのロック内で行い、同じキーを同時に取り出しても1つのスレッドだけが受け取る
+- apply は値の読み出しと書き換えをシャードのロック内で行う（リフレッシュトークンの使用済み化の compare-and-set）
+"""
+
+import threading
+
+
+class ShardedDict:
+    """シャードごとにロックを持つ dict"""
+
+    def __init__(self, shards=16):
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _index(self, key):
+        return hash(key) % len(self._shards)
+
+    def get(self, key, default=None):
+        # 単一キーの読み出しは dict 自体がアトミックなのでロックを取らない
+        return self._shards[self._index(key)].get(key, default)
+
+    def __setitem__(self, key, value):
+        index = self._index(key)
+        with self._locks[index]:
+            self._shards[index][key] = value
+
+    def pop(self, key, default=None):
+        index = self._index(key)
+        with self._locks[index]:
+            return self._shards[index].pop(key, default)
+
+    def pop_if_valid(self, key, is_valid):
+        """is_valid(値) が真なら取り出して削除する（偽・存在しなければ None で、値は残す）"""
+        index = self._index(key)
+        with self._locks[index]:
+            shard = self._shards[index]
+            value = shard.get(key)
+            if value is None or not is_valid(value):
+                return None
+            del shard[key]
+            return value
+
+    def apply(self, key, func):
+        """シャードのロック内で func(値) を呼んで結果を返す（存在しなければ None）"""
+        index = self._index(key)
+        with self._locks[index]:
+            value = self._shards[index].get(key)
+            return None if value is None else func(value)
+
+    def __contains__(self, key):
+        return key in self._shards[self._index(key)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
@@ -0,0 +1,519 @@
+"""
+OAuth 2.0 ストレージ（共有メモリ実装）
+
+uvicorn --workers N や prefork サーバーで複数ワーカープロセスを動かすとき、
+認可コード・トークン・失効ファミリーをホスト内の全ワーカーで共有する（外部サービス不要）
+
+- /dev/shm 上のファイルを mmap した固定長スロットのハッシュテーブル（オープンアドレス法）
+- 書き込みはスロット単位でロック（プロセス内はストライプロック、プロセス間は fcntl のバイト範囲ロック）
+- 読み込みはスロットのバージョン番号で整合性を確認するためロック不要（seqlock）
+- クライアント・ユーザー・投稿は各プロセスのメモリに持つ（デモデータのみ）
+- ユーザー・クライアント単位の一括失効は失効時刻（ウォーターマーク）で行う
+  （可変長のセカンダリインデックスは固定長スロットに載らないため）
+- スロットに収まらない値（長いスコープなど）は大きいスロットのオーバーフロー表に置き、
+  元のスロットにはダイジェストだけを書く
+"""
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from expiry import SweepStats
+from storage import MemoryStorage
+
+
+MAGIC = b"OAUTHSHM"
+# マジック, スロット数, スロット長
+HEADER = struct.Struct("<8sQQ")
+HEADER_SIZE = 64
+# バージョン, 状態, キー長, 値の長さ, 有効期限
+SLOT_HEADER = struct.Struct("<IBBHd")
+KEY_SIZE = 64
+SLOT_SIZE = 320
+VALUE_SIZE = SLOT_SIZE - SLOT_HEADER.size - KEY_SIZE
+OVERFLOW_SLOT_SIZE = 4096
+# オーバーフロー表に置いた値の目印（JSON の値は "[" で始まるので区別できる）
+OVERFLOW_MARKER = b"@"
+
+EMPTY, USED, DELETED = 0, 1, 2
+# 1キーあたりの最大探索スロット数
+MAX_PROBE = 64
+LOCK_STRIPES = 64
+# 失効ウォーターマークの保持期間（最も長いリフレッシュトークンの有効期限）
+REVOCATION_TTL = 30 * 24 * 3600
+
+
+class TableFullError(Exception):
+    """空きスロットが見つからない"""
+
+
+class SharedHashTable:
+    """mmap した固定長スロットのハッシュテーブル（複数プロセスで共有）"""
+
+    def __init__(self, path, slots=65536, slot_size=SLOT_SIZE):
+        self.path = path
+        self.slot_size = slot_size
+        self.value_size = slot_size - SLOT_HEADER.size - KEY_SIZE
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # 最初に開いたプロセスだけが初期化する
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, HEADER_SIZE + slots * slot_size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, slots, slot_size), 0)
+            magic, self.slots, slot_size = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+        if magic != MAGIC or slot_size != self.slot_size:
+            raise ValueError(f"Incompatible shared table: {path}")
+
+        self._mm = mmap.mmap(self._fd, HEADER_SIZE + self.slots * self.slot_size)
+        # fcntl のロックはプロセス単位なので、同一プロセス内のスレッドはこちらで排他
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._sweep_cursor = 0
+        self.probes = 0
+        self.read_retries = 0
+
+    # ===== スロット操作 =====
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+    def _probe(self, key_bytes):
+        """キーの探索順にスロット番号を返す"""
+        start = int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little") % self.slots
+        for i in range(min(MAX_PROBE, self.slots)):
+            yield (start + i) % self.slots
+
+    def _lock(self, index):
+        stripe = self._stripes[index % LOCK_STRIPES]
+        stripe.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, self._offset(index))
+        return stripe
+
+    def _unlock(self, index, stripe):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, self._offset(index))
+        stripe.release()
+
+    def _read(self, index):
+        """スロットを一貫した状態で読む（書き込み中ならリトライ）"""
+        offset = self._offset(index)
+        while True:
+            data = self._mm[offset:offset + self.slot_size]
+            version, state, key_len, value_len, expires_at = SLOT_HEADER.unpack_from(data)
+            # 書き込み中（奇数）か、読んでいる間に書き換わった場合はやり直す
+            if version % 2 == 0 and SLOT_HEADER.unpack_from(self._mm, offset)[0] == version:
+                return state, data[SLOT_HEADER.size:SLOT_HEADER.size + key_len], value_len, expires_at, data
+            self.read_retries += 1
+
+    def _write(self, index, state, key_bytes=b"", value_bytes=b"", expires_at=0.0):
+        """ロック済みのスロットに書き込む"""
+        offset = self._offset(index)
+        version = SLOT_HEADER.unpack_from(self._mm, offset)[0]
+        # 奇数 = 書き込み中
+        struct.pack_into("<I", self._mm, offset, version + 1)
+        key_offset = offset + SLOT_HEADER.size
+        self._mm[key_offset:key_offset + len(key_bytes)] = key_bytes
+        value_offset = key_offset + KEY_SIZE
+        self._mm[value_offset:value_offset + len(value_bytes)] = value_bytes
+        SLOT_HEADER.pack_into(
+            self._mm, offset, version + 1, state, len(key_bytes), len(value_bytes), expires_at
+        )
+        struct.pack_into("<I", self._mm, offset, version + 2)
+
+    # ===== 公開API =====
+
+    def put(self, key, value: bytes, expires_at: float):
+        """キーを保存（既存のキーは上書き）"""
+        key_bytes = key.encode()
+        if len(key_bytes) > KEY_SIZE or len(value) > self.value_size:
+            raise ValueError("Key or value too large for a slot")
+
+        now = time.time()
+        free = None
+        for index in self._probe(key_bytes):
+            self.probes += 1
+            state, slot_key, _, slot_expires_at, _ = self._read(index)
+            if state == USED and slot_key == key_bytes:
+                free = index
+                break
+            reusable = state == DELETED or (state == USED and slot_expires_at <= now)
+            if reusable and free is None:
+                free = index
+            if state == EMPTY:
+                if free is None:
+                    free = index
+                break
+
+        if free is None:
+            raise TableFullError(self.path)
+
+        stripe = self._lock(free)
+        try:
+            state, slot_key, _, slot_expires_at, _ = self._read(free)
+            # ロックを取るまでの間に他のプロセスが使った場合はやり直す
+            if state == USED and slot_key != key_bytes and slot_expires_at > now:
+                return self.put(key, value, expires_at)
+            self._write(free, USED, key_bytes, value, expires_at)
+        finally:
+            self._unlock(free, stripe)
+
+    def _find(self, key_bytes):
+        for index in self._probe(key_bytes):
+            self.probes += 1
+            state, slot_key, value_len, expires_at, data = self._read(index)
+            if state == EMPTY:
+                return None
+            if state == USED and slot_key == key_bytes:
+                value_offset = SLOT_HEADER.size + KEY_SIZE
+                return index, data[value_offset:value_offset + value_len], expires_at
+        return None
+
+    def get(self, key):
+        """(値, 有効期限) を返す（存在しなければ None）"""
+        found = self._find(key.encode())
+        if found is None:
+            return None
+        return found[1], found[2]
+
+    def delete(self, key):
+        """キーを削除（スロットは DELETED として再利用される）"""
+        key_bytes = key.encode()
+        found = self._find(key_bytes)
+        if found is None:
+            return False
+        index = found[0]
+        stripe = self._lock(index)
+        try:
+            state, slot_key, _, _, _ = self._read(index)
+            if state != USED or slot_key != key_bytes:
+                return False
+            self._write(index, DELETED)
+            return True
+        finally:
+            self._unlock(index, stripe)
+
+    def update(self, key, func):
+        """キーの値を func(値, 有効期限) の結果で置き換える（func が None を返したら変更しない）。置き換えたら True
+
+        読み出しから書き込みまでスロットのロックを持つので、他のスレッド・プロセスの update と交互にならない
+        """
+        key_bytes = key.encode()
+        found = self._find(key_bytes)
+        if found is None:
+            return False
+        index = found[0]
+        stripe = self._lock(index)
+        try:
+            state, slot_key, value_len, expires_at, data = self._read(index)
+            if state != USED or slot_key != key_bytes:
+                return False
+            value_offset = SLOT_HEADER.size + KEY_SIZE
+            value = func(data[value_offset:value_offset + value_len], expires_at)
+            if value is None:
+                return False
+            if len(value) > self.value_size:
+                raise ValueError("Value too large for a slot")
+            self._write(index, USED, key_bytes, value, expires_at)
+            return True
+        finally:
+            self._unlock(index, stripe)
+
+    def sweep(self, now, max_slots):
+        """期限切れのスロットを最大 max_slots 個走査して削除（前回の続きから）"""
+        removed = 0
+        for _ in range(min(max_slots, self.slots)):
+            index = self._sweep_cursor
+            self._sweep_cursor = (index + 1) % self.slots
+            state, _, _, expires_at, _ = self._read(index)
+            if state != USED or expires_at > now:
+                continue
+            stripe = self._lock(index)
+            try:
+                state, _, _, expires_at, _ = self._read(index)
+                if state == USED and expires_at <= now:
+                    self._write(index, DELETED)
+                    removed += 1
+            finally:
+                self._unlock(index, stripe)
+        return removed
+
+    def values(self):
+        """使用中のスロットの値（全走査、ロックなし）"""
+        now = time.time()
+        value_offset = SLOT_HEADER.size + KEY_SIZE
+        for index in range(self.slots):
+            state, _, value_len, expires_at, data = self._read(index)
+            if state == USED and expires_at > now:
+                yield data[value_offset:value_offset + value_len]
+
+    def count(self):
+        """使用中のスロット数（全走査）"""
+        now = time.time()
+        live = 0
+        for index in range(self.slots):
+            state, _, _, expires_at, _ = self._read(index)
+            if state == USED and expires_at > now:
+                live += 1
+        return live
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+def default_shm_dir():
+    """共有メモリ（tmpfs）があれば /dev/shm、なければ一時ディレクトリ"""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedMemoryStorage(MemoryStorage):
+    """認可コード・トークン・失効ファミリーを共有メモリに置くストレージ"""
+
+    def __init__(self, directory=None, prefix="oauth-flask-custom", token_slots=65536, code_slots=16384,
+                 family_slots=16384, overflow_slots=4096):
+        super().__init__()
+        directory = directory or default_shm_dir()
+        self.code_table = SharedHashTable(os.path.join(directory, f"{prefix}-codes.tbl"), code_slots)
+        self.token_table = SharedHashTable(os.path.join(directory, f"{prefix}-tokens.tbl"), token_slots)
+        self.refresh_table = SharedHashTable(os.path.join(directory, f"{prefix}-refresh.tbl"), token_slots)
+        self.family_table = SharedHashTable(os.path.join(directory, f"{prefix}-families.tbl"), family_slots)
+        self.revocation_table = SharedHashTable(os.path.join(directory, f"{prefix}-revocations.tbl"), family_slots)
+        self.overflow_table = SharedHashTable(
+            os.path.join(directory, f"{prefix}-overflow.tbl"), overflow_slots, OVERFLOW_SLOT_SIZE
+        )
+        self.sweep_stats = SweepStats()
+
+    def _tables(self):
+        return (self.code_table, self.token_table, self.refresh_table, self.family_table, self.revocation_table,
+                self.overflow_table)
+
+    def _pack(self, table, fields, expires_at):
+        """値を JSON にする（table のスロットに収まらなければオーバーフロー表に置き、ダイジェストを返す）"""
+        value = json.dumps(fields, separators=(",", ":"), ensure_ascii=False).encode()
+        if len(value) <= table.value_size:
+            return value
+        digest = hashlib.blake2b(value, digest_size=16).hexdigest()
+        # 同じ内容を共有する他のレコードより先に消えないよう、長い方の有効期限を残す
+        found = self.overflow_table.get(digest)
+        self.overflow_table.put(digest, value, max(expires_at, found[1]) if found else expires_at)
+        return OVERFLOW_MARKER + digest.encode()
+
+    def _unpack(self, value):
+        """_pack の逆（オーバーフロー表の値が消えていれば None）"""
+        if value.startswith(OVERFLOW_MARKER):
+            found = self.overflow_table.get(value[len(OVERFLOW_MARKER):].decode())
+            if found is None:
+                return None
+            value = found[0]
+        return json.loads(value)
+
+    # ===== 認可コード =====
+
+    def save_auth_code(self, code, data):
+        expires_at = data["expires_at"].timestamp()
+        value = self._pack(
+            self.code_table, [data["client_id"], data["redirect_uri"], data["scope"], data["username"]], expires_at
+        )
+        self.code_table.put(code, value, expires_at)
+
+    def get_auth_code(self, code):
+        found = self.code_table.get(code)
+        if found is None:
+            return None
+        value, expires_at = found
+        fields = self._unpack(value)
+        if fields is None:
+            return None
+        client_id, redirect_uri, scope, username = fields
+        return {
+            "code": code,
+            "client_id": client_id,
+            "redirect_uri": redirect_uri,
+            "scope": scope,
+            "username": username,
+            "expires_at": datetime.fromtimestamp(expires_at),
+        }
+
+    def delete_auth_code(self, code):
+        self.code_table.delete(code)
+
+    def pop_auth_code_if_valid(self, code, is_valid):
+        data = self.get_auth_code(code)
+        if data is None or not is_valid(data):
+            return None
+        # スロットを削除できたスレッド・プロセスだけが受け取る
+        return data if self.code_table.delete(code) else None
+
+    # ===== アクセストークン =====
+
+    def save_access_token(self, token, data):
+        expires_at = data["expires_at"].timestamp()
+        value = self._pack(
+            self.token_table,
+            [data["client_id"], data["scope"], data["username"], data.get("family_id"), time.time()],
+            expires_at,
+        )
+        self.token_table.put(token, value, expires_at)
+
+    def get_access_token(self, token):
+        found = self.token_table.get(token)
+        if found is None:
+            return None
+        value, expires_at = found
+        fields = self._unpack(value)
+        if fields is None:
+            return None
+        client_id, scope, username, family_id, issued_at = fields
+        if (family_id and self.is_family_revoked(family_id)) or self._is_revoked(username, client_id, issued_at):
+            self.token_table.delete(token)
+            return None
+        return {
+            "access_token": token,
+            "token_type": "Bearer",
+            "client_id": client_id,
+            "scope": scope,
+            "username": username,
+            "family_id": family_id,
+            "expires_at": datetime.fromtimestamp(expires_at),
+        }
+
+    def delete_access_token(self, token):
+        self.token_table.delete(token)
+
+    # ===== リフレッシュトークン =====
+
+    def save_refresh_token(self, token, data):
+        expires_at = data["expires_at"].timestamp()
+        value = self._pack(
+            self.refresh_table,
+            [data["client_id"], data["scope"], data["username"], data["family_id"], bool(data.get("used")),
+             time.time()],
+            expires_at,
+        )
+        self.refresh_table.put(token, value, expires_at)
+
+    def get_refresh_token(self, token):
+        found = self.refresh_table.get(token)
+        if found is None:
+            return None
+        value, expires_at = found
+        fields = self._unpack(value)
+        if fields is None:
+            return None
+        client_id, scope, username, family_id, used, issued_at = fields
+        if self._is_revoked(username, client_id, issued_at):
+            self.refresh_table.delete(token)
+            return None
+        return {
+            "client_id": client_id,
+            "scope": scope,
+            "username": username,
+            "family_id": family_id,
+            "used": used,
+            "expires_at": datetime.fromtimestamp(expires_at),
+        }
+
+    def mark_refresh_token_used(self, token):
+        def mark(value, expires_at):
+            fields = self._unpack(value)
+            if fields is None or fields[4]:
+                return None
+            # 発行時刻は変えずに使用済みフラグだけ立てる
+            fields[4] = True
+            return self._pack(self.refresh_table, fields, expires_at)
+
+        # スロットのロック内で未使用を確認して書き換える（compare-and-set）
+        return self.refresh_table.update(token, mark)
+
+    def delete_refresh_token(self, token):
+        self.refresh_table.delete(token)
+
+    # ===== トークンファミリーの失効 =====
+
+    def revoke_family(self, family_id, expires_at):
+        self.family_table.put(family_id, b"", expires_at.timestamp())
+
+    def is_family_revoked(self, family_id):
+        found = self.family_table.get(family_id)
+        return found is not None and found[1] > time.time()
+
+    # ===== 一括失効（失効時刻のウォーターマーク） =====
+
+    def _revoked_at(self, key):
+        found = self.revocation_table.get(key)
+        return struct.unpack("<d", found[0])[0] if found else 0.0
+
+    def _is_revoked(self, username, client_id, issued_at):
+        """失効時刻より前に発行されたトークンか"""
+        return issued_at <= max(self._revoked_at(f"u:{username}"), self._revoked_at(f"c:{client_id}"))
+
+    def _revoke_before_now(self, key, position, owner):
+        """key の失効時刻を今にする。fields[position]（0: client_id, 2: username）が owner で、
+        まだ失効していなかったアクセストークン・リフレッシュトークンの数を返す（全スロットを走査する）
+        """
+        now = time.time()
+        count = 0
+        for table in (self.token_table, self.refresh_table):
+            for value in table.values():
+                fields = self._unpack(value)
+                if fields is None:
+                    continue
+                client_id, username, issued_at = fields[0], fields[2], fields[-1]
+                if fields[position] == owner and issued_at <= now and not self._is_revoked(username, client_id, issued_at):
+                    count += 1
+        self.revocation_table.put(key, struct.pack("<d", now), now + REVOCATION_TTL)
+        return count
+
+    def revoke_user_tokens(self, username):
+        """ユーザーの既存トークンをすべて失効"""
+        return self._revoke_before_now(f"u:{username}", 2, username)
+
+    def revoke_client_tokens(self, client_id):
+        """クライアントの既存トークンをすべて失効"""
+        return self._revoke_before_now(f"c:{client_id}", 0, client_id)
+
+    # ===== 期限切れの削除 =====
+
+    def has_expired(self, now):
+        # 期限順の索引は持たないため、スイーパーは interval ごとに少しずつ走査する
+        return False
+
+    def sweep_expired(self, max_batch=1000):
+        """スロットを最大 max_batch 個ずつ走査して期限切れを削除"""
+        start = time.perf_counter()
+        now = time.time()
+        removed = sum(table.sweep(now, max_batch) for table in self._tables())
+        self.sweep_stats.record(removed, (time.perf_counter() - start) * 1000)
+        return removed
+
+    def stats(self):
+        return {
+            "backend": "shm",
+            "live_auth_codes": self.code_table.count(),
+            "live_access_tokens": self.token_table.count(),
+            "live_refresh_tokens": self.refresh_table.count(),
+            "revoked_families": self.family_table.count(),
+            "revocation_watermarks": self.revocation_table.count(),
+            "overflow_values": self.overflow_table.count(),
+            "slots": {
+                "auth_codes": self.code_table.slots,
+                "access_tokens": self.token_table.slots,
+                "refresh_tokens": self.refresh_table.slots,
+                "revoked_families": self.family_table.slots,
+                "revocation_watermarks": self.revocation_table.slots,
+                "overflow_values": self.overflow_table.slots,
+            },
+            "probes": sum(table.probes for table in self._tables()),
+            "read_retries": sum(table.read_retries for table in self._tables()),
+            "sweep": self.sweep_stats.as_dict(),
+        }